@@ -21,6 +21,7 @@
 
 from __future__ import print_function
 
+import concurrent.futures
 import errno
 import os
 import signal
@@ -29,14 +30,19 @@ import subprocess
 import sys
 import syslog
 import time
+import traceback
 
 import apt_pkg
-from apt.cache import Cache
 import debconf
 
 sys.path.insert(0, '/usr/lib/ubiquity')
 
-from ubiquity import install_misc, misc, osextras
+from ubiquity import copy_manifest, install_misc, misc, osextras
+
+
+# Byte-compiling Python needs the interpreter and its libraries, and dpkg's
+# lists of which modules belong to the standard library.
+PYTHON_SUBTREES = ('etc', 'lib', 'lib64', 'usr', 'var/lib/dpkg')
 
 
 class Install(install_misc.InstallBase):
@@ -61,7 +67,7 @@ class Install(install_misc.InstallBase):
         else:
             self.source = '/var/lib/ubiquity/source'
         self.db = debconf.Debconf()
-        self.blacklist = {}
+        self.blacklist = install_misc.Blacklist()
 
         if 'UBIQUITY_OEM_USER_CONFIG' in os.environ:
             self.source = None
@@ -110,54 +116,56 @@ class Install(install_misc.InstallBase):
 
         if self.target != '/':
             self.next_region(size=74)
-            # We don't later wait() on this pid by design.  There's no
-            # sense waiting for updates to finish downloading when they can
-            # quite easily finish downloading them once inside the new
-            # Ubuntu system.
-            # TODO can we incorporate the bytes copied / bytes total into
-            # the main progress bar?
-            # TODO log to /var/log/installer/debug
-            # TODO make sure KeyboardInterrupt and SystemExit kills this
-            # TODO the install will blow up spectacularly if this is still
-            # holding the apt lock when other apt install tasks run, I
-            # imagine.  Have those spin until the lock is released.
-            if self.db.get('ubiquity/download_updates') == 'true':
-                cmd = ['/usr/share/ubiquity/update-apt-cache']
-
-                def subprocess_setup():
-                    signal.signal(signal.SIGPIPE, signal.SIG_DFL)
-                    os.setpgid(0, 0)
-
-                self.update_proc = subprocess.Popen(
-                    cmd, stdin=subprocess.PIPE, stdout=subprocess.PIPE,
-                    preexec_fn=subprocess_setup)
-            try:
-                self.copy_all()
-            except EnvironmentError as e:
-                if e.errno in (errno.ENOENT, errno.EIO, errno.EFAULT,
-                               errno.ENOTDIR, errno.EROFS):
-                    if e.filename is None:
-                        error_template = 'cd_hd_fault'
-                    elif e.filename.startswith(self.target):
-                        error_template = 'hd_fault'
+            block_image = self.find_block_image()
+            # update-apt-cache writes to the target, so if we're going to
+            # replace the whole target filesystem then it has to wait until
+            # that's done.
+            if block_image is None:
+                self.start_update_apt_cache()
+            while True:
+                try:
+                    if block_image is not None:
+                        try:
+                            self.install_block_image(*block_image)
+                        except install_misc.InstallStepError as e:
+                            if not self.block_image_failed(block_image, e):
+                                raise
+                            block_image = None
+                            self.start_update_apt_cache()
+                            continue
+                        self.start_update_apt_cache()
                     else:
-                        error_template = 'cd_fault'
-                    error_template = ('ubiquity/install/copying_error/%s' %
-                                      error_template)
-                    self.db.subst(error_template, 'ERROR', str(e))
-                    self.db.input('critical', error_template)
-                    self.db.go()
-                    # Exit code 3 signals to the frontend that we have handled
-                    # this error.
-                    sys.exit(3)
-                elif e.errno == errno.ENOSPC:
-                    error_template = 'ubiquity/install/copying_error/no_space'
+                        self.copy_all()
+                    break
+                except EnvironmentError as e:
+                    if e.errno in (errno.ENOENT, errno.EIO, errno.EFAULT,
+                                   errno.ENOTDIR, errno.EROFS):
+                        if e.filename is None:
+                            error_template = 'cd_hd_fault'
+                        elif e.filename.startswith(self.target):
+                            error_template = 'hd_fault'
+                        else:
+                            error_template = 'cd_fault'
+                        error_template = (
+                            'ubiquity/install/copying_error/%s' %
+                            error_template)
+                    elif e.errno == errno.ENOSPC:
+                        error_template = (
+                            'ubiquity/install/copying_error/no_space')
+                    else:
+                        raise
                     self.db.subst(error_template, 'ERROR', str(e))
                     self.db.input('critical', error_template)
                     self.db.go()
+                    # copy_all keeps a journal of what it has copied, so it
+                    # can carry on from where it stopped.
+                    if block_image is None and self.resume_copy():
+                        # copy_all starts its progress bar again.
+                        self.db.progress('STOP')
+                        continue
+                    # Exit code 3 signals to the frontend that we have
+                    # handled this error.
                     sys.exit(3)
-                else:
-                    raise
 
         if self.source == '/var/lib/ubiquity/source':
             self.umount_source()
@@ -182,6 +190,36 @@ class Install(install_misc.InstallBase):
             self.update_proc.stdout.close()
             syslog.syslog('Terminated ubiquity update process.')
 
+    def resume_copy(self):
+        """Ask whether to try copying again after an error."""
+        question = 'ubiquity/install/copying_error/resume'
+        self.db.input('critical', question)
+        self.db.go()
+        return self.db.get(question) == 'true'
+
+    def start_update_apt_cache(self):
+        """Start downloading updates in the background, if requested."""
+        # We don't later wait() on this pid by design.  There's no sense
+        # waiting for updates to finish downloading when they can quite
+        # easily finish downloading them once inside the new Ubuntu system.
+        # TODO can we incorporate the bytes copied / bytes total into the
+        # main progress bar?
+        # TODO log to /var/log/installer/debug
+        # TODO make sure KeyboardInterrupt and SystemExit kills this
+        # TODO the install will blow up spectacularly if this is still
+        # holding the apt lock when other apt install tasks run, I imagine.
+        # Have those spin until the lock is released.
+        if self.db.get('ubiquity/download_updates') == 'true':
+            cmd = ['/usr/share/ubiquity/update-apt-cache']
+
+            def subprocess_setup():
+                signal.signal(signal.SIGPIPE, signal.SIG_DFL)
+                os.setpgid(0, 0)
+
+            self.update_proc = subprocess.Popen(
+                cmd, stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                preexec_fn=subprocess_setup)
+
     def find_cd_kernel(self):
         """Find the boot kernel on the CD, if possible."""
 
@@ -246,7 +284,7 @@ class Install(install_misc.InstallBase):
         else:
             difference = set()
 
-        cache = Cache()
+        cache = self.get_cache()
 
         use_restricted = True
         try:
@@ -255,10 +293,7 @@ class Install(install_misc.InstallBase):
         except debconf.DebconfError:
             pass
         if not use_restricted:
-            for pkg in cache.keys():
-                if (cache[pkg].is_installed and
-                        cache[pkg].section.startswith('restricted/')):
-                    difference.add(pkg)
+            difference |= install_misc.restricted_packages(cache)
 
         # Keep packages we explicitly installed.
         keep = install_misc.query_recorded_installed()
@@ -305,8 +340,9 @@ class Install(install_misc.InstallBase):
         except (debconf.DebconfError, IOError):
             pass
 
-        difference -= install_misc.expand_dependencies_simple(
-            cache, keep, difference)
+        graph = install_misc.DependencyGraph(cache)
+        del cache
+        difference -= graph.keep_closure(keep, difference)
 
         # Consider only packages that don't have a prerm, and which can
         # therefore have their files removed without any preliminary work.
@@ -315,38 +351,30 @@ class Install(install_misc.InstallBase):
             if not os.path.exists('/var/lib/dpkg/info/%s.prerm' % x)}
 
         confirmed_remove = set()
-        with cache.actiongroup():
-            for pkg in sorted(difference):
-                if pkg in confirmed_remove:
-                    continue
-                would_remove = install_misc.get_remove_list(
-                    cache, [pkg], recursive=True)
-                if would_remove <= difference:
-                    confirmed_remove |= would_remove
-                    # Leave these marked for removal in the apt cache to
-                    # speed up further calculations.
-                else:
-                    for removedpkg in would_remove:
-                        cachedpkg = install_misc.get_cache_pkg(
-                            cache, removedpkg)
-                        cachedpkg.mark_keep()
+        for pkg in sorted(difference):
+            if pkg in confirmed_remove:
+                continue
+            would_remove = graph.removal_closure(
+                [pkg], recursive=True, removed=confirmed_remove)
+            if would_remove <= difference:
+                confirmed_remove |= would_remove
         difference = confirmed_remove
 
         if len(difference) == 0:
-            del cache
-            self.blacklist = {}
+            self.blacklist = install_misc.Blacklist()
             return
 
-        cmd = ['dpkg', '-L']
-        cmd.extend(difference)
-        subp = subprocess.Popen(
-            cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE,
-            universal_newlines=True)
-        res = subp.communicate()[0].splitlines()
-        u = {}
-        for x in res:
-            u[x] = 1
-        self.blacklist = u
+        # Live images may ship an index of package files to save us
+        # reading dpkg's file lists.
+        index = install_misc.DpkgPathIndex.open(
+            cache_path='/var/lib/ubiquity/dpkg-path-index')
+        # Knowing what we're keeping lets copy_all skip whole directories
+        # that only contain files we're not.  Reading the file lists of
+        # every kept package is expensive, so only do it if some directory
+        # might be skipped.
+        kept = set(index.lists) - difference
+        self.blacklist = install_misc.Blacklist(
+            index.files(difference), lambda: index.files(kept))
 
     def copy_all(self):
         """Core copy process. This is the most important step of this
@@ -356,10 +384,28 @@ class Install(install_misc.InstallBase):
         self.db.progress('START', 0, 100, 'ubiquity/install/title')
         self.db.progress('INFO', 'ubiquity/install/copying')
 
+        self.verifier = install_misc.FileVerifier.from_debconf(self.db)
+        stats = install_misc.CopyStats(
+            live_path='/var/lib/ubiquity/copy-stats.json')
+        self.verifier.stats = stats
+        # If the source is on the same filesystem as the target (as when
+        # re-imaging in place), then on btrfs or XFS the target can share
+        # the source's data blocks rather than copying them.
+        self.verifier.clone = (
+            os.stat(self.source).st_dev == os.stat(self.target).st_dev)
+        manifest = self.open_copy_manifest()
         fs_size = os.path.join(self.casper_path, 'filesystem.size')
-        if os.path.exists(fs_size):
+        if manifest is not None:
+            # The manifest lists everything we need to copy, with exact
+            # sizes, so we don't need to walk the source at all.
+            total_size = manifest.total_size
+            entries = self.prune_entries(
+                (entry.path, entry) for entry in
+                manifest.entries(self.verifier.hash_name))
+        elif os.path.exists(fs_size):
             with open(fs_size) as total_size_fp:
                 total_size = int(total_size_fp.readline())
+            entries = self.walk_source()
         else:
             # Fallback in case an Ubuntu derivative forgets to put
             # /casper/filesystem.size on the CD, or to account for things
@@ -376,49 +422,82 @@ class Install(install_misc.InstallBase):
                 for name in dirnames + filenames:
                     fqpath = os.path.join(dirpath, name)
                     total_size += os.lstat(fqpath).st_size
+            entries = self.walk_source()
 
-        # Progress bar handling:
-        # We sample progress every half-second (assuming time.time() gives
-        # us sufficiently good granularity) and use the average of progress
-        # over the last minute or so to decide how much time remains. We
-        # don't bother displaying any progress for the first ten seconds in
-        # order to allow things to settle down, and we only update the "time
-        # remaining" indicator at most every two seconds after that.
-
-        copy_progress = 0
-        copied_size = 0
+        progress = install_misc.CopyProgress(self.db, total_size)
         directory_times = []
-        time_start = time.time()
-        times = [(time_start, copied_size)]
-        long_enough = False
-        time_last_update = time_start
         debug = 'UBIQUITY_DEBUG' in os.environ
-        if self.db.get('ubiquity/install/md5_check') == 'false':
-            md5_check = False
+
+        # Regular files are copied by a pool of worker threads; everything
+        # else is created here, in os.walk() order, so that directories
+        # always exist before anything is copied into them.  Files are
+        # handed to the workers in batches sorted by where their data lives
+        # in the source, to keep reads close to sequential.  Files that
+        # need reading back are verified by a background thread some way
+        # behind the copy.
+        orderer = install_misc.ReadOrderer()
+        copier = install_misc.ParallelCopier(
+            self.copy_regular_file, self.copy_workers())
+        if self.verifier.mode != 'none':
+            background_verifier = install_misc.BackgroundVerifier(
+                self.verifier)
         else:
-            md5_check = True
-
-        # Increase kernel flush times during bulk data copying to make it
-        # more likely that small files are packed contiguously, which should
-        # speed up initial boot times.
-        dirty_writeback_centisecs = None
-        dirty_expire_centisecs = None
-        if os.path.exists('/proc/sys/vm/dirty_writeback_centisecs'):
-            with open('/proc/sys/vm/dirty_writeback_centisecs') as dwc:
-                dirty_writeback_centisecs = int(dwc.readline())
-            with open('/proc/sys/vm/dirty_writeback_centisecs', 'w') as dwc:
-                print('3000\n', file=dwc)
-        if os.path.exists('/proc/sys/vm/dirty_expire_centisecs'):
-            with open('/proc/sys/vm/dirty_expire_centisecs') as dec:
-                dirty_expire_centisecs = int(dec.readline())
-            with open('/proc/sys/vm/dirty_expire_centisecs', 'w') as dec:
-                print('6000\n', file=dec)
+            background_verifier = None
+
+        # Files that have been copied are recorded in a journal, so that
+        # if we fail part-way through then we can pick up from there.
+        journal = install_misc.CopyJournal(
+            '/var/lib/ubiquity/copy-journal', self.source, self.target)
+
+        def recopy(results):
+            # Failures are rare, so just deal with them synchronously.
+            for (sourcepath, targetpath, st), ok in results:
+                if not ok:
+                    if not install_misc.copy_file_error(self.db, targetpath):
+                        continue
+                    if not install_misc.copy_file(
+                            self.db, sourcepath, targetpath, True,
+                            verifier=self.verifier,
+                            expected=getattr(st, 'hash', None)):
+                        continue
+                    install_misc.copy_metadata(
+                        sourcepath, targetpath, st, stats)
+                journal.record(targetpath[len(self.target) + 1:], st)
+
+        def copied(results):
+            for args, ok in results:
+                if (ok and background_verifier is not None and
+                        self.verifier.reads_back(
+                            getattr(args[2], 'hash', None))):
+                    recopy(background_verifier.submit(*args))
+                else:
+                    recopy([(args, ok)])
+                progress.add(args[2].st_size)
+                stats.add(args[2])
+                watcher.copied(args[1][len(self.target) + 1:])
+
+        # Some of the configuration that plugininstall.py does only needs
+        # part of the target, so start it as soon as that part has been
+        # copied rather than waiting for the rest.
+        watcher = install_misc.SubtreeWatcher()
+        early = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+        # A record left by an earlier install in this session describes a
+        # different target.
+        osextras.unlink_force(install_misc.PYTHON_STDLIB_COMPILED)
+
+        def compile_python():
+            early.submit(self.compile_python_early)
+
+        watcher.watch(
+            [path for path in PYTHON_SUBTREES
+             if os.path.isdir(os.path.join(self.source, path)) and
+             not os.path.islink(os.path.join(self.source, path))],
+            compile_python)
 
         old_umask = os.umask(0)
-        for dirpath, dirnames, filenames in os.walk(self.source):
-            sp = dirpath[len(self.source) + 1:]
-            for name in dirnames + filenames:
-                relpath = os.path.join(sp, name)
+        try:
+            for relpath, st in entries:
+                watcher.walked(relpath)
                 # /etc/fstab was legitimately created by partman, and
                 # shouldn't be copied again.  Similarly, /etc/crypttab may
                 # have been legitimately created by the user-setup plugin.
@@ -426,7 +505,6 @@ class Install(install_misc.InstallBase):
                     continue
                 sourcepath = os.path.join(self.source, relpath)
                 targetpath = os.path.join(self.target, relpath)
-                st = os.lstat(sourcepath)
 
                 # Is the path blacklisted?
                 if (not stat.S_ISDIR(st.st_mode) and
@@ -435,93 +513,43 @@ class Install(install_misc.InstallBase):
                         syslog.syslog('Not copying %s' % relpath)
                     continue
 
+                # Did we copy it last time round?
+                if (stat.S_ISREG(st.st_mode) and
+                        journal.is_done(relpath, st, targetpath)):
+                    progress.add(st.st_size)
+                    continue
+
                 # Remove the target if necessary and if we can.
                 install_misc.remove_target(
                     self.source, self.target, relpath, st)
 
-                # Now actually copy source to target.
-                mode = stat.S_IMODE(st.st_mode)
-                if stat.S_ISLNK(st.st_mode):
-                    linkto = os.readlink(sourcepath)
-                    os.symlink(linkto, targetpath)
-                elif stat.S_ISDIR(st.st_mode):
-                    if not os.path.isdir(targetpath):
-                        try:
-                            os.mkdir(targetpath, mode)
-                        except OSError as e:
-                            # there is a small window where update-apt-cache
-                            # can race with us since it creates
-                            # "/target/var/cache/apt/...". Hence, ignore
-                            # failure if the directory does now exist where
-                            # brief moments before it didn't.
-                            if e.errno != errno.EEXIST:
-                                raise
-                elif stat.S_ISCHR(st.st_mode):
-                    os.mknod(targetpath, stat.S_IFCHR | mode, st.st_rdev)
-                elif stat.S_ISBLK(st.st_mode):
-                    os.mknod(targetpath, stat.S_IFBLK | mode, st.st_rdev)
-                elif stat.S_ISFIFO(st.st_mode):
-                    os.mknod(targetpath, stat.S_IFIFO | mode)
-                elif stat.S_ISSOCK(st.st_mode):
-                    os.mknod(targetpath, stat.S_IFSOCK | mode)
-                elif stat.S_ISREG(st.st_mode):
-                    install_misc.copy_file(
-                        self.db, sourcepath, targetpath, md5_check)
-
-                # Copy metadata.
-                copied_size += st.st_size
-                os.lchown(targetpath, st.st_uid, st.st_gid)
-                if not stat.S_ISLNK(st.st_mode):
-                    os.chmod(targetpath, mode)
+                if stat.S_ISREG(st.st_mode):
+                    watcher.submitted(relpath)
+                    for args in orderer.add(sourcepath, targetpath, st):
+                        copied(copier.submit(*args))
+                    continue
+
+                self.copy_special_file(sourcepath, targetpath, st)
+                install_misc.copy_metadata(sourcepath, targetpath, st, stats)
                 if stat.S_ISDIR(st.st_mode):
                     directory_times.append(
                         (targetpath, st.st_atime, st.st_mtime))
-                # os.utime() sets timestamp of target, not link
-                elif not stat.S_ISLNK(st.st_mode):
-                    try:
-                        os.utime(targetpath, (st.st_atime, st.st_mtime))
-                    except Exception:
-                        # We can live with timestamps being wrong.
-                        pass
-                if (hasattr(os, "listxattr") and
-                        hasattr(os, "supports_follow_symlinks") and
-                        os.supports_follow_symlinks):
-                    try:
-                        attrnames = os.listxattr(
-                            sourcepath, follow_symlinks=False)
-                        for attrname in attrnames:
-                            attrvalue = os.getxattr(
-                                sourcepath, attrname, follow_symlinks=False)
-                            os.setxattr(
-                                targetpath, attrname, attrvalue,
-                                follow_symlinks=False)
-                    except OSError as e:
-                        if e.errno not in (
-                                errno.EPERM, errno.ENOTSUP, errno.ENODATA):
-                            raise
-
-                if int((copied_size * 90) / total_size) != copy_progress:
-                    copy_progress = int((copied_size * 90) / total_size)
-                    self.db.progress('SET', 10 + copy_progress)
-
-                time_now = time.time()
-                if (time_now - times[-1][0]) >= 0.5:
-                    times.append((time_now, copied_size))
-                    if not long_enough and time_now - times[0][0] >= 10:
-                        long_enough = True
-                    if long_enough and time_now - time_last_update >= 2:
-                        time_last_update = time_now
-                        while (time_now - times[0][0] > 60 and
-                               time_now - times[1][0] >= 60):
-                            times.pop(0)
-                        speed = ((times[-1][1] - times[0][1]) /
-                                 (times[-1][0] - times[0][0]))
-                        if speed != 0:
-                            time_remaining = (
-                                int((total_size - copied_size) / speed))
-                            if time_remaining < 60:
-                                self.db.progress(
-                                    'INFO', 'ubiquity/install/copying_minute')
+                progress.add(st.st_size)
+                stats.add(st)
+
+            for args in orderer.flush():
+                copied(copier.submit(*args))
+            copied(copier.finish())
+            if background_verifier is not None:
+                recopy(background_verifier.finish())
+            watcher.finish()
+        finally:
+            copier.shutdown()
+            if background_verifier is not None:
+                background_verifier.shutdown()
+            journal.close()
+            os.umask(old_umask)
+            early.shutdown()
 
         # Apply timestamps to all directories now that the items within them
         # have been copied.
@@ -534,14 +562,57 @@ class Install(install_misc.InstallBase):
                 # about this failing, but I really don't care. Ignore it.
                 pass
 
-        # Revert to previous kernel flush times.
-        if dirty_writeback_centisecs is not None:
-            with open('/proc/sys/vm/dirty_writeback_centisecs', 'w') as dwc:
-                print(dirty_writeback_centisecs, file=dwc)
-        if dirty_expire_centisecs is not None:
-            with open('/proc/sys/vm/dirty_expire_centisecs', 'w') as dec:
-                print(dirty_expire_centisecs, file=dec)
+        self.copy_cd_kernel()
+
+        # Files aren't flushed one by one as they're copied (except for
+        # read-back verification), which leaves the kernel free to lay out
+        # small files together; flush the whole target in one go now.
+        with install_misc.timed(stats, 'write'):
+            osextras.syncfs(self.target)
+        journal.remove()
+
+        stats.write('/var/lib/ubiquity/copy-stats.json')
+        stats.write('/var/log/installer/copy-stats.json')
+
+        self.db.progress('SET', 100)
+        self.db.progress('STOP')
+
+    def compile_python_early(self):
+        """Byte-compile the Python standard library in the target.
 
+        This runs in the background during the copy, as soon as everything
+        it needs has been copied.  Failure isn't fatal, since
+        plugininstall.py compiles anything not recorded as done here.
+        """
+        workers = os.cpu_count() or 1
+        try:
+            index = install_misc.DpkgPathIndex(
+                self.target_file('var/lib/dpkg/info'))
+            batches = list(self.python_stdlib_batches(
+                index, workers, exclude=self.blacklist))
+            with concurrent.futures.ThreadPoolExecutor(
+                    max_workers=workers) as executor:
+                for job in [
+                        executor.submit(
+                            install_misc.py_compile, self.target, python,
+                            batch)
+                        for python, batch in batches]:
+                    job.result()
+        except Exception:
+            syslog.syslog(syslog.LOG_WARNING,
+                          'Failed to byte-compile Python during copy:')
+            for line in traceback.format_exc().split('\n'):
+                syslog.syslog(syslog.LOG_WARNING, line)
+            return
+        # copy_all may still have its umask of 0 in force.
+        fd = os.open(install_misc.PYTHON_STDLIB_COMPILED,
+                     os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+        with open(fd, 'w') as compiled:
+            for python in sorted(set(python for python, _ in batches)):
+                print(python, file=compiled)
+
+    def copy_cd_kernel(self):
+        """Copy the kernel we booted from the CD to the target."""
         # Try some possible locations for the kernel we used to boot. This
         # lets us save a couple of megabytes of CD space.
         bootdir = self.target_file('boot')
@@ -573,7 +644,8 @@ class Install(install_misc.InstallBase):
 
             for source, target in copies:
                 osextras.unlink_force(target)
-                install_misc.copy_file(self.db, source, target, md5_check)
+                install_misc.copy_file(
+                    self.db, source, target, True, verifier=self.verifier)
                 os.lchown(target, 0, 0)
                 os.chmod(target, 0o644)
                 st = os.lstat(source)
@@ -587,11 +659,329 @@ class Install(install_misc.InstallBase):
                 # Construct the unsigned kernel.
                 subprocess.check_call(["sbattach", "--remove", target_kernel])
 
-        os.umask(old_umask)
+    def open_copy_manifest(self):
+        """Open the copy manifest shipped alongside the live filesystem.
+
+        Return None if there isn't one or if it can't be used, in which case
+        we fall back to walking the source.
+        """
+        path = os.path.join(self.casper_path, 'filesystem.copymanifest')
+        if not os.path.exists(path):
+            return None
+        image = os.path.join(self.casper_path, 'filesystem.squashfs')
+        if not self.source_is_image(image):
+            syslog.syslog('Ignoring copy manifest: %s is not mounted from %s'
+                          % (self.source, image))
+            return None
+        try:
+            return copy_manifest.CopyManifest(path, image=image)
+        except (OSError, copy_manifest.ManifestError) as e:
+            syslog.syslog(syslog.LOG_WARNING,
+                          'Ignoring copy manifest: %s' % e)
+            return None
+
+    def source_is_image(self, image):
+        """Return True if the source is the filesystem image at image.
+
+        A source made up of several layers, or mounted from some other
+        image, has different contents from the one that image's copy
+        manifest describes.
+        """
+        source = None
+        with open('/proc/mounts') as fp:
+            for line in fp:
+                device, mountpoint, fstype = line.split()[:3]
+                # Later mounts hide earlier ones.
+                if mountpoint == self.source:
+                    source = (device, fstype)
+        if source is None or source[1] != 'squashfs':
+            return False
+        backing = os.path.join(
+            '/sys/block', os.path.basename(source[0]), 'loop/backing_file')
+        try:
+            with open(backing) as fp:
+                return os.path.samefile(fp.read().rstrip('\n'), image)
+        except (IOError, OSError):
+            return False
+
+    def walk_source(self):
+        """Yield (relpath, stat result) for everything in the source.
+
+        Directories come before anything inside them.  Directories whose
+        entire contents are blacklisted are skipped; they are still
+        listed, but nothing in them is stat-ed.
+        """
+        def walk():
+            for dirpath, dirnames, filenames in os.walk(self.source):
+                sp = dirpath[len(self.source) + 1:]
+                for name in dirnames:
+                    yield os.path.join(sp, name), True, None
+                for name in filenames:
+                    yield os.path.join(sp, name), False, None
+
+        for relpath, _ in self.blacklist.prune(walk()):
+            yield relpath, os.lstat(os.path.join(self.source, relpath))
+
+    def prune_entries(self, entries):
+        """Filter entirely blacklisted directories out of entries.
+
+        entries must be in os.walk() order.
+        """
+        return self.blacklist.prune(
+            (relpath, stat.S_ISDIR(st.st_mode), st)
+            for relpath, st in entries)
+
+    def copy_workers(self):
+        """Return the number of threads to use for copying files."""
+        try:
+            workers = int(self.db.get('ubiquity/install/copy-workers'))
+        except (debconf.DebconfError, ValueError):
+            workers = 0
+        if workers <= 0:
+            workers = install_misc.default_copy_workers()
+        return workers
+
+    def copy_special_file(self, sourcepath, targetpath, st):
+        """Create anything other than a regular file in the target."""
+        mode = stat.S_IMODE(st.st_mode)
+        if stat.S_ISLNK(st.st_mode):
+            linkto = getattr(st, 'linktarget', None)
+            if linkto is None:
+                linkto = os.readlink(sourcepath)
+            os.symlink(linkto, targetpath)
+        elif stat.S_ISDIR(st.st_mode):
+            if not os.path.isdir(targetpath):
+                try:
+                    os.mkdir(targetpath, mode)
+                except OSError as e:
+                    # there is a small window where update-apt-cache can
+                    # race with us since it creates
+                    # "/target/var/cache/apt/...". Hence, ignore failure if
+                    # the directory does now exist where brief moments
+                    # before it didn't.
+                    if e.errno != errno.EEXIST:
+                        raise
+        elif stat.S_ISCHR(st.st_mode):
+            os.mknod(targetpath, stat.S_IFCHR | mode, st.st_rdev)
+        elif stat.S_ISBLK(st.st_mode):
+            os.mknod(targetpath, stat.S_IFBLK | mode, st.st_rdev)
+        elif stat.S_ISFIFO(st.st_mode):
+            os.mknod(targetpath, stat.S_IFIFO | mode)
+        elif stat.S_ISSOCK(st.st_mode):
+            os.mknod(targetpath, stat.S_IFSOCK | mode)
+
+    def copy_regular_file(self, sourcepath, targetpath, st):
+        """Copy a regular file and its metadata.
+
+        This runs in a copy worker thread, so it must not talk to debconf.
+        Return False if the copy did not match its source.
+        """
+        start = time.monotonic()
+        # Manifest entries may carry a known-good hash of the file.
+        expected = getattr(st, 'hash', None)
+        if (st.st_size <= install_misc.SMALL_FILE_SIZE and
+                not self.verifier.clone):
+            ok = install_misc.copy_small_file(
+                sourcepath, targetpath, st, self.verifier, expected)
+        else:
+            ok = self.verifier.copy(sourcepath, targetpath, expected)
+            install_misc.copy_metadata(
+                sourcepath, targetpath, st, self.verifier.stats)
+        if self.verifier.stats is not None:
+            self.verifier.stats.add_directory_time(
+                os.path.dirname(sourcepath[len(self.source):]),
+                time.monotonic() - start)
+        return ok
+
+    def target_mounts(self):
+        """Return (device, mountpoint, fstype, options) for each mount at
+        or below the target, in mount order."""
+        mounts = []
+        with open('/proc/mounts') as fp:
+            for line in fp:
+                device, mountpoint, fstype, options = line.split()[:4]
+                if (mountpoint == self.target or
+                        mountpoint.startswith(self.target + '/')):
+                    mounts.append((device, mountpoint, fstype, options))
+        return mounts
+
+    def find_block_image(self):
+        """Decide whether we can stream a filesystem image to the target.
+
+        This only works if ubiquity/install/block-image has been preseeded,
+        the target is a freshly-made filesystem of the same type as the
+        image, and nothing that the image provides would be hidden by
+        another filesystem mounted on the target.  Return the arguments for
+        install_block_image if so, or None to copy files as usual.
+        """
+        try:
+            image = self.db.get('ubiquity/install/block-image')
+        except debconf.DebconfError:
+            image = ''
+        if not image:
+            return None
+
+        def unsuitable(reason):
+            syslog.syslog('Not streaming %s: %s' % (image, reason))
+            return None
+
+        if not os.path.isfile(image):
+            return unsuitable('image not found')
+        mounts = self.target_mounts()
+        if not mounts or mounts[0][1] != self.target:
+            return unsuitable('%s is not mounted' % self.target)
+        (device, _, fstype, options), submounts = mounts[0], mounts[1:]
+        if fstype not in ('ext2', 'ext3', 'ext4'):
+            return unsuitable('cannot resize %s filesystems' % fstype)
+        image_fstype = subprocess.Popen(
+            ['blkid', '-p', '-o', 'value', '-s', 'TYPE', image],
+            stdout=subprocess.PIPE,
+            universal_newlines=True).communicate()[0].strip()
+        if image_fstype != fstype:
+            return unsuitable('image is %s but target is %s' %
+                              (image_fstype or 'unknown', fstype))
+        if os.path.getsize(image) > install_misc.block_device_size(device):
+            return unsuitable('image is larger than %s' % device)
+        for _, mountpoint, _, _ in submounts:
+            relpath = mountpoint[len(self.target) + 1:]
+            sourcepath = os.path.join(self.source, relpath)
+            if os.path.isdir(sourcepath) and os.listdir(sourcepath):
+                return unsuitable('/%s is a separate filesystem' % relpath)
+        for dirpath, dirnames, filenames in os.walk(self.target):
+            dirnames[:] = [
+                name for name in dirnames
+                if not os.path.ismount(os.path.join(dirpath, name))]
+            for name in filenames:
+                relpath = os.path.join(dirpath, name)[len(self.target) + 1:]
+                if relpath not in ("etc/fstab", "etc/crypttab"):
+                    return unsuitable('%s is not empty' % self.target)
+        return image, device, fstype, options, submounts
+
+    def install_block_image(self, image, device, fstype, options,
+                            submounts):
+        """Stream a filesystem image onto the target's root partition.
+
+        The filesystem is then grown to fill the partition and given back
+        the UUID that partman created it with, so that fstab still matches.
+        Anything else mounted on the target is unmounted while this
+        happens.
+        """
+        self.db.progress('START', 0, 100, 'ubiquity/install/title')
+        self.db.progress('INFO', 'ubiquity/install/copying')
+        self.verifier = install_misc.FileVerifier.from_debconf(self.db)
+
+        # /etc/fstab was legitimately created by partman, and /etc/crypttab
+        # may have been legitimately created by the user-setup plugin.
+        # Save them so that we can put them back afterwards.
+        preserved = {}
+        for relpath in ("etc/fstab", "etc/crypttab"):
+            if os.path.exists(self.target_file(relpath)):
+                with open(self.target_file(relpath), 'rb') as fp:
+                    preserved[relpath] = fp.read()
+        uuid = subprocess.Popen(
+            ['blkid', '-o', 'value', '-s', 'UUID', device],
+            stdout=subprocess.PIPE,
+            universal_newlines=True).communicate()[0].strip()
+
+        for _, mountpoint, _, _ in reversed(submounts):
+            if not misc.execute('umount', mountpoint):
+                raise install_misc.InstallStepError(
+                    "Failed to unmount %s" % mountpoint)
+        if not misc.execute('umount', self.target):
+            raise install_misc.InstallStepError(
+                "Failed to unmount %s" % self.target)
+
+        try:
+            with open(image, 'rb') as fp:
+                data_size = sum(
+                    length for _, length in
+                    install_misc.image_data_extents(
+                        fp.fileno(), os.fstat(fp.fileno()).st_size))
+            progress = install_misc.CopyProgress(self.db, data_size or 1)
+            install_misc.stream_image(image, device, progress.add)
+            # e2fsck exits 1 or 2 if it corrected anything, which is fine.
+            if subprocess.call(['e2fsck', '-f', '-p', device]) >= 4:
+                raise install_misc.InstallStepError(
+                    "Filesystem check of %s failed" % device)
+            subprocess.check_call(['resize2fs', device])
+            if uuid:
+                subprocess.check_call(['tune2fs', '-U', uuid, device])
+        except (EnvironmentError, subprocess.CalledProcessError) as e:
+            error = install_misc.InstallStepError(
+                "Failed to write %s to %s: %s" % (image, device, e))
+        except install_misc.InstallStepError as e:
+            error = e
+        else:
+            error = None
+        if error is not None:
+            # If this fails too, the target is left unmounted so that
+            # nothing is copied onto a half-written image.
+            self.remake_filesystem(device, fstype, uuid)
+
+        if not misc.execute('mount', '-t', fstype, '-o', options,
+                            device, self.target):
+            raise install_misc.InstallStepError(
+                "Failed to mount %s on %s" % (device, self.target))
+        for sub_device, mountpoint, sub_fstype, sub_options in submounts:
+            if not os.path.isdir(mountpoint):
+                os.makedirs(mountpoint)
+            if not misc.execute('mount', '-t', sub_fstype,
+                                '-o', sub_options, sub_device, mountpoint):
+                raise install_misc.InstallStepError(
+                    "Failed to mount %s on %s" % (sub_device, mountpoint))
+
+        # copy_all won't copy these either, so put them back even if the
+        # image couldn't be written.
+        for relpath, contents in preserved.items():
+            osextras.unlink_force(self.target_file(relpath))
+            with open(self.target_file(relpath), 'wb') as fp:
+                fp.write(contents)
+        if error is not None:
+            raise error
+
+        # The image contains everything, so take out what copy_all would
+        # have left behind.
+        for relpath in sorted(self.blacklist, reverse=True):
+            targetpath = self.target_file(relpath[1:])
+            if os.path.lexists(targetpath) and not os.path.isdir(targetpath):
+                osextras.unlink_force(targetpath)
+
+        self.copy_cd_kernel()
 
         self.db.progress('SET', 100)
         self.db.progress('STOP')
 
+    def remake_filesystem(self, device, fstype, uuid):
+        """Replace a half-written image with an empty filesystem.
+
+        This leaves the target as partman made it, near enough, so that
+        files can be copied to it instead.
+        """
+        mkfs = ['mkfs.%s' % fstype, '-F', '-q']
+        if uuid:
+            mkfs.extend(['-U', uuid])
+        if not misc.execute(*(mkfs + [device])):
+            raise install_misc.InstallStepError(
+                "Failed to recreate the filesystem on %s" % device)
+
+    def block_image_failed(self, block_image, error):
+        """Report that streaming an image failed, before copying files.
+
+        Return False if the target isn't in a state to copy files to.
+        """
+        image, _, _, _, submounts = block_image
+        syslog.syslog(syslog.LOG_WARNING,
+                      'Streaming %s failed: %s' % (image, error))
+        self.db.progress('STOP')
+        for mountpoint in [self.target] + [sub[1] for sub in submounts]:
+            if not os.path.ismount(mountpoint):
+                return False
+        self.db.subst('ubiquity/install/block_image_failed', 'ERROR',
+                      str(error))
+        self.db.input('critical', 'ubiquity/install/block_image_failed')
+        self.db.go()
+        return True
+
     def mount_one_image(self, fsfile, mountpoint=None):
         if os.path.splitext(fsfile)[1] == '.cloop':
             blockdev_prefix = 'cloop'
@@ -21,6 +21,7 @@
 
 from __future__ import print_function
 
+import concurrent.futures
 import gzip
 import io
 import os
@@ -36,7 +37,6 @@ import textwrap
 import traceback
 
 import apt_pkg
-from apt.cache import Cache
 import debconf
 
 sys.path.insert(0, '/usr/lib/ubiquity')
@@ -106,6 +106,10 @@ class Install(install_misc.InstallBase):
         modules = plugin_manager.order_plugins(modules)
         self.plugins = [x for x in modules if hasattr(x, 'Install')]
 
+        # Leave dpkg triggers pending until the end of the install?
+        self.defer_triggers = False
+        self.triggers_processed = False
+
         if 'UBIQUITY_OEM_USER_CONFIG' in os.environ:
             self.target = '/'
             return
@@ -141,6 +145,16 @@ class Install(install_misc.InstallBase):
         apt_pkg.config.set("Acquire::cdrom::AutoDetect", "false")
         apt_pkg.config.set("Dir::Media::MountPath", "/cdrom")
 
+        try:
+            self.defer_triggers = misc.create_bool(
+                self.db.get('ubiquity/install/defer-triggers'))
+        except debconf.DebconfError:
+            pass
+        if self.defer_triggers:
+            apt_pkg.config.set("DPkg::NoTriggers", "true")
+            apt_pkg.config.set("DPkg::ConfigurePending", "false")
+            apt_pkg.config.set("DPkg::TriggersPending", "false")
+
         apt_pkg.config.set("DPkg::Options::", "--root=%s" % self.target)
         # We don't want apt-listchanges or dpkg-preconfigure, so just clear
         # out the list of pre-installation hooks.
@@ -154,7 +168,10 @@ class Install(install_misc.InstallBase):
         except debconf.DebconfError:
             pass
         if not use_restricted:
-            self.restricted_cache = Cache()
+            # Remember what came from restricted before apt-setup drops it
+            # from sources.list.
+            self.restricted_packages = install_misc.restricted_packages(
+                self.get_cache())
 
     # TODO can we really pick up where install.py left off?  They're using two
     # separate databases, which means two progress states.  Might need to
@@ -175,24 +192,69 @@ class Install(install_misc.InstallBase):
         self.db.progress(
             'START', self.start, self.end, 'ubiquity/install/title')
 
-        self.configure_python()
-
-        self.next_region()
-        self.db.progress('INFO', 'ubiquity/install/network')
-        self.configure_network()
-
-        self.configure_locale()
-
-        self.next_region()
-        self.db.progress('INFO', 'ubiquity/install/apt')
-        self.configure_apt()
+        Step = install_misc.Step
+        # Steps that might do anything at all to the target.
+        everything = ('debconf', 'apt', 'chroot', '/')
+        steps = [
+            # Byte-compiling doesn't need debconf, so it can get on with it
+            # while the network is configured.
+            Step('python', self.configure_python,
+                 resources=('apt', 'chroot', '/usr')),
+            Step('network', self.configure_network,
+                 resources=('debconf', '/etc'), region=1,
+                 info='ubiquity/install/network'),
+            Step('locale', self.configure_locale, resources=everything),
+            Step('apt', self.configure_apt, resources=everything, region=1,
+                 info='ubiquity/install/apt'),
+            Step('plugins', self.configure_plugins, resources=everything),
+            Step('target-hooks', self.run_target_config_hooks,
+                 resources=everything, region=1),
+            Step('language-packs', self.try_install_language_packs,
+                 resources=everything, region=5),
+            Step('kernels', self.remove_unusable_kernels,
+                 resources=everything, region=1),
+            Step('hardware', self.configure_hardware, resources=everything,
+                 region=4, info='ubiquity/install/hardware'),
+            Step('extras', self.install_extras_step, resources=everything,
+                 region=1, info='ubiquity/install/installing'),
+            Step('bootloader', self.configure_bootloader,
+                 resources=everything, region=1,
+                 info='ubiquity/install/bootloader'),
+            # Removing extras and installing restricted extras don't depend
+            # on each other, so make both sets of changes in one dpkg run.
+            Step('remove-extras', self.change_extras, resources=everything,
+                 region=5, info='ubiquity/install/removing'),
+            Step('apt-clone', self.try_apt_clone_restore,
+                 resources=everything,
+                 info='ubiquity/install/apt_clone_restore'),
+            Step('network-config', self.try_copy_network_config,
+                 resources=('debconf', '/etc/NetworkManager')),
+            Step('bluetooth-config', self.try_copy_bluetooth_config,
+                 resources=('debconf', '/var/lib/bluetooth')),
+            Step('apparmor', self.try_recache_apparmor,
+                 resources=('chroot', '/etc/apparmor.d')),
+            Step('wallpaper', self.try_copy_wallpaper_cache,
+                 resources=('debconf', '/home')),
+            Step('dcd', self.copy_dcd,
+                 resources=('/var/lib/ubuntu_dist_channel',)),
+            Step('random-seed', self.save_random_seed,
+                 resources=('/var/lib/systemd/random-seed',)),
+        ]
+        if self.defer_triggers:
+            steps.append(Step('triggers', self.process_triggers,
+                              resources=everything,
+                              info='ubiquity/install/triggers'))
+        # Copy logs last of all, so that they're as complete as possible.
+        steps.append(Step('logs', self.copy_logs_step, resources=everything,
+                          barrier=True))
+        # Most steps run things in the target, so set it up once for all
+        # of them rather than mounting and unmounting around each one.
+        with install_misc.chroot_session(self.target):
+            install_misc.StepScheduler(self, steps).run()
 
-        self.configure_plugins()
-
-        self.next_region()
-        self.run_target_config_hooks()
+        self.db.progress('SET', self.end)
 
-        self.next_region(size=5)
+    def try_install_language_packs(self):
         # Ignore failures from language pack installation.
         try:
             self.install_language_packs()
@@ -203,45 +265,31 @@ class Install(install_misc.InstallBase):
         except SystemError:
             pass
 
-        self.next_region()
-        self.remove_unusable_kernels()
-
-        self.next_region(size=4)
-        self.db.progress('INFO', 'ubiquity/install/hardware')
-        self.configure_hardware()
-
+    def install_extras_step(self):
         # Tell apt-install to install packages directly from now on.
         with open('/var/lib/ubiquity/apt-install-direct', 'w'):
             pass
 
-        self.next_region()
-        self.db.progress('INFO', 'ubiquity/install/installing')
-
         if 'UBIQUITY_OEM_USER_CONFIG' in os.environ:
             self.install_oem_extras()
         else:
             self.install_extras()
 
-        self.next_region()
-        self.db.progress('INFO', 'ubiquity/install/bootloader')
-        self.configure_bootloader()
-
-        self.next_region(size=4)
-        self.db.progress('INFO', 'ubiquity/install/removing')
+    def change_extras(self):
+        plan = install_misc.InstallPlan()
         if 'UBIQUITY_OEM_USER_CONFIG' in os.environ:
             try:
                 if misc.create_bool(self.db.get('oem-config/remove_extras')):
-                    self.remove_oem_extras()
+                    self.remove_oem_extras(plan)
             except debconf.DebconfError:
                 pass
         else:
-            self.remove_extras()
+            self.remove_extras(plan)
+            self.install_restricted_extras(plan)
+        if plan:
+            self.commit_plan(plan)
 
-        self.next_region()
-        if 'UBIQUITY_OEM_USER_CONFIG' not in os.environ:
-            self.install_restricted_extras()
-
-        self.db.progress('INFO', 'ubiquity/install/apt_clone_restore')
+    def try_apt_clone_restore(self):
         try:
             self.apt_clone_restore()
         except Exception:
@@ -252,6 +300,8 @@ class Install(install_misc.InstallBase):
                 syslog.syslog(syslog.LOG_WARNING, line)
             self.db.input('critical', 'ubiquity/install/broken_apt_clone')
             self.db.go()
+
+    def try_copy_network_config(self):
         try:
             self.copy_network_config()
         except Exception:
@@ -262,6 +312,8 @@ class Install(install_misc.InstallBase):
                 syslog.syslog(syslog.LOG_WARNING, line)
             self.db.input('critical', 'ubiquity/install/broken_network_copy')
             self.db.go()
+
+    def try_copy_bluetooth_config(self):
         try:
             self.copy_bluetooth_config()
         except Exception:
@@ -272,6 +324,8 @@ class Install(install_misc.InstallBase):
                 syslog.syslog(syslog.LOG_WARNING, line)
             self.db.input('critical', 'ubiquity/install/broken_bluetooth_copy')
             self.db.go()
+
+    def try_recache_apparmor(self):
         try:
             self.recache_apparmor()
         except Exception:
@@ -279,6 +333,8 @@ class Install(install_misc.InstallBase):
                 syslog.LOG_WARNING, 'Could not create an Apparmor cache:')
             for line in traceback.format_exc().split('\n'):
                 syslog.syslog(syslog.LOG_WARNING, line)
+
+    def try_copy_wallpaper_cache(self):
         try:
             self.copy_wallpaper_cache()
         except Exception:
@@ -286,31 +342,19 @@ class Install(install_misc.InstallBase):
                 syslog.LOG_WARNING, 'Could not copy wallpaper cache:')
             for line in traceback.format_exc().split('\n'):
                 syslog.syslog(syslog.LOG_WARNING, line)
-        self.copy_dcd()
 
+    def copy_logs_step(self):
         self.db.progress('SET', self.count)
         self.db.progress('INFO', 'ubiquity/install/log_files')
         self.copy_logs()
-        self.save_random_seed()
-
-        self.db.progress('SET', self.end)
 
     def _get_uid_gid_on_target(self, target_user):
         """Helper that gets the uid/gid of the username in the target chroot"""
-        uid = subprocess.Popen(
-            ['chroot', self.target, 'sudo', '-u', target_user, '--',
-             'id', '-u'], stdout=subprocess.PIPE, universal_newlines=True)
-        uid = uid.communicate()[0].strip('\n')
-        gid = subprocess.Popen(
-            ['chroot', self.target, 'sudo', '-u', target_user, '--',
-             'id', '-g'], stdout=subprocess.PIPE, universal_newlines=True)
-        gid = gid.communicate()[0].strip('\n')
         try:
-            uid = int(uid)
-            gid = int(gid)
-        except ValueError:
+            entry = install_misc.target_getpwnam(self.target, target_user)
+        except (KeyError, OSError):
             return (None, None)
-        return uid, gid
+        return entry.pw_uid, entry.pw_gid
 
     def configure_python(self):
         """Byte-compile Python modules.
@@ -319,39 +363,42 @@ class Install(install_misc.InstallBase):
         Recreate them now to restore the appearance of a system installed
         from .debs.
         """
-        cache = Cache()
-
-        # Python standard library.
-        re_minimal = re.compile('^python\d+\.\d+-minimal$')
-        python_installed = sorted([
-            pkg[:-8] for pkg in cache.keys()
-            if re_minimal.match(pkg) and cache[pkg].is_installed])
-        for python in python_installed:
-            re_file = re.compile('^/usr/lib/%s/.*\.py$' % python)
-            files = [
-                f for f in cache['%s-minimal' % python].installed_files
-                if (re_file.match(f) and
-                    not os.path.exists(self.target_file('%sc' % f[1:])))]
-            install_misc.chrex(self.target, python,
-                               '/usr/lib/%s/py_compile.py' % python, *files)
-            files = [
-                f for f in cache[python].installed_files
-                if (re_file.match(f) and
-                    not os.path.exists(self.target_file('%sc' % f[1:])))]
-            install_misc.chrex(self.target, python,
-                               '/usr/lib/%s/py_compile.py' % python, *files)
-
-        # Modules provided by the core Debian Python packages.
-        default = subprocess.Popen(
-            ['chroot', self.target, 'pyversions', '-d'],
-            stdout=subprocess.PIPE,
-            universal_newlines=True).communicate()[0].rstrip('\n')
-        if default:
-            install_misc.chrex(self.target, default, '-m', 'compileall',
-                               '/usr/share/python/')
-        if osextras.find_on_path_root(self.target, 'py3compile'):
-            install_misc.chrex(self.target, 'py3compile', '-p', 'python3',
-                               '/usr/share/python3/')
+        cache = self.get_cache()
+        workers = os.cpu_count() or 1
+
+        # Compiling doesn't run any package code, so the standard library
+        # (split into a batch per CPU) and the core Debian modules can be
+        # compiled side by side.  The copy may already have compiled some
+        # Pythons' standard libraries.
+        with concurrent.futures.ThreadPoolExecutor(
+                max_workers=workers) as executor:
+            jobs = []
+
+            index = install_misc.DpkgPathIndex(
+                self.target_file('var/lib/dpkg/info'))
+            for python, batch in self.python_stdlib_batches(
+                    index, workers,
+                    done=install_misc.python_stdlib_compiled()):
+                jobs.append(executor.submit(
+                    install_misc.py_compile, self.target, python, batch))
+
+            # Modules provided by the core Debian Python packages.
+            default = subprocess.Popen(
+                ['chroot', self.target, 'pyversions', '-d'],
+                stdout=subprocess.PIPE,
+                universal_newlines=True).communicate()[0].rstrip('\n')
+            if default:
+                jobs.append(executor.submit(
+                    install_misc.chrex, self.target, default, '-m',
+                    'compileall', '/usr/share/python/'))
+            if osextras.find_on_path_root(self.target, 'py3compile'):
+                jobs.append(executor.submit(
+                    install_misc.chrex, self.target, 'py3compile',
+                    '-j', str(workers), '-p', 'python3',
+                    '/usr/share/python3/'))
+
+            for job in jobs:
+                job.result()
 
         def run_hooks(path, *args):
             for hook in osextras.glob_root(self.target, path):
@@ -359,7 +406,9 @@ class Install(install_misc.InstallBase):
                     continue
                 install_misc.chrex(self.target, hook, *args)
 
-        # Public and private modules provided by other packages.
+        # Public and private modules provided by other packages.  Nothing
+        # promises that these hooks can run alongside each other, so run
+        # them one at a time, in order.
         install_misc.chroot_setup(self.target)
         try:
             if osextras.find_on_path_root(self.target, 'pyversions'):
@@ -559,6 +608,11 @@ class Install(install_misc.InstallBase):
                 os.mkdir(target_cdrom)
             misc.execute('mount', '--bind', '/cdrom', target_cdrom)
 
+        # Leave triggers for process_triggers to run all at once.
+        # This file will be left in place until the end of the install.
+        if self.defer_triggers:
+            self.write_defer_triggers()
+
         # Make apt-cdrom and apt not unmount/mount CD-ROMs.
         # This file will be left in place until the end of the install.
         tf = self.target_file('etc/apt/apt.conf.d/00NoMountCDROM')
@@ -633,7 +687,7 @@ class Install(install_misc.InstallBase):
         if self.db.get('pkgsel/ignore-incomplete-language-support') == 'true':
             return
 
-        cache = Cache()
+        cache = self.get_cache()
         incomplete = False
         for pkg in self.langpacks:
             if pkg.startswith('gimp-help-'):
@@ -711,7 +765,7 @@ class Install(install_misc.InstallBase):
                         new_kernel_version = kernel[12:]
                     elif kernel.startswith('linux-generic-'):
                         # Traverse dependencies to find the real kernel image.
-                        cache = Cache()
+                        cache = self.get_cache()
                         kernel = self.traverse_for_kernel(cache, kernel)
                         if kernel:
                             new_kernel_pkg = kernel
@@ -737,7 +791,7 @@ class Install(install_misc.InstallBase):
             self.do_install(install_kernels)
             install_misc.record_installed(install_kernels)
             if new_kernel_pkg:
-                cache = Cache()
+                cache = self.get_cache()
                 cached_pkg = install_misc.get_cache_pkg(cache, new_kernel_pkg)
                 if cached_pkg is not None and cached_pkg.is_installed:
                     self.kernel_version = new_kernel_version
@@ -1012,71 +1066,9 @@ class Install(install_misc.InstallBase):
                 misc.execute('umount', '-f', self.target + bind)
 
     def do_remove(self, to_remove, recursive=False):
-        self.nested_progress_start()
-
-        self.db.progress('START', 0, 5, 'ubiquity/install/title')
-        self.db.progress('INFO', 'ubiquity/install/find_removables')
-
-        fetchprogress = install_misc.DebconfAcquireProgress(
-            self.db, 'ubiquity/install/title',
-            'ubiquity/install/apt_indices_starting',
-            'ubiquity/install/apt_indices')
-        cache = Cache()
-
-        if cache._depcache.broken_count > 0:
-            syslog.syslog(
-                'not processing removals, since there are broken packages: '
-                '%s' % ', '.join(install_misc.broken_packages(cache)))
-            self.db.progress('STOP')
-            self.nested_progress_end()
-            return
-
-        with cache.actiongroup():
-            install_misc.get_remove_list(cache, to_remove, recursive)
-
-        self.db.progress('SET', 1)
-        self.progress_region(1, 5)
-        fetchprogress = install_misc.DebconfAcquireProgress(
-            self.db, 'ubiquity/install/title', None,
-            'ubiquity/install/fetch_remove')
-        installprogress = install_misc.DebconfInstallProgress(
-            self.db, 'ubiquity/install/title', 'ubiquity/install/apt_info',
-            'ubiquity/install/apt_error_remove')
-        install_misc.chroot_setup(self.target)
-        commit_error = None
-        try:
-            try:
-                if not cache.commit(fetchprogress, installprogress):
-                    fetchprogress.stop()
-                    installprogress.finish_update()
-                    self.db.progress('STOP')
-                    self.nested_progress_end()
-                    return
-            except SystemError as e:
-                for line in traceback.format_exc().split('\n'):
-                    syslog.syslog(syslog.LOG_ERR, line)
-                commit_error = str(e)
-        finally:
-            install_misc.chroot_cleanup(self.target)
-        self.db.progress('SET', 5)
-
-        cache.open(None)
-        if commit_error or cache._depcache.broken_count > 0:
-            if commit_error is None:
-                commit_error = ''
-            brokenpkgs = install_misc.broken_packages(cache)
-            syslog.syslog('broken packages after removal: '
-                          '%s' % ', '.join(brokenpkgs))
-            self.db.subst('ubiquity/install/broken_remove', 'ERROR',
-                          commit_error)
-            self.db.subst('ubiquity/install/broken_remove', 'PACKAGES',
-                          ', '.join(brokenpkgs))
-            self.db.input('critical', 'ubiquity/install/broken_remove')
-            self.db.go()
-
-        self.db.progress('STOP')
-
-        self.nested_progress_end()
+        plan = install_misc.InstallPlan()
+        plan.remove(to_remove, recursive=recursive)
+        self.commit_plan(plan)
 
     def install_oem_extras(self):
         """Try to install additional packages requested by the distributor."""
@@ -1142,13 +1134,30 @@ class Install(install_misc.InstallBase):
             # because we don't have any way of discerning between questions
             # asked by this module and questions asked by packages being
             # installed.
+            pool = self.package_pool()
+            if pool is not None:
+                # Work out what apt-get is going to fetch, so that anything
+                # we've seen before can come from the pool instead.
+                cache = self.get_cache()
+                try:
+                    with cache.actiongroup():
+                        for pkg in extra_packages:
+                            install_misc.mark_install(cache, pkg)
+                    planned = install_misc.planned_archives(cache)
+                except install_misc.InstallStepError:
+                    planned = {}
+                del cache
+                archive_dir = apt_pkg.config.find_dir('Dir::Cache::Archives')
+                pool.fill_archives(planned, archive_dir)
             cmd = ['debconf-apt-progress', '--', 'apt-get', '-y', 'install']
             cmd += extra_packages
             try:
                 subprocess.check_call(cmd)
+                if pool is not None:
+                    pool.add_archives(planned, archive_dir)
             except subprocess.CalledProcessError as e:
                 if e.returncode != 30:
-                    cache = Cache()
+                    cache = self.get_cache()
                     brokenpkgs = install_misc.broken_packages(cache)
                     self.warn_broken_packages(brokenpkgs, str(e))
         finally:
@@ -1165,11 +1174,12 @@ class Install(install_misc.InstallBase):
         if inst_langpacks:
             self.verify_language_packs()
 
-    def install_restricted_extras(self):
+    def install_restricted_extras(self, plan):
+        """Add restricted extras requested by the user to plan."""
         if self.db.get('ubiquity/use_nonfree') == 'true':
             self.db.progress('INFO', 'ubiquity/install/nonfree')
             packages = self.db.get('ubiquity/nonfree_package').split()
-            self.do_install(packages)
+            plan.install(packages)
 
     def install_extras(self):
         """Try to install packages requested by installer components."""
@@ -1243,8 +1253,8 @@ class Install(install_misc.InstallBase):
         except debconf.DebconfError:
             pass
 
-    def remove_oem_extras(self):
-        """Remove unnecessary packages in OEM mode.
+    def remove_oem_extras(self, plan):
+        """Add unnecessary packages in OEM mode to plan for removal.
 
         Try to remove packages that were not part of the base install and
         are not needed by the final system.
@@ -1266,21 +1276,16 @@ class Install(install_misc.InstallBase):
         keep.add('ubiquity')
         keep.add('oem-config')
 
-        cache = Cache()
-        # TODO cjwatson 2012-05-04: It would be nice to use a set
-        # comprehension here, but that causes:
-        #   SyntaxError: can not delete variable 'cache' referenced in nested
-        #   scope
-        remove = set([pkg for pkg in cache.keys() if cache[pkg].is_installed])
+        graph = install_misc.DependencyGraph(self.get_cache())
+        remove = set(graph.installed)
         # Keep packages we explicitly installed.
         keep |= install_misc.query_recorded_installed()
-        remove -= install_misc.expand_dependencies_simple(cache, keep, remove)
-        del cache
+        remove -= graph.keep_closure(keep, remove)
 
         install_misc.record_removed(remove)
         (regular, recursive) = install_misc.query_recorded_removed()
-        self.do_remove(regular)
-        self.do_remove(recursive, recursive=True)
+        plan.remove(regular)
+        plan.remove(recursive, recursive=True)
 
     def copy_tree(self, source, target, uid, gid):
         # Mostly stolen from copy_all.
@@ -1347,8 +1352,8 @@ class Install(install_misc.InstallBase):
                 # about this failing, but I really don't care. Ignore it.
                 pass
 
-    def remove_extras(self):
-        """Remove unnecessary packages.
+    def remove_extras(self, plan):
+        """Add unnecessary packages to plan for removal.
 
         Try to remove packages that are needed on the live CD but not on the
         installed system.
@@ -1408,10 +1413,8 @@ class Install(install_misc.InstallBase):
                 if pkg not in keep:
                     difference.add(pkg)
 
-        cache = Cache()
-        difference -= install_misc.expand_dependencies_simple(
-            cache, keep, difference)
-        del cache
+        graph = install_misc.DependencyGraph(self.get_cache())
+        difference -= graph.keep_closure(keep, difference)
 
         if len(difference) == 0:
             return
@@ -1423,12 +1426,7 @@ class Install(install_misc.InstallBase):
         except debconf.DebconfError:
             pass
         if not use_restricted:
-            cache = self.restricted_cache
-            for pkg in cache.keys():
-                if (cache[pkg].is_installed and
-                        cache[pkg].section.startswith('restricted/')):
-                    difference.add(pkg)
-            del cache
+            difference |= self.restricted_packages
 
         install_misc.record_removed(difference)
 
@@ -1437,8 +1435,8 @@ class Install(install_misc.InstallBase):
         # whatever) after installation than it will be to try to deal with
         # them automatically here.
         (regular, recursive) = install_misc.query_recorded_removed()
-        self.do_remove(regular)
-        self.do_remove(recursive, recursive=True)
+        plan.remove(regular)
+        plan.remove(recursive, recursive=True)
 
         oem_remove_extras = False
         try:
@@ -1537,16 +1535,12 @@ class Install(install_misc.InstallBase):
             syslog.syslog(
                 'Apparmor is not installed, so not generating cache.')
             return
-        install_misc.chrex(self.target, 'mount', '-t', 'proc', 'proc', '/proc')
-        install_misc.chrex(
-            self.target, 'mount', '-t', 'sysfs', 'sysfs', '/sys')
-        install_misc.chrex(
-            self.target, 'mount', '-t', 'securityfs',
-            'securityfs', '/sys/kernel/security')
-        install_misc.chrex(self.target, '/etc/init.d/apparmor', 'recache')
-        install_misc.chrex(self.target, 'umount', '/proc')
-        install_misc.chrex(self.target, 'umount', '/sys/kernel/security')
-        install_misc.chrex(self.target, 'umount', '/sys')
+        with install_misc.chroot_session(self.target):
+            install_misc.chrex(
+                self.target, 'mount', '-t', 'securityfs',
+                'securityfs', '/sys/kernel/security')
+            install_misc.chrex(self.target, '/etc/init.d/apparmor', 'recache')
+            install_misc.chrex(self.target, 'umount', '/sys/kernel/security')
 
     def copy_wallpaper_cache(self):
         """Copy GNOME wallpaper cache for the benefit of ureadahead.
@@ -1576,18 +1570,11 @@ class Install(install_misc.InstallBase):
                 os.path.isdir(casper_user_wallpaper_cache_dir)):
 
             # copy to targeted user
-            uid = subprocess.Popen(
-                ['chroot', self.target, 'sudo', '-u', target_user, '--',
-                 'id', '-u'],
-                stdout=subprocess.PIPE,
-                universal_newlines=True).communicate()[0].strip('\n')
-            gid = subprocess.Popen(
-                ['chroot', self.target, 'sudo', '-u', target_user, '--',
-                 'id', '-g'],
-                stdout=subprocess.PIPE,
-                universal_newlines=True).communicate()[0].strip('\n')
-            uid = int(uid)
-            gid = int(gid)
+            uid, gid = self._get_uid_gid_on_target(target_user)
+            if uid is None:
+                syslog.syslog(syslog.LOG_WARNING,
+                              'No user %s on the target' % target_user)
+                return
             self.copy_tree(casper_user_wallpaper_cache_dir,
                            target_user_wallpaper_cache_dir, uid, gid)
             os.chmod(target_user_cache_dir, 0o700)
@@ -1610,7 +1597,8 @@ class Install(install_misc.InstallBase):
 
         for log_file in ('/var/log/syslog', '/var/log/partman',
                          '/var/log/installer/version', '/var/log/casper.log',
-                         '/var/log/installer/debug'):
+                         '/var/log/installer/debug',
+                         '/var/log/installer/copy-stats.json'):
             target_log_file = os.path.join(target_dir,
                                            os.path.basename(log_file))
             if os.path.isfile(log_file):
@@ -1685,19 +1673,56 @@ class Install(install_misc.InstallBase):
         except IOError:
             pass
 
-        old_umask = os.umask(0o077)
+        # This may run alongside other steps, so set the mode directly
+        # rather than changing the process-wide umask.
         try:
             with open("/dev/urandom", "rb") as urandom:
-                with open(self.target_file("var/lib/systemd/random-seed"),
-                          "wb") as seed:
+                fd = os.open(self.target_file("var/lib/systemd/random-seed"),
+                             os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+                with os.fdopen(fd, "wb") as seed:
                     seed.write(urandom.read(poolbytes))
         except IOError:
             pass
+
+    def write_defer_triggers(self):
+        """Stop apt from running dpkg triggers until process_triggers."""
+        tf = self.target_file('etc/apt/apt.conf.d/00DeferTriggers')
+        with open(tf, 'w') as apt_conf_dt:
+            print(textwrap.dedent("""\
+                DPkg::NoTriggers "true";
+                DPkg::ConfigurePending "false";
+                DPkg::TriggersPending "false";"""), file=apt_conf_dt)
+
+    def process_triggers(self):
+        """Run any dpkg triggers left pending by defer_triggers.
+
+        Packages are installed and removed with their triggers deferred so
+        that expensive ones, like regenerating the initramfs, run once
+        rather than after every commit.
+        """
+        if not self.defer_triggers or self.triggers_processed:
+            return
+        self.triggers_processed = True
+        try:
+            install_misc.chroot_setup(self.target)
+            try:
+                if not install_misc.chrex(
+                        self.target, 'dpkg', '--triggers-only', '--pending'):
+                    syslog.syslog(syslog.LOG_WARNING,
+                                  'Processing deferred triggers failed')
+            finally:
+                install_misc.chroot_cleanup(self.target)
         finally:
-            os.umask(old_umask)
+            # Never leave triggers disabled in the installed system.
+            osextras.unlink_force(
+                self.target_file('etc/apt/apt.conf.d/00DeferTriggers'))
 
     def cleanup(self):
         """Miscellaneous cleanup tasks."""
+        # If the install failed part way through, still leave the target
+        # with its triggers run.
+        self.process_triggers()
+
         misc.execute('umount', self.target_file('cdrom'))
 
         env = dict(os.environ)
@@ -1706,7 +1731,7 @@ class Install(install_misc.InstallBase):
                         env=env)
 
         for apt_conf in ('00NoMountCDROM', '00IgnoreTimeConflict',
-                         '00AllowUnauthenticated'):
+                         '00AllowUnauthenticated', '00DeferTriggers'):
             osextras.unlink_force(
                 self.target_file('etc/apt/apt.conf.d', apt_conf))
 
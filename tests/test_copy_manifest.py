@@ -0,0 +1,104 @@
+#! /usr/bin/python3
+
+import hashlib
+import os
+import shutil
+import stat
+import tempfile
+import unittest
+
+from ubiquity import copy_manifest
+
+
+class CopyManifestTests(unittest.TestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.temp_dir)
+        self.root = os.path.join(self.temp_dir, "root")
+        os.makedirs(os.path.join(self.root, "dir", "subdir"))
+        with open(os.path.join(self.root, "dir", "file"), "wb") as f:
+            f.write(b"data")
+        os.symlink("subdir", os.path.join(self.root, "dir", "link"))
+        self.manifest_path = os.path.join(self.temp_dir, "manifest")
+
+    def test_round_trip(self):
+        copy_manifest.write_manifest(self.root, self.manifest_path)
+        manifest = copy_manifest.CopyManifest(self.manifest_path)
+        entries = {entry.path: entry for entry in manifest.entries()}
+        self.assertEqual(
+            {"dir", "dir/subdir", "dir/file", "dir/link"}, set(entries))
+        self.assertEqual(len(entries), manifest.count)
+        for path, entry in entries.items():
+            st = os.lstat(os.path.join(self.root, path))
+            self.assertEqual(st.st_mode, entry.st_mode)
+            self.assertEqual(st.st_size, entry.st_size)
+            self.assertEqual(st.st_mtime, entry.st_mtime)
+        self.assertEqual(
+            sum(entry.st_size for entry in entries.values()),
+            manifest.total_size)
+        self.assertTrue(stat.S_ISLNK(entries["dir/link"].st_mode))
+        self.assertEqual("subdir", entries["dir/link"].linktarget)
+        self.assertIsNone(entries["dir/file"].linktarget)
+        self.assertIsNone(entries["dir/file"].hash)
+
+    def test_directories_come_first(self):
+        copy_manifest.write_manifest(self.root, self.manifest_path)
+        manifest = copy_manifest.CopyManifest(self.manifest_path)
+        seen = set()
+        for entry in manifest.entries():
+            parent = os.path.dirname(entry.path)
+            if parent:
+                self.assertIn(parent, seen)
+            seen.add(entry.path)
+
+    def test_hashes(self):
+        copy_manifest.write_manifest(
+            self.root, self.manifest_path, hash_name="md5")
+        manifest = copy_manifest.CopyManifest(self.manifest_path)
+        self.assertEqual("md5", manifest.hash_name)
+        entries = {entry.path: entry for entry in manifest.entries("md5")}
+        self.assertEqual(
+            hashlib.md5(b"data").digest(), entries["dir/file"].hash)
+        self.assertIsNone(entries["dir/subdir"].hash)
+        # Hashes made with a different function are useless to the caller.
+        entries = {entry.path: entry
+                   for entry in manifest.entries("blake2b")}
+        self.assertIsNone(entries["dir/file"].hash)
+
+    def test_positions(self):
+        copy_manifest.write_manifest(
+            self.root, self.manifest_path, positions_from=self.root)
+        manifest = copy_manifest.CopyManifest(self.manifest_path)
+        entries = {entry.path: entry for entry in manifest.entries()}
+        self.assertNotEqual(0, entries["dir/file"].position)
+        self.assertEqual(0, entries["dir/subdir"].position)
+        self.assertEqual(0, entries["dir/link"].position)
+
+    def test_stale_image(self):
+        image = os.path.join(self.temp_dir, "image")
+        with open(image, "wb") as f:
+            f.write(b"image")
+        copy_manifest.write_manifest(
+            self.root, self.manifest_path, image=image)
+        copy_manifest.CopyManifest(self.manifest_path, image=image)
+        with open(image, "ab") as f:
+            f.write(b"remastered")
+        self.assertRaises(
+            copy_manifest.ManifestError,
+            copy_manifest.CopyManifest, self.manifest_path, image=image)
+
+    def test_not_a_manifest(self):
+        with open(self.manifest_path, "wb") as f:
+            f.write(b"\0" * 64)
+        self.assertRaises(
+            copy_manifest.ManifestError,
+            copy_manifest.CopyManifest, self.manifest_path)
+
+    def test_truncated(self):
+        copy_manifest.write_manifest(self.root, self.manifest_path)
+        size = os.path.getsize(self.manifest_path)
+        with open(self.manifest_path, "r+b") as f:
+            f.truncate(size - 1)
+        manifest = copy_manifest.CopyManifest(self.manifest_path)
+        self.assertRaises(
+            copy_manifest.ManifestError, list, manifest.entries())
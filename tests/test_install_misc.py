@@ -1,10 +1,19 @@
 #! /usr/bin/python3
 
+import errno
+import hashlib
+import json
 import os
 import shutil
+import stat
+import subprocess
+import sys
 import tempfile
+import threading
 import unittest
 
+import mock
+
 from ubiquity import install_misc
 
 
@@ -108,3 +117,965 @@ class InstallMiscTests(unittest.TestCase):
             self.target_path("source-file-target-non-empty-dir.bak")))
         self.assertTrue(os.path.isfile(
             self.target_path("source-file-target-non-empty-dir.bak/file")))
+
+    def test_parallel_copier_returns_results(self):
+        copier = install_misc.ParallelCopier(lambda x: x * 2, 2)
+        self.addCleanup(copier.shutdown)
+        results = []
+        for i in range(20):
+            results.extend(copier.submit(i))
+        results.extend(copier.finish())
+        self.assertEqual(sorted(results), [((i,), i * 2) for i in range(20)])
+
+    def test_parallel_copier_reraises_worker_errors(self):
+        def fail(path):
+            raise OSError(errno.EIO, 'I/O error', path)
+
+        copier = install_misc.ParallelCopier(fail, 2)
+        self.addCleanup(copier.shutdown)
+        copier.submit('/cdrom/broken')
+        with self.assertRaises(OSError) as cm:
+            copier.finish()
+        self.assertEqual('/cdrom/broken', cm.exception.filename)
+
+    def write_source(self, relpath, data):
+        with open(self.source_path(relpath), 'wb') as f:
+            f.write(data)
+
+    def read_target(self, relpath):
+        with open(self.target_path(relpath), 'rb') as f:
+            return f.read()
+
+    def test_copy_file_data(self):
+        data = os.urandom(3 * install_misc.COPY_BUFFER_SIZE + 17)
+        self.write_source("file", data)
+        self.assertTrue(install_misc.copy_file_data(
+            self.source_path("file"), self.target_path("file"), True))
+        self.assertEqual(data, self.read_target("file"))
+
+    def test_copy_file_data_falls_back_to_buffered_copy(self):
+        def unsupported(*args):
+            raise OSError(errno.EINVAL, 'Invalid argument')
+
+        data = os.urandom(install_misc.COPY_BUFFER_SIZE + 17)
+        self.write_source("file", data)
+        with mock.patch('os.sendfile', unsupported, create=True):
+            with mock.patch('os.copy_file_range', unsupported, create=True):
+                self.assertTrue(install_misc.copy_file_data(
+                    self.source_path("file"), self.target_path("file"),
+                    True))
+        self.assertEqual(data, self.read_target("file"))
+
+    def test_files_match_detects_mismatch(self):
+        self.write_source("file", b"source")
+        with open(self.target_path("file"), "wb") as f:
+            f.write(b"target")
+        self.assertFalse(install_misc.files_match(
+            self.source_path("file"), self.target_path("file")))
+
+    def test_file_verifier_write_mode_checks_expected_hash(self):
+        data = os.urandom(install_misc.COPY_BUFFER_SIZE + 17)
+        self.write_source("file", data)
+        verifier = install_misc.FileVerifier('write', 'md5')
+        good = install_misc.hash_file(self.source_path("file"))
+        self.assertTrue(verifier.copy(
+            self.source_path("file"), self.target_path("file"), good))
+        self.assertFalse(verifier.copy(
+            self.source_path("file"), self.target_path("file"), b"bad"))
+        self.assertEqual(data, self.read_target("file"))
+
+    def test_file_verifier_write_mode_reads_back_without_hash(self):
+        self.write_source("file", b"data")
+        verifier = install_misc.FileVerifier('write', 'md5')
+        with mock.patch('ubiquity.install_misc.copy_fd',
+                        wraps=install_misc.copy_fd) as mock_copy_fd:
+            self.assertTrue(verifier.copy(
+                self.source_path("file"), self.target_path("file")))
+        self.assertTrue(mock_copy_fd.called)
+        self.assertEqual(b"data", self.read_target("file"))
+        self.assertTrue(verifier.reads_back())
+        self.assertFalse(verifier.reads_back(b"digest"))
+        with open(self.target_path("file"), "wb") as f:
+            f.write(b"corrupt")
+        self.assertFalse(verifier.check(
+            self.source_path("file"), self.target_path("file")))
+        self.assertTrue(verifier.check(
+            self.source_path("file"), self.target_path("file"),
+            expected=b"digest"))
+
+    def test_copy_file_retries_against_expected_hash(self):
+        self.write_source("file", b"data")
+        verifier = install_misc.FileVerifier('write', 'md5')
+        db = mock.Mock()
+        db.get.return_value = 'skip'
+        self.assertFalse(install_misc.copy_file(
+            db, self.source_path("file"), self.target_path("file"), True,
+            verifier=verifier, expected=b"bad"))
+        db.input.assert_called_once_with(
+            'critical', 'ubiquity/install/copying_error/md5')
+        good = install_misc.hash_file(self.source_path("file"))
+        self.assertTrue(install_misc.copy_file(
+            db, self.source_path("file"), self.target_path("file"), True,
+            verifier=verifier, expected=good))
+
+    def test_background_verifier_reports_mismatches(self):
+        self.write_source("good", b"good")
+        self.write_source("bad", b"bad")
+        verifier = install_misc.FileVerifier('readback', 'blake2b')
+        verifier.copy(self.source_path("good"), self.target_path("good"))
+        with open(self.target_path("bad"), "wb") as f:
+            f.write(b"corrupt")
+        background = install_misc.BackgroundVerifier(verifier)
+        self.addCleanup(background.shutdown)
+        results = background.submit(
+            self.source_path("good"), self.target_path("good"))
+        results.extend(background.submit(
+            self.source_path("bad"), self.target_path("bad")))
+        results.extend(background.finish())
+        self.assertEqual(
+            {self.target_path("good"): True, self.target_path("bad"): False},
+            {args[1]: ok for args, ok in results})
+
+    @mock.patch('os.fdatasync')
+    @mock.patch('ubiquity.osextras.syncfs')
+    def test_background_verifier_flushes_per_batch(self, mock_syncfs,
+                                                   mock_fdatasync):
+        verifier = install_misc.FileVerifier('readback')
+        background = install_misc.BackgroundVerifier(verifier)
+        self.addCleanup(background.shutdown)
+        results = []
+        for name in ("a", "b", "c"):
+            self.write_source(name, name.encode())
+            verifier.copy(self.source_path(name), self.target_path(name))
+            results.extend(background.submit(
+                self.source_path(name), self.target_path(name)))
+        results.extend(background.finish())
+        self.assertEqual([True] * 3, [ok for _, ok in results])
+        self.assertFalse(mock_fdatasync.called)
+        self.assertTrue(1 <= mock_syncfs.call_count <= 3)
+
+    def test_file_verifier_defaults_to_write(self):
+        self.assertEqual('write', install_misc.FileVerifier().mode)
+        db = mock.Mock()
+        db.get.side_effect = lambda question: {
+            'ubiquity/install/verify-mode': '',
+            'ubiquity/install/verify-hash': ''}.get(question, 'true')
+        self.assertEqual(
+            'write', install_misc.FileVerifier.from_debconf(db).mode)
+
+    def test_image_data_extents_skips_holes(self):
+        path = self.source_path("image")
+        with open(path, "wb") as f:
+            f.write(b"a" * 10)
+            f.seek(1024 * 1024)
+            f.write(b"b" * 10)
+            f.truncate(4 * 1024 * 1024)
+        fd = os.open(path, os.O_RDONLY)
+        self.addCleanup(os.close, fd)
+        extents = install_misc.image_data_extents(fd, 4 * 1024 * 1024)
+        data = sum(length for _, length in extents)
+        self.assertEqual(0, extents[0][0])
+        for offset, length in extents:
+            self.assertEqual(0, offset % install_misc.IMAGE_ALIGNMENT)
+        # Filesystems without hole support report everything as data.
+        self.assertIn(data, (2 * install_misc.IMAGE_ALIGNMENT,
+                             4 * 1024 * 1024))
+
+    def test_stream_image(self):
+        image = self.source_path("image")
+        with open(image, "wb") as f:
+            f.write(b"a" * 10)
+            f.seek(1024 * 1024)
+            f.write(b"b" * 10)
+        device = self.target_path("device")
+        with open(device, "wb") as f:
+            f.write(b"x" * 2 * 1024 * 1024)
+        sizes = []
+        install_misc.stream_image(image, device, sizes.append)
+        with open(device, "rb") as f:
+            contents = f.read()
+        self.assertEqual(b"a" * 10, contents[:10])
+        self.assertEqual(b"b" * 10, contents[1024 * 1024:1024 * 1024 + 10])
+        # The hole reads back as zeroes, not as what was there before.
+        self.assertEqual(b"\0" * (1024 * 1024 - 4096),
+                         contents[4096:1024 * 1024])
+        self.assertEqual(2 * 1024 * 1024, len(contents))
+        self.assertLessEqual(sum(sizes), os.path.getsize(image))
+
+    def test_stream_image_zeroes_trailing_hole(self):
+        image = self.source_path("image")
+        with open(image, "wb") as f:
+            f.write(b"a" * 4096)
+            f.truncate(64 * 1024)
+        device = self.target_path("device")
+        with open(device, "wb") as f:
+            f.write(b"x" * 128 * 1024)
+        install_misc.stream_image(image, device)
+        with open(device, "rb") as f:
+            contents = f.read()
+        self.assertEqual(b"a" * 4096, contents[:4096])
+        self.assertEqual(b"\0" * (60 * 1024), contents[4096:64 * 1024])
+        self.assertEqual(b"x" * (64 * 1024), contents[64 * 1024:])
+
+    def test_read_orderer_sorts_by_position(self):
+        orderer = install_misc.ReadOrderer(window=3)
+        entries = [mock.Mock(position=position) for position in (30, 10, 20)]
+        self.assertEqual([], orderer.add("a", "ta", entries[0]))
+        self.assertEqual([], orderer.add("b", "tb", entries[1]))
+        self.assertEqual(
+            ["b", "c", "a"],
+            [args[0] for args in orderer.add("c", "tc", entries[2])])
+        self.assertEqual([], orderer.flush())
+
+    def test_copy_small_file(self):
+        self.write_source("file", b"small")
+        os.chmod(self.source_path("file"), 0o751)
+        os.utime(self.source_path("file"), (1000, 2000))
+        st = os.lstat(self.source_path("file"))
+        verifier = install_misc.FileVerifier('write')
+        self.assertTrue(install_misc.copy_small_file(
+            self.source_path("file"), self.target_path("file"), st,
+            verifier))
+        self.assertEqual(b"small", self.read_target("file"))
+        st_target = os.lstat(self.target_path("file"))
+        self.assertEqual(0o751, stat.S_IMODE(st_target.st_mode))
+        self.assertEqual(2000, st_target.st_mtime)
+        self.assertFalse(install_misc.copy_small_file(
+            self.source_path("file"), self.target_path("file"), st,
+            verifier, b"bad"))
+
+    def test_copy_journal_resumes(self):
+        self.write_source("done", b"done")
+        self.write_source("todo", b"todo")
+        journal_path = os.path.join(self.source, "journal")
+        st_done = os.lstat(self.source_path("done"))
+        st_todo = os.lstat(self.source_path("todo"))
+        journal = install_misc.CopyJournal(
+            journal_path, self.source, self.target)
+        shutil.copy(self.source_path("done"), self.target_path("done"))
+        journal.record("done", st_done)
+        journal.close()
+
+        journal = install_misc.CopyJournal(
+            journal_path, self.source, self.target)
+        self.assertTrue(
+            journal.is_done("done", st_done, self.target_path("done")))
+        self.assertFalse(
+            journal.is_done("todo", st_todo, self.target_path("todo")))
+        journal.remove()
+        self.assertFalse(os.path.exists(journal_path))
+
+    def test_copy_journal_ignores_other_copies(self):
+        journal_path = os.path.join(self.source, "journal")
+        with open(journal_path, "w") as f:
+            f.write('{"source": [0, 0], "target": [0, 0]}\n')
+            f.write('{"path": "done", "size": 4, "mtime": 0, "hash": null}\n')
+        journal = install_misc.CopyJournal(
+            journal_path, self.source, self.target)
+        self.assertEqual({}, journal.done)
+
+    def test_copy_stats(self):
+        self.write_source("file", b"data")
+        st = os.lstat(self.source_path("file"))
+        stats = install_misc.CopyStats()
+        verifier = install_misc.FileVerifier('write')
+        verifier.stats = stats
+        install_misc.copy_small_file(
+            self.source_path("file"), self.target_path("file"), st,
+            verifier)
+        stats.add_directory_time("/slow", 2.0)
+        stats.add_directory_time("/fast", 1.0)
+        stats.add(st)
+        stats.add(os.lstat(self.source))
+        report_path = os.path.join(self.target, "log", "copy-stats.json")
+        stats.write(report_path)
+        with open(report_path) as f:
+            report = json.load(f)
+        self.assertEqual(2, report["entries"])
+        self.assertEqual(1, report["files"])
+        self.assertEqual(4, report["bytes"])
+        self.assertEqual(set(install_misc.CopyStats.phases),
+                         set(report["phases"]))
+        self.assertGreater(report["phases"]["write"], 0)
+        self.assertEqual(
+            ["/slow", "/fast"],
+            [d["path"] for d in report["slowest_directories"]])
+
+    def test_clone_falls_back_per_file(self):
+        self.write_source("file", b"data")
+        verifier = install_misc.FileVerifier('none')
+        verifier.clone = True
+        error = OSError(errno.EXDEV, os.strerror(errno.EXDEV))
+        with mock.patch("fcntl.ioctl", side_effect=error) as ioctl:
+            self.assertTrue(verifier.copy(
+                self.source_path("file"), self.target_path("file")))
+        self.assertEqual(install_misc.FICLONE, ioctl.call_args[0][1])
+        self.assertEqual(b"data", self.read_target("file"))
+        self.assertTrue(verifier.clone)
+
+    def test_clone_gives_up_if_unsupported(self):
+        self.write_source("file", b"data")
+        verifier = install_misc.FileVerifier('none')
+        verifier.clone = True
+        error = OSError(errno.EOPNOTSUPP, os.strerror(errno.EOPNOTSUPP))
+        with mock.patch("fcntl.ioctl", side_effect=error):
+            self.assertTrue(verifier.copy(
+                self.source_path("file"), self.target_path("file")))
+        self.assertEqual(b"data", self.read_target("file"))
+        self.assertFalse(verifier.clone)
+
+    def test_clone_checks_expected_hash(self):
+        self.write_source("file", b"data")
+        verifier = install_misc.FileVerifier('write', 'md5')
+        verifier.clone = True
+        good = install_misc.hash_file(self.source_path("file"))
+
+        def clone(targetfd, request, sourcefd):
+            os.write(targetfd, os.pread(sourcefd, 100, 0))
+
+        with mock.patch("fcntl.ioctl", side_effect=clone):
+            self.assertTrue(verifier.copy(
+                self.source_path("file"), self.target_path("file"), good))
+            self.assertFalse(verifier.copy(
+                self.source_path("file"), self.target_path("file"), b"bad"))
+        self.assertEqual(b"data", self.read_target("file"))
+        self.assertTrue(verifier.clone)
+
+    def write_dpkg_list(self, name, paths):
+        with open(self.source_path(name + ".list"), "w") as f:
+            for path in paths:
+                print(path, file=f)
+
+    def test_dpkg_path_index(self):
+        self.write_dpkg_list("foo", ["/.", "/usr", "/usr/bin/foo"])
+        self.write_dpkg_list("bar:amd64", ["/usr", "/usr/bin/bar"])
+        self.write_dpkg_list("baz", ["/usr/bin/baz"])
+        index = install_misc.DpkgPathIndex(self.source)
+        self.assertEqual(
+            {"/.", "/usr", "/usr/bin/foo", "/usr/bin/bar"},
+            index.files(["foo", "bar"]))
+        self.assertEqual(set(), index.files(["missing"]))
+
+    def test_dpkg_path_index_cache(self):
+        self.write_dpkg_list("foo", ["/usr/bin/foo"])
+        cache_path = self.target_path("cache")
+        install_misc.DpkgPathIndex(self.source).save_cache(cache_path)
+        with mock.patch.object(
+                install_misc, "read_dpkg_list") as read_dpkg_list:
+            index = install_misc.DpkgPathIndex.open(cache_path, self.source)
+            self.assertEqual({"/usr/bin/foo"}, index.files(["foo"]))
+            read_dpkg_list.assert_not_called()
+
+        # Installing another package invalidates the cache.
+        os.utime(self.source, ns=(0, 0))
+        self.write_dpkg_list("bar", ["/usr/bin/bar"])
+        index = install_misc.DpkgPathIndex.open(cache_path, self.source)
+        self.assertEqual({}, index.packages)
+        self.assertEqual({"/usr/bin/bar"}, index.files(["bar"]))
+
+    def test_blacklist_prunes_unshared_directories(self):
+        blacklist = install_misc.Blacklist(
+            ["/usr/share/gone", "/usr/share/gone/file", "/usr/share/doc",
+             "/usr/share/doc/gone", "/usr/share/gone-too"],
+            ["/usr", "/usr/share", "/usr/share/doc", "/usr/share/doc/kept",
+             "/usr/share/gone-too"])
+        self.assertIn("/usr/share/gone/file", blacklist)
+        self.assertTrue(blacklist.prunes("/usr/share/gone"))
+        # Shared with a kept package.
+        self.assertFalse(blacklist.prunes("/usr/share/doc"))
+        self.assertFalse(blacklist.prunes("/usr/share/gone-too"))
+        # Not blacklisted at all.
+        self.assertFalse(blacklist.prunes("/usr/share"))
+        self.assertFalse(blacklist.prunes("/usr/share/other"))
+
+    def test_blacklist_prune(self):
+        for path in ("usr/share/gone/sub", "usr/share/generated/sub/deeper",
+                     "usr/share/empty", "usr/share/kept"):
+            os.makedirs(self.source_path(path))
+        for path in ("usr/share/gone/file", "usr/share/gone/sub/file",
+                     "usr/share/generated/owned",
+                     "usr/share/generated/sub/owned",
+                     "usr/share/generated/sub/deeper/config",
+                     "usr/share/kept/file"):
+            with open(self.source_path(path), "w"):
+                pass
+        blacklist = install_misc.Blacklist(
+            ["/usr/share/gone", "/usr/share/gone/file",
+             "/usr/share/gone/sub", "/usr/share/gone/sub/file",
+             "/usr/share/generated", "/usr/share/generated/owned",
+             "/usr/share/generated/sub", "/usr/share/generated/sub/owned",
+             "/usr/share/generated/sub/deeper", "/usr/share/empty"],
+            ["/usr", "/usr/share", "/usr/share/kept",
+             "/usr/share/kept/file"])
+
+        def walk():
+            for dirpath, dirnames, filenames in os.walk(self.source):
+                sp = os.path.relpath(dirpath, self.source)
+                for name in dirnames:
+                    yield os.path.normpath(os.path.join(sp, name)), True, 1
+                for name in filenames:
+                    yield os.path.normpath(os.path.join(sp, name)), False, 2
+
+        pruned = list(blacklist.prune(walk()))
+        relpaths = [relpath for relpath, _ in pruned]
+        # Directories still come before their contents.
+        for i, relpath in enumerate(relpaths):
+            self.assertNotIn(os.path.dirname(relpath), relpaths[i + 1:])
+        self.assertEqual(
+            {"usr", "usr/share", "usr/share/kept", "usr/share/kept/file",
+             # These hold a file that no package owns.
+             "usr/share/generated", "usr/share/generated/owned",
+             "usr/share/generated/sub", "usr/share/generated/sub/owned",
+             "usr/share/generated/sub/deeper",
+             "usr/share/generated/sub/deeper/config"},
+            set(relpaths))
+        self.assertEqual(2, dict(pruned)["usr/share/generated/owned"])
+
+    def test_blacklist_reads_kept_lazily(self):
+        kept = mock.Mock(return_value=["/kept"])
+        blacklist = install_misc.Blacklist(["/gone", "/kept/file"], kept)
+        self.assertFalse(blacklist.prunes("/kept"))
+        self.assertFalse(kept.called)
+        self.assertTrue(blacklist.prunes("/gone"))
+        kept.assert_called_once_with()
+
+    def test_restricted_packages(self):
+        def package(name, section):
+            pkg = mock.Mock(spec=['name', 'current_ver', 'section'])
+            pkg.name = name
+            # The package's own section is often empty.
+            pkg.section = None
+            if section is None:
+                pkg.current_ver = None
+            else:
+                pkg.current_ver = mock.Mock(section=section)
+            return pkg
+
+        cache = mock.Mock()
+        cache._cache.packages = [
+            package('driver', 'restricted/misc'),
+            package('free', 'main/misc'),
+            package('uninstalled', None),
+            package('nosection', ''),
+        ]
+        self.assertEqual({'driver'}, install_misc.restricted_packages(cache))
+
+    @mock.patch('ubiquity.install_misc.apt_pkg')
+    @mock.patch('ubiquity.install_misc.apt_state')
+    @mock.patch('ubiquity.install_misc.Cache')
+    def test_get_cache_reuses_cache(self, mock_cache, mock_apt_state,
+                                    mock_apt_pkg):
+        mock_apt_state.return_value = ['state']
+        install = install_misc.InstallBase()
+        cache = install.get_cache()
+        self.assertIs(cache, install.get_cache())
+        self.assertEqual(1, mock_cache.call_count)
+        cache.clear.assert_called_once_with()
+        # Reopened when apt's state changes.
+        mock_apt_state.return_value = ['changed']
+        self.assertIs(cache, install.get_cache())
+        cache.open.assert_called_once_with(None)
+        self.assertEqual(1, mock_cache.call_count)
+        install.clear_cache()
+        install.get_cache()
+        self.assertEqual(2, mock_cache.call_count)
+
+    @mock.patch.dict(os.environ, {'UBIQUITY_FRONTEND': 'gtk_ui'})
+    @mock.patch('time.monotonic')
+    def test_progress_throttle(self, mock_monotonic):
+        db = mock.Mock()
+        throttle = install_misc.ProgressThrottle(db, interval=1)
+        mock_monotonic.return_value = 10
+        throttle.update(1, 'info', [('info', 'TIME', '1:00')])
+        self.assertEqual(
+            [mock.call.progress('SET', 1),
+             mock.call.subst('info', 'TIME', '1:00'),
+             mock.call.progress('INFO', 'info')],
+            db.mock_calls)
+        db.reset_mock()
+        # Held back, and superseded.
+        mock_monotonic.return_value = 10.5
+        throttle.update(2, 'info', [('info', 'TIME', '0:59')])
+        throttle.update(3, 'info', [('info', 'TIME', '1:00')])
+        self.assertEqual([], db.mock_calls)
+        self.assertEqual(0.5, throttle.timeout())
+        # Only what changed is sent.
+        mock_monotonic.return_value = 11
+        throttle.flush()
+        self.assertEqual([mock.call.progress('SET', 3)], db.mock_calls)
+        self.assertIsNone(throttle.timeout())
+
+    @mock.patch('ubiquity.install_misc._chroot_cleanup')
+    @mock.patch('ubiquity.install_misc._chroot_setup')
+    def test_chroot_sessions_nest(self, mock_setup, mock_cleanup):
+        with install_misc.chroot_session(self.target):
+            install_misc.chroot_setup(self.target)
+            install_misc.chroot_cleanup(self.target)
+            with install_misc.chroot_session(self.target):
+                pass
+            mock_setup.assert_called_once_with(self.target)
+            self.assertFalse(mock_cleanup.called)
+        mock_cleanup.assert_called_once_with(self.target)
+        install_misc.chroot_setup(self.target)
+        self.assertEqual(2, mock_setup.call_count)
+        install_misc.chroot_cleanup(self.target)
+        self.assertEqual(2, mock_cleanup.call_count)
+
+    def test_py_compile_ignores_callers_umask(self):
+        module = self.target_path('module.py')
+        with open(module, 'w') as f:
+            f.write('x = 1\n')
+        real_call = subprocess.call
+
+        def call(args):
+            # Compile with this Python instead of in a chroot.
+            self.assertEqual(
+                ['chroot', self.target, 'python3.6',
+                 '/usr/lib/python3.6/py_compile.py', module], args[7:])
+            return real_call(
+                args[3:7] + [sys.executable, '-m', 'py_compile', module])
+
+        old_umask = os.umask(0)
+        try:
+            with mock.patch('subprocess.call', side_effect=call):
+                self.assertTrue(install_misc.py_compile(
+                    self.target, 'python3.6', [module]))
+        finally:
+            os.umask(old_umask)
+        pycache = self.target_path('__pycache__')
+        self.assertEqual(0o755, stat.S_IMODE(os.stat(pycache).st_mode))
+        for name in os.listdir(pycache):
+            self.assertEqual(0, os.stat(os.path.join(pycache, name)).st_mode &
+                             (stat.S_IWGRP | stat.S_IWOTH))
+
+    def make_python_target(self):
+        info = self.target_path('var/lib/dpkg/info')
+        os.makedirs(info)
+        os.makedirs(self.target_path('usr/lib/python3.6/sub'))
+        stdlib = ['/usr/lib/python3.6/%s.py' % name
+                  for name in ('a', 'b', 'c', 'd', 'sub/e')]
+        with open(os.path.join(info, 'python3.6-minimal.list'), 'w') as f:
+            f.write('/usr/bin/python3.6\n')
+            f.write(''.join('%s\n' % path for path in stdlib[:3]))
+        with open(os.path.join(info, 'python3.6:amd64.list'), 'w') as f:
+            f.write(''.join('%s\n' % path for path in stdlib[3:]))
+        with open(os.path.join(info, 'python2.7-minimal.list'), 'w') as f:
+            f.write('/usr/lib/python2.7/os.py\n')
+        # Already compiled.
+        with open(self.target_path('usr/lib/python3.6/sub/e.pyc'), 'w'):
+            pass
+        install = install_misc.InstallBase()
+        install.target = self.target
+        return install, install_misc.DpkgPathIndex(info)
+
+    def test_existing_files(self):
+        install, _ = self.make_python_target()
+        self.assertEqual(
+            {'/usr/lib/python3.6/sub/e.pyc'},
+            install.existing_files('/usr/lib/python3.6', '.pyc'))
+
+    def test_python_stdlib_batches(self):
+        install, index = self.make_python_target()
+        batches = list(install.python_stdlib_batches(index, 2))
+        self.assertEqual(
+            [('python2.7', ['/usr/lib/python2.7/os.py']),
+             ('python3.6', ['/usr/lib/python3.6/a.py',
+                            '/usr/lib/python3.6/c.py']),
+             ('python3.6', ['/usr/lib/python3.6/b.py',
+                            '/usr/lib/python3.6/d.py'])],
+            batches)
+        # No more batches than files: one for python2.7, four for python3.6.
+        self.assertEqual(
+            5, len(list(install.python_stdlib_batches(index, 8))))
+
+    def test_python_stdlib_batches_skips(self):
+        install, index = self.make_python_target()
+        batches = list(install.python_stdlib_batches(
+            index, 1, exclude={'/usr/lib/python3.6/b.py'},
+            done={'python2.7'}))
+        self.assertEqual(
+            [('python3.6', ['/usr/lib/python3.6/a.py',
+                            '/usr/lib/python3.6/c.py',
+                            '/usr/lib/python3.6/d.py'])],
+            batches)
+
+    def test_python_stdlib_compiled(self):
+        path = self.target_path('python-stdlib-compiled')
+        with mock.patch('ubiquity.install_misc.PYTHON_STDLIB_COMPILED', path):
+            self.assertEqual(set(), install_misc.python_stdlib_compiled())
+            with open(path, 'w') as f:
+                f.write('python2.7\npython3.6\n')
+            self.assertEqual({'python2.7', 'python3.6'},
+                             install_misc.python_stdlib_compiled())
+
+    def test_target_accounts(self):
+        os.mkdir(self.target_path('etc'))
+        with open(self.target_path('etc/passwd'), 'w') as passwd:
+            passwd.write('root:x:0:0:root:/root:/bin/bash\n'
+                         'user:x:1000:1000:User,,,:/home/user:/bin/bash\n')
+        entry = install_misc.target_getpwnam(self.target, 'user')
+        self.assertEqual((1000, 1000, '/home/user'),
+                         (entry.pw_uid, entry.pw_gid, entry.pw_dir))
+        self.assertRaises(
+            KeyError, install_misc.target_getpwnam, self.target, 'new')
+        # Changes to the file are noticed.
+        with open(self.target_path('etc/passwd'), 'a') as passwd:
+            passwd.write('new:x:1001:1001::/home/new:/bin/sh\n')
+        self.assertEqual(
+            1001, install_misc.target_getpwnam(self.target, 'new').pw_uid)
+
+
+class DependencyGraphTests(unittest.TestCase):
+    def make_cache(self, packages, provides={}):
+        # packages maps names to None if not installed, or to a dict of
+        # dependency fields, each a list of disjunctions of names.
+        pkgs = {}
+        for name, depends in packages.items():
+            pkg = mock.Mock()
+            pkg.get_fullname.return_value = name
+            if depends is None:
+                pkg.current_ver = None
+            else:
+                pkg.current_ver = mock.Mock(parent_pkg=pkg)
+            pkgs[name] = pkg
+        for name, depends in packages.items():
+            if depends is None:
+                continue
+            depends_list = {}
+            for key, dep_ors in depends.items():
+                depends_list[key] = []
+                for dep_or in dep_ors:
+                    deps = []
+                    for depname in dep_or:
+                        dep = mock.Mock(target_pkg=pkgs[depname])
+                        targets = [
+                            pkgs[target].current_ver
+                            for target in [depname] + provides.get(
+                                depname, [])
+                            if pkgs[target].current_ver is not None]
+                        dep.all_targets.return_value = targets
+                        deps.append(dep)
+                    depends_list[key].append(deps)
+            pkgs[name].current_ver.depends_list = depends_list
+        cache = mock.Mock()
+        cache._cache.packages = list(pkgs.values())
+        return cache
+
+    def test_keep_closure(self):
+        graph = install_misc.DependencyGraph(self.make_cache({
+            'keep': {'Depends': [['a'], ['missing', 'b']],
+                     'Recommends': [['c']]},
+            'a': {'Pre-Depends': [['d']]},
+            'b': {}, 'c': {}, 'd': {}, 'e': {}, 'missing': None,
+        }))
+        self.assertEqual({'a', 'b', 'c', 'd', 'e', 'keep'}, graph.installed)
+        to_remove = {'a', 'b', 'c', 'd', 'e'}
+        self.assertEqual(
+            {'keep', 'a', 'b', 'c', 'd'},
+            graph.keep_closure({'keep'}, to_remove))
+        self.assertEqual(
+            {'keep', 'a', 'b', 'd'},
+            graph.keep_closure({'keep'}, to_remove, recommends=False))
+        self.assertEqual(
+            {'keep', 'b', 'c'}, graph.keep_closure({'keep'}, {'b', 'c'}))
+
+    def test_removal_closure(self):
+        graph = install_misc.DependencyGraph(self.make_cache({
+            'lib': {},
+            'app': {'Depends': [['lib']]},
+            'plugin': {'Depends': [['app']]},
+            'user': {'Depends': [['lib']]},
+            'either': {'Depends': [['alt1', 'alt2']]},
+            'alt1': {}, 'alt2': {},
+            'fan': {'Recommends': [['lib']]},
+        }))
+        # Removing lib would break user.
+        self.assertEqual(
+            {'app', 'plugin'},
+            graph.removal_closure({'lib', 'app', 'plugin'}))
+        self.assertEqual(
+            {'lib', 'app', 'plugin', 'user'},
+            graph.removal_closure({'lib'}, recursive=True))
+        # One alternative is enough, and Recommends don't matter.
+        self.assertEqual({'alt1'}, graph.removal_closure({'alt1'}))
+        self.assertEqual(
+            {'alt2', 'either'},
+            graph.removal_closure({'alt2'}, recursive=True,
+                                  removed={'alt1'}))
+
+    def test_removal_closure_follows_provides(self):
+        graph = install_misc.DependencyGraph(self.make_cache({
+            'virtual': None,
+            'provider': {},
+            'user': {'Depends': [['virtual']]},
+        }, provides={'virtual': ['provider']}))
+        self.assertEqual(set(), graph.removal_closure({'provider'}))
+        self.assertEqual(
+            {'provider', 'user'},
+            graph.removal_closure({'provider', 'user'}))
+
+
+class BrokenPackagesTests(unittest.TestCase):
+    def setUp(self):
+        # lib is provided by libimpl; app depends on lib.
+        self.pkgs = {}
+        for name in ('app', 'lib', 'libimpl', 'other'):
+            pkg = mock.Mock(rev_depends_list=[])
+            pkg.get_fullname.return_value = name
+            pkg.current_ver.provides_list = []
+            self.pkgs[name] = pkg
+        self.pkgs['libimpl'].current_ver.provides_list = [('lib', '', None)]
+        self.pkgs['lib'].rev_depends_list = [
+            mock.Mock(parent_pkg=self.pkgs['app'])]
+        self.broken = set()
+        self.cache = mock.Mock()
+        self.cache._cache = self.pkgs
+        self.cache.keys.return_value = sorted(self.pkgs)
+        self.cache._depcache.get_candidate_ver.return_value = None
+        self.cache._depcache.is_inst_broken.side_effect = (
+            lambda pkg: pkg.get_fullname() in self.broken)
+
+    def set_broken(self, *names):
+        self.broken = set(names)
+        self.cache._depcache.broken_count = len(names)
+
+    def test_only_checks_neighbours(self):
+        tracker = install_misc.BrokenPackages(self.cache)
+        self.set_broken('app')
+        self.assertEqual({'app'}, tracker.update(['libimpl']))
+        checked = {call[0][0].get_fullname()
+                   for call in
+                   self.cache._depcache.is_inst_broken.call_args_list}
+        self.assertEqual({'app', 'libimpl'}, checked)
+        self.set_broken()
+        self.assertEqual(set(), tracker.update(['libimpl']))
+
+    def test_falls_back_to_full_scan(self):
+        tracker = install_misc.BrokenPackages(self.cache)
+        self.set_broken('other')
+        self.assertEqual({'other'}, tracker.update(['libimpl']))
+
+
+class DownloadVerifierTests(unittest.TestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.temp_dir)
+        pkg = mock.Mock(shortname='foo', marked_delete=False)
+        pkg.candidate.version = '1:1.0'
+        pkg.candidate.architecture = 'amd64'
+        pkg.candidate.sha256 = hashlib.sha256(b'good').hexdigest()
+        cache = mock.Mock()
+        cache.get_changes.return_value = [pkg]
+        self.verifier = install_misc.DownloadVerifier(cache, workers=2)
+
+    def write_archive(self, name, data):
+        path = os.path.join(self.temp_dir, name)
+        with open(path, 'wb') as f:
+            f.write(data)
+        return mock.Mock(destfile=path, filesize=len(data))
+
+    def test_accepts_matching_archives(self):
+        items = [self.write_archive('foo_1%3a1.0_amd64.deb', b'good'),
+                 self.write_archive('unknown_1.0_all.deb', b'data')]
+        self.verifier.submit(items[0].destfile, items[0].filesize)
+        self.verifier.finish(items)
+
+    def test_rejects_mismatched_archives(self):
+        item = self.write_archive('foo_1%3a1.0_amd64.deb', b'evil')
+        self.assertRaises(IOError, self.verifier.finish, [item])
+        self.assertFalse(os.path.exists(item.destfile))
+
+
+class PackagePoolTests(unittest.TestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.temp_dir)
+        self.pool = install_misc.PackagePool(
+            os.path.join(self.temp_dir, 'pool'))
+        self.archives = os.path.join(self.temp_dir, 'archives')
+        os.mkdir(self.archives)
+        self.sha256 = hashlib.sha256(b'deb').hexdigest()
+
+    def test_planned_archives(self):
+        pkg = mock.Mock(shortname='foo', marked_delete=False)
+        pkg.candidate.version = '1:1.0_1'
+        pkg.candidate.architecture = 'amd64'
+        pkg.candidate.filename = 'pool/main/f/foo/foo_1.0_1_amd64.deb'
+        pkg.candidate.sha256 = self.sha256
+        removed = mock.Mock(marked_delete=True)
+        cache = mock.Mock()
+        cache.get_changes.return_value = [pkg, removed]
+        self.assertEqual(
+            {'foo_1%3a1.0%5f1_amd64.deb': self.sha256},
+            install_misc.planned_archives(cache))
+
+    def test_round_trip(self):
+        fetched = os.path.join(self.archives, 'foo_1.0_all.deb')
+        with open(fetched, 'wb') as f:
+            f.write(b'deb')
+        self.pool.add(fetched, self.sha256)
+        os.unlink(fetched)
+        planned = {'foo_1.0_all.deb': self.sha256, 'bar_1.0_all.deb': 'f00'}
+        self.assertEqual(1, self.pool.fill_archives(planned, self.archives))
+        with open(fetched, 'rb') as f:
+            self.assertEqual(b'deb', f.read())
+        self.assertEqual(['foo_1.0_all.deb'], os.listdir(self.archives))
+
+    def test_drops_corrupt_archives(self):
+        pooled = os.path.join(
+            self.pool.path, self.sha256[:2], '%s.deb' % self.sha256)
+        os.makedirs(os.path.dirname(pooled))
+        with open(pooled, 'wb') as f:
+            f.write(b'bad')
+        planned = {'foo_1.0_all.deb': self.sha256}
+        self.assertEqual(0, self.pool.fill_archives(planned, self.archives))
+        self.assertEqual([], os.listdir(self.archives))
+        self.assertFalse(os.path.exists(pooled))
+
+
+class InstallPlanTests(unittest.TestCase):
+    def test_install_wins(self):
+        plan = install_misc.InstallPlan()
+        self.assertFalse(plan)
+        plan.remove(['a', 'b'])
+        plan.remove(['c'], recursive=True)
+        plan.install(['b', 'c', 'd'], langpacks=True)
+        plan.remove(['d', 'e'])
+        self.assertTrue(plan)
+        self.assertEqual(['b', 'c', 'd'], plan.to_install)
+        self.assertEqual({'a', 'e'}, plan.to_remove)
+        self.assertEqual(set(), plan.to_remove_recursive)
+        self.assertTrue(plan.langpacks)
+
+    def commit_plan(self, plan, mark_install):
+        install = install_misc.InstallBase()
+        install.db = mock.Mock()
+        install.nested_progress_start = mock.Mock()
+        install.nested_progress_end = mock.Mock()
+        install.progress_region = mock.Mock()
+        cache = mock.MagicMock()
+        cache._depcache.broken_count = 0
+        install.get_cache = mock.Mock(return_value=cache)
+        install.commit_with_verify = mock.Mock(return_value=True)
+        with mock.patch.multiple(
+                'ubiquity.install_misc', DependencyGraph=mock.DEFAULT,
+                get_remove_list=mock.DEFAULT, mark_install=mark_install,
+                chroot_setup=mock.DEFAULT, chroot_cleanup=mock.DEFAULT,
+                DebconfAcquireProgress=mock.DEFAULT,
+                DebconfInstallProgress=mock.DEFAULT,
+                apt_state=mock.DEFAULT) as patched:
+            try:
+                install.commit_plan(plan)
+                error = None
+            except install_misc.InstallStepError as e:
+                error = e
+        return install, patched, error
+
+    def test_commit_plan_removes_despite_install_conflict(self):
+        plan = install_misc.InstallPlan()
+        plan.remove(['extra'])
+        plan.install(['restricted'])
+        conflict = install_misc.InstallStepError('conflict')
+        mark_install = mock.Mock(side_effect=conflict)
+        install, patched, error = self.commit_plan(plan, mark_install)
+        self.assertIs(conflict, error)
+        # The removals were marked again after the conflict, and committed.
+        self.assertEqual(4, patched['get_remove_list'].call_count)
+        self.assertTrue(install.commit_with_verify.called)
+        self.assertEqual(
+            'ubiquity/install/apt_error_remove',
+            patched['DebconfInstallProgress'].call_args[0][3])
+
+    def test_commit_plan_removal_progress(self):
+        plan = install_misc.InstallPlan()
+        plan.remove(['extra'])
+        install, patched, error = self.commit_plan(plan, mock.Mock())
+        self.assertIsNone(error)
+        install.db.progress.assert_any_call(
+            'START', 0, 5, 'ubiquity/install/title')
+        install.db.progress.assert_any_call('SET', 5)
+        install.progress_region.assert_called_with(1, 5)
+        self.assertEqual(
+            'ubiquity/install/apt_error_remove',
+            patched['DebconfInstallProgress'].call_args[0][3])
+
+
+class StepSchedulerTests(unittest.TestCase):
+    def test_conflicts(self):
+        def step(*resources):
+            return install_misc.Step('step', None, resources=resources)
+
+        self.assertTrue(step('apt').conflicts(step('apt', 'chroot')))
+        self.assertFalse(step('apt').conflicts(step('chroot')))
+        self.assertTrue(step('/etc').conflicts(step('/etc/hosts')))
+        self.assertTrue(step('/').conflicts(step('/usr')))
+        self.assertFalse(step('/etc').conflicts(step('/etcetera')))
+        self.assertRaises(
+            ValueError, install_misc.Step, 'bad', None, region=1)
+
+    def test_overlaps_independent_steps(self):
+        events = []
+        background_started = threading.Event()
+        release = threading.Event()
+
+        def background():
+            background_started.set()
+            release.wait(5)
+            events.append('background')
+
+        def foreground():
+            # Runs while background is still going.
+            background_started.wait(5)
+            events.append('foreground')
+            release.set()
+
+        install = mock.Mock()
+        steps = [
+            install_misc.Step('bg', background, resources=('/usr',)),
+            install_misc.Step('fg', foreground, resources=('debconf', '/etc'),
+                              region=2, info='info'),
+            install_misc.Step('last', lambda: events.append('last'),
+                              resources=('debconf',), after=('bg',)),
+        ]
+        install_misc.StepScheduler(install, steps).run()
+        self.assertEqual(['foreground', 'background', 'last'], events)
+        install.next_region.assert_called_once_with(size=2)
+        install.db.progress.assert_called_once_with('INFO', 'info')
+
+    def test_reraises_background_errors(self):
+        def fail():
+            raise IOError('failed')
+
+        steps = [install_misc.Step('bg', fail),
+                 install_misc.Step('fg', lambda: None, resources=('debconf',))]
+        self.assertRaises(
+            IOError, install_misc.StepScheduler(mock.Mock(), steps).run)
+
+
+class SubtreeWatcherTests(unittest.TestCase):
+    def test_waits_for_walk_and_files(self):
+        done = []
+        watcher = install_misc.SubtreeWatcher()
+        watcher.watch(['/usr', 'var/lib/dpkg'], lambda: done.append(True))
+        for relpath in ('usr', 'var', 'usr/bin', 'usr/bin/python3'):
+            watcher.walked(relpath)
+        watcher.submitted('usr/bin/python3')
+        for relpath in ('var/lib', 'var/lib/dpkg', 'var/lib/dpkg/status',
+                        'var/log'):
+            watcher.walked(relpath)
+        # The walk has left both subtrees, but python3 isn't written yet.
+        self.assertEqual([], done)
+        watcher.copied('usr/bin/python3')
+        self.assertEqual([True], done)
+        watcher.finish()
+        self.assertEqual([True], done)
+
+    def test_unvisited_subtree_waits_for_finish(self):
+        done = []
+        watcher = install_misc.SubtreeWatcher()
+        watcher.watch(['lib64'], lambda: done.append(True))
+        watcher.walked('lib64')
+        watcher.walked('usr/bin')
+        self.assertEqual([], done)
+        watcher.finish()
+        self.assertEqual([True], done)
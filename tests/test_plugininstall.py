@@ -0,0 +1,92 @@
+#!/usr/bin/python3
+
+import importlib
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+# These tests require Mock 0.7.0
+import mock
+
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'scripts'))
+try:
+    plugininstall = importlib.import_module('plugininstall')
+finally:
+    del sys.path[0]
+
+
+class DeferTriggersTests(unittest.TestCase):
+    def setUp(self):
+        self.target = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.target)
+        os.makedirs(os.path.join(self.target, 'etc/apt/apt.conf.d'))
+        self.conf = os.path.join(
+            self.target, 'etc/apt/apt.conf.d/00DeferTriggers')
+        self.install = plugininstall.Install.__new__(plugininstall.Install)
+        self.install.target = self.target
+        self.install.db = mock.Mock()
+        self.install.defer_triggers = True
+        self.install.triggers_processed = False
+        for obj in ('ubiquity.install_misc.chroot_setup',
+                    'ubiquity.install_misc.chroot_cleanup',
+                    'ubiquity.misc.execute',
+                    'subprocess.call',
+                    'syslog.syslog'):
+            patcher = mock.patch(obj)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def test_write_defer_triggers(self):
+        self.install.write_defer_triggers()
+        with open(self.conf) as conf:
+            self.assertIn('DPkg::NoTriggers "true";', conf.read())
+
+    @mock.patch('ubiquity.install_misc.chrex')
+    def test_process_triggers(self, mock_chrex):
+        mock_chrex.return_value = True
+        self.install.write_defer_triggers()
+        self.install.process_triggers()
+        mock_chrex.assert_called_once_with(
+            self.target, 'dpkg', '--triggers-only', '--pending')
+        self.assertFalse(os.path.exists(self.conf))
+        # Triggers are only processed once.
+        self.install.process_triggers()
+        self.assertEqual(1, mock_chrex.call_count)
+
+    @mock.patch('ubiquity.install_misc.chrex')
+    def test_process_triggers_not_deferred(self, mock_chrex):
+        self.install.defer_triggers = False
+        self.install.process_triggers()
+        self.assertFalse(mock_chrex.called)
+
+    @mock.patch('ubiquity.install_misc.chrex')
+    def test_process_triggers_removes_conf_on_failure(self, mock_chrex):
+        mock_chrex.return_value = False
+        self.install.write_defer_triggers()
+        self.install.process_triggers()
+        self.assertFalse(os.path.exists(self.conf))
+
+    @mock.patch('ubiquity.install_misc.chrex')
+    def test_process_triggers_removes_conf_on_error(self, mock_chrex):
+        mock_chrex.side_effect = OSError('dpkg went away')
+        self.install.write_defer_triggers()
+        self.assertRaises(OSError, self.install.process_triggers)
+        self.assertFalse(os.path.exists(self.conf))
+        self.assertTrue(plugininstall.install_misc.chroot_cleanup.called)
+
+    @mock.patch('ubiquity.install_misc.chrex')
+    def test_cleanup_processes_triggers_on_failure(self, mock_chrex):
+        mock_chrex.return_value = True
+
+        @plugininstall.cleanup_after
+        def run(install):
+            install.write_defer_triggers()
+            raise RuntimeError('install failed')
+
+        self.assertRaises(RuntimeError, run, self.install)
+        mock_chrex.assert_called_once_with(
+            self.target, 'dpkg', '--triggers-only', '--pending')
+        self.assertFalse(os.path.exists(self.conf))
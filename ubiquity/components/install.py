@@ -41,6 +41,7 @@ class Install(FilteredCommand):
 
         questions = ['^.*/apt-install-failed$',
                      'ubiquity/install/copying_error/md5',
+                     'ubiquity/install/copying_error/resume',
                      'ubiquity/install/new-bootdev',
                      'CAPB',
                      'ERROR',
@@ -71,5 +72,13 @@ class Install(FilteredCommand):
             elif response == 'Skip':
                 self.preseed(question, 'skip')
             return True
+        elif question == 'ubiquity/install/copying_error/resume':
+            response = self.frontend.question_dialog(
+                self.description(question),
+                self.extended_description(question),
+                ('Abort', 'Resume'),
+                use_templates=False)
+            self.preseed_bool(question, response == 'Resume')
+            return True
 
         return FilteredCommand.run(self, priority, question)
@@ -0,0 +1,262 @@
+# -*- coding: utf-8; Mode: Python; indent-tabs-mode: nil; tab-width: 4 -*-
+
+# Copyright (C) 2017 Canonical Ltd.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
+
+# Read and write copy manifests.
+#
+# A copy manifest lists every entry in the live filesystem image along with
+# the metadata that install.py needs to copy it, so that the installer
+# doesn't have to stat its way through the whole image itself.  Entries are
+# stored in os.walk() order, so directories always come before anything
+# inside them.
+#
+# The format is a fixed header, followed by the name of the hash used for
+# file contents (if any), followed by the entries.  Each entry is a fixed
+# part followed by its path, symlink target, extended attributes and hash.
+# All integers are little-endian.
+#
+# To generate a manifest for an unpacked image:
+#
+#   python3 -m ubiquity.copy_manifest [--hash md5] [--image IMAGE] \
+#       [--positions-from MOUNTED-IMAGE] ROOT OUTPUT
+
+from collections import namedtuple
+import hashlib
+import os
+import stat
+import struct
+import sys
+
+from ubiquity import osextras
+
+
+MAGIC = b'UBIQCMF\0'
+VERSION = 2
+
+# magic, version, length of hash name, image size, total size, entries
+_header = struct.Struct('<8sHHQQQ')
+# mode, uid, gid, size, atime, mtime, rdev, position, length of path,
+# length of symlink target, number of xattrs, length of hash
+_entry = struct.Struct('<IIIQddQQHHHH')
+# length of name, length of value
+_xattr = struct.Struct('<HI')
+
+# Entries stand in for os.stat_result, so that they can be handed straight
+# to code that expects one.  position says where a regular file's data
+# lives in the image, so that reads can be made in order; it is 0 if
+# unknown.  linktarget is None for anything other than a symlink, and hash
+# is None unless the manifest has hashes and the caller asked for them.
+ManifestEntry = namedtuple(
+    'ManifestEntry',
+    'path, st_mode, st_uid, st_gid, st_size, st_atime, st_mtime, st_rdev, '
+    'position, linktarget, xattrs, hash')
+
+
+class ManifestError(Exception):
+    """The manifest is corrupt, or does not describe this image."""
+
+
+def _new_hash(hash_name):
+    if hash_name == 'xxhash':
+        import xxhash
+        return xxhash.xxh64()
+    return hashlib.new(hash_name)
+
+
+def _hash_file(path, hash_name):
+    filehash = _new_hash(hash_name)
+    with open(path, 'rb') as fh:
+        while True:
+            buf = fh.read(1024 * 1024)
+            if not buf:
+                break
+            filehash.update(buf)
+    return filehash.digest()
+
+
+def _read_xattrs(path):
+    if not hasattr(os, 'listxattr'):
+        return []
+    try:
+        return [(name, os.getxattr(path, name, follow_symlinks=False))
+                for name in os.listxattr(path, follow_symlinks=False)]
+    except OSError:
+        return []
+
+
+def _read_exactly(fp, size):
+    data = fp.read(size)
+    if len(data) != size:
+        raise ManifestError('Truncated copy manifest')
+    return data
+
+
+class CopyManifest:
+    """A copy manifest opened for reading."""
+
+    def __init__(self, path, image=None):
+        """Open the manifest at path.
+
+        If image is given and the manifest recorded the size of the image
+        it was generated for, check that it still matches, since a
+        remastered image would otherwise be copied according to a stale
+        list.  Raise ManifestError if the manifest can't be used.
+        """
+        self.path = path
+        with open(path, 'rb') as fp:
+            header = fp.read(_header.size)
+            if len(header) != _header.size:
+                raise ManifestError('Truncated copy manifest header')
+            (magic, version, hash_name_len, self.image_size, self.total_size,
+             self.count) = _header.unpack(header)
+            if magic != MAGIC:
+                raise ManifestError('%s is not a copy manifest' % path)
+            if version != VERSION:
+                raise ManifestError(
+                    'Unsupported copy manifest version %d' % version)
+            self.hash_name = _read_exactly(fp, hash_name_len).decode()
+            self.offset = fp.tell()
+        if image is not None and self.image_size:
+            if os.path.getsize(image) != self.image_size:
+                raise ManifestError('%s does not match %s' % (path, image))
+
+    def entries(self, hash_name=None):
+        """Yield a ManifestEntry for each entry in the manifest.
+
+        File hashes are only included if the manifest's hashes were made
+        with hash_name.
+        """
+        want_hash = hash_name is not None and hash_name == self.hash_name
+        unpack = _entry.unpack
+        entry_size = _entry.size
+        with open(self.path, 'rb') as fp:
+            fp.seek(self.offset)
+            for _ in range(self.count):
+                (mode, uid, gid, size, atime, mtime, rdev, position,
+                 path_len, link_len, xattr_count, hash_len) = unpack(
+                    _read_exactly(fp, entry_size))
+                path = os.fsdecode(_read_exactly(fp, path_len))
+                if stat.S_ISLNK(mode):
+                    linktarget = os.fsdecode(_read_exactly(fp, link_len))
+                else:
+                    linktarget = None
+                xattrs = []
+                for _ in range(xattr_count):
+                    name_len, value_len = _xattr.unpack(
+                        _read_exactly(fp, _xattr.size))
+                    name = _read_exactly(fp, name_len).decode()
+                    xattrs.append((name, _read_exactly(fp, value_len)))
+                filehash = _read_exactly(fp, hash_len) if hash_len else None
+                yield ManifestEntry(
+                    path, mode, uid, gid, size, atime, mtime, rdev, position,
+                    linktarget, xattrs, filehash if want_hash else None)
+
+
+def _read_position(path):
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        return osextras.physical_offset(fd) or os.fstat(fd).st_ino
+    except OSError:
+        # squashfs doesn't support FIEMAP, but it numbers inodes in the
+        # same order as it lays out their data.
+        return os.fstat(fd).st_ino
+    finally:
+        os.close(fd)
+
+
+def write_manifest(root, path, hash_name=None, image=None,
+                   positions_from=None):
+    """Write a copy manifest for the tree at root to path.
+
+    If hash_name is given, record a hash of each regular file's contents.
+    If image is given, record its size so that the installer can tell if
+    the manifest has gone stale.  If positions_from is given, it should be
+    the image mounted somewhere; record where each regular file's data
+    lives in it.
+    """
+    root = os.path.normpath(root)
+    encoded_hash_name = (hash_name or '').encode()
+    image_size = os.path.getsize(image) if image is not None else 0
+    total_size = 0
+    count = 0
+    with open(path, 'wb') as fp:
+        # Leave room for the header, and fill it in at the end.
+        fp.write(b'\0' * _header.size)
+        fp.write(encoded_hash_name)
+        for dirpath, dirnames, filenames in os.walk(root):
+            sp = dirpath[len(root) + 1:]
+            for name in dirnames + filenames:
+                relpath = os.path.join(sp, name)
+                fqpath = os.path.join(root, relpath)
+                st = os.lstat(fqpath)
+                encoded_path = os.fsencode(relpath)
+                if stat.S_ISLNK(st.st_mode):
+                    linktarget = os.fsencode(os.readlink(fqpath))
+                else:
+                    linktarget = b''
+                xattrs = _read_xattrs(fqpath)
+                if hash_name and stat.S_ISREG(st.st_mode):
+                    filehash = _hash_file(fqpath, hash_name)
+                else:
+                    filehash = b''
+                if positions_from is not None and stat.S_ISREG(st.st_mode):
+                    position = _read_position(
+                        os.path.join(positions_from, relpath))
+                else:
+                    position = 0
+                fp.write(_entry.pack(
+                    st.st_mode, st.st_uid, st.st_gid, st.st_size,
+                    st.st_atime, st.st_mtime, st.st_rdev, position,
+                    len(encoded_path), len(linktarget), len(xattrs),
+                    len(filehash)))
+                fp.write(encoded_path)
+                fp.write(linktarget)
+                for attrname, attrvalue in xattrs:
+                    encoded_name = attrname.encode()
+                    fp.write(_xattr.pack(len(encoded_name), len(attrvalue)))
+                    fp.write(encoded_name)
+                    fp.write(attrvalue)
+                fp.write(filehash)
+                total_size += st.st_size
+                count += 1
+        fp.seek(0)
+        fp.write(_header.pack(
+            MAGIC, VERSION, len(encoded_hash_name), image_size, total_size,
+            count))
+
+
+def main(argv):
+    import argparse
+
+    parser = argparse.ArgumentParser(
+        description='Generate a copy manifest for a live filesystem.')
+    parser.add_argument('--hash', dest='hash_name',
+                        help='record file hashes using HASH_NAME')
+    parser.add_argument('--image',
+                        help='filesystem image generated from ROOT')
+    parser.add_argument('--positions-from', metavar='MOUNTED-IMAGE',
+                        help='record where file data lives in the image '
+                             'mounted on MOUNTED-IMAGE')
+    parser.add_argument('root', metavar='ROOT')
+    parser.add_argument('output', metavar='OUTPUT')
+    args = parser.parse_args(argv)
+    write_manifest(args.root, args.output, hash_name=args.hash_name,
+                   image=args.image, positions_from=args.positions_from)
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
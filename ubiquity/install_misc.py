@@ -22,18 +22,28 @@
 
 from __future__ import print_function
 
+import bisect
+import concurrent.futures
+import contextlib
 import errno
 import fcntl
 import hashlib
+import json
 import os
+import pwd
+import queue
 import re
 import select
 import shutil
 import stat
+import struct
 import subprocess
 import sys
 import syslog
+import threading
+import time
 import traceback
+import urllib.parse
 
 from apt.cache import Cache
 from apt.progress.base import InstallProgress
@@ -44,6 +54,11 @@ import debconf
 from ubiquity import misc, osextras
 from ubiquity.casper import get_casper
 
+try:
+    import xxhash
+except ImportError:
+    xxhash = None
+
 
 def debconf_disconnect():
     """Disconnect from debconf. This is only to be used as a subprocess
@@ -74,6 +89,34 @@ def chrex(target, *args):
     return misc.execute('chroot', target, *args)
 
 
+def py_compile(target, python, files):
+    """Byte-compile files in the target using python's py_compile.py.
+
+    The compiler gets a umask of 022 whatever the caller's is, since
+    install.py copies with a umask of 0 and the __pycache__ directories
+    created under /usr must not be world-writable.  This is called from
+    worker threads, so the umask is set by a shell rather than in a
+    preexec_fn.
+    """
+    compile_args = ['chroot', target, python,
+                    '/usr/lib/%s/py_compile.py' % python]
+    log_args = ['log-output', '-t', 'ubiquity',
+                'sh', '-c', 'umask 022; exec "$@"', 'py_compile']
+    log_args.extend(compile_args)
+    log_args.extend(files)
+    try:
+        status = subprocess.call(log_args)
+    except OSError as e:
+        syslog.syslog(syslog.LOG_ERR, ' '.join(compile_args))
+        syslog.syslog(syslog.LOG_ERR,
+                      "OS error(%s): %s" % (e.errno, e.strerror))
+        return False
+    if status != 0:
+        syslog.syslog(syslog.LOG_ERR, ' '.join(compile_args))
+        return False
+    return True
+
+
 def set_debconf(target, question, value, db=None):
     try:
         if 'UBIQUITY_OEM_USER_CONFIG' in os.environ and db:
@@ -114,11 +157,14 @@ def get_all_interfaces():
     return ifs
 
 
-def chroot_setup(target, x11=False):
-    """Set up /target for safe package management operations."""
-    if target == '/':
-        return
+# chroot_setup calls may be nested, and made from several threads, so count
+# how many are outstanding for each target.
+_chroot_lock = threading.Lock()
+_chroot_users = {}
+_chroot_x11_users = {}
 
+
+def _chroot_setup(target):
     policy_rc_d = os.path.join(target, 'usr/sbin/policy-rc.d')
     with open(policy_rc_d, 'w') as f:
         print("""\
@@ -156,36 +202,34 @@ exit 0""", file=f)
     misc.execute('mount', '--bind', '/dev', os.path.join(target, 'dev'))
     misc.execute('mount', '--bind', '/run', os.path.join(target, 'run'))
 
-    if x11 and 'DISPLAY' in os.environ:
-        if 'SUDO_USER' in os.environ:
-            xauthority = os.path.expanduser('~%s/.Xauthority' %
-                                            os.environ['SUDO_USER'])
-        else:
-            xauthority = os.path.expanduser('~/.Xauthority')
-        if os.path.exists(xauthority):
-            shutil.copy(xauthority,
-                        os.path.join(target, 'root/.Xauthority'))
 
-        if not os.path.isdir(os.path.join(target, 'tmp/.X11-unix')):
-            os.mkdir(os.path.join(target, 'tmp/.X11-unix'))
-        misc.execute('mount', '--bind', '/tmp/.X11-unix',
-                     os.path.join(target, 'tmp/.X11-unix'))
+def _chroot_setup_x11(target):
+    if 'SUDO_USER' in os.environ:
+        xauthority = os.path.expanduser('~%s/.Xauthority' %
+                                        os.environ['SUDO_USER'])
+    else:
+        xauthority = os.path.expanduser('~/.Xauthority')
+    if os.path.exists(xauthority):
+        shutil.copy(xauthority,
+                    os.path.join(target, 'root/.Xauthority'))
+
+    if not os.path.isdir(os.path.join(target, 'tmp/.X11-unix')):
+        os.mkdir(os.path.join(target, 'tmp/.X11-unix'))
+    misc.execute('mount', '--bind', '/tmp/.X11-unix',
+                 os.path.join(target, 'tmp/.X11-unix'))
 
 
-def chroot_cleanup(target, x11=False):
-    """Undo the work done by chroot_setup."""
-    if target == '/':
-        return
+def _chroot_cleanup_x11(target):
+    misc.execute('umount', os.path.join(target, 'tmp/.X11-unix'))
+    try:
+        os.rmdir(os.path.join(target, 'tmp/.X11-unix'))
+    except OSError:
+        pass
+    osextras.unlink_force(os.path.join(target,
+                                       'root/.Xauthority'))
 
-    if x11 and 'DISPLAY' in os.environ:
-        misc.execute('umount', os.path.join(target, 'tmp/.X11-unix'))
-        try:
-            os.rmdir(os.path.join(target, 'tmp/.X11-unix'))
-        except OSError:
-            pass
-        osextras.unlink_force(os.path.join(target,
-                                           'root/.Xauthority'))
 
+def _chroot_cleanup(target):
     chrex(target, 'umount', '/sys')
     chrex(target, 'umount', '/proc')
     misc.execute('umount', os.path.join(target, 'run'))
@@ -205,6 +249,104 @@ def chroot_cleanup(target, x11=False):
     osextras.unlink_force(policy_rc_d)
 
 
+def chroot_setup(target, x11=False):
+    """Set up /target for safe package management operations.
+
+    Only the outermost of nested calls does any work; the rest share its
+    mounts and diversions until the matching chroot_cleanup calls.
+    """
+    if target == '/':
+        return
+
+    with _chroot_lock:
+        if not _chroot_users.get(target):
+            _chroot_setup(target)
+        _chroot_users[target] = _chroot_users.get(target, 0) + 1
+        if x11 and 'DISPLAY' in os.environ:
+            if not _chroot_x11_users.get(target):
+                _chroot_setup_x11(target)
+            _chroot_x11_users[target] = _chroot_x11_users.get(target, 0) + 1
+
+
+def chroot_cleanup(target, x11=False):
+    """Undo the work done by chroot_setup."""
+    if target == '/':
+        return
+
+    with _chroot_lock:
+        if x11 and 'DISPLAY' in os.environ:
+            users = _chroot_x11_users.pop(target, 0) - 1
+            if users > 0:
+                _chroot_x11_users[target] = users
+            else:
+                _chroot_cleanup_x11(target)
+        users = _chroot_users.pop(target, 0) - 1
+        if users > 0:
+            _chroot_users[target] = users
+        else:
+            _chroot_cleanup(target)
+
+
+@contextlib.contextmanager
+def chroot_session(target, x11=False):
+    """Keep /target set up for package management within a with block.
+
+    Sessions nest, so a step can open its own without caring whether an
+    enclosing one already exists.
+    """
+    chroot_setup(target, x11=x11)
+    try:
+        yield
+    finally:
+        chroot_cleanup(target, x11=x11)
+
+
+# path -> ((st_ino, st_size, st_mtime_ns), entries)
+_account_files = {}
+
+
+def _read_account_file(path, fields, convert):
+    st = os.stat(path)
+    key = (st.st_ino, st.st_size, st.st_mtime_ns)
+    cached = _account_files.get(path)
+    if cached is not None and cached[0] == key:
+        return cached[1]
+    entries = {}
+    with open(path) as fp:
+        for line in fp:
+            line = line.rstrip('\n')
+            if not line or line.startswith(('#', '+', '-')):
+                continue
+            parts = line.split(':')
+            if len(parts) != fields:
+                continue
+            try:
+                entry = convert(parts)
+            except ValueError:
+                continue
+            # Like the C library, the first entry for a name wins.
+            entries.setdefault(parts[0], entry)
+    _account_files[path] = (key, entries)
+    return entries
+
+
+def _passwd_entry(parts):
+    parts[2] = int(parts[2])
+    parts[3] = int(parts[3])
+    return pwd.struct_passwd(parts)
+
+
+def target_getpwnam(target, name):
+    """Look up a user in the target system's /etc/passwd.
+
+    This behaves like pwd.getpwnam, and raises KeyError if there is no
+    such user.  The parsed file is kept until it changes, so repeated
+    lookups are cheap and don't need to run anything in the target.
+    """
+    path = os.path.join(target, 'etc/passwd')
+    return _read_account_file(path, 7, _passwd_entry)[name]
+
+
 def record_installed(pkgs):
     """Record which packages we've explicitly installed so that we don't
     try to remove them later."""
@@ -250,6 +392,84 @@ def query_recorded_removed():
     return (apt_removed, apt_removed_recursive)
 
 
+# Minimum number of seconds between progress updates sent to debconf.
+PROGRESS_INTERVAL = 0.1
+
+
+class ProgressThrottle:
+    """Send progress updates to debconf at a limited rate.
+
+    apt and dpkg can report progress far faster than a frontend can show
+    it, and every debconf command is a round trip to the frontend, so
+    sending each report as it comes holds up whoever is reporting.
+    Instead, updates that arrive within interval seconds of the last one
+    sent are held back, and only the latest is sent when the interval is
+    up.  Parts of an update that haven't changed since they were last sent
+    are not sent again.
+    """
+
+    def __init__(self, db, interval=PROGRESS_INTERVAL):
+        self.db = db
+        self.interval = interval
+        self.last_time = None
+        # (percent, info, substitutions) waiting to be sent
+        self.pending = None
+        self.sent_percent = None
+        self.sent_substs = {}
+        self.sent_info = None
+
+    def update(self, percent=None, info=None, substs=()):
+        """Queue an update, sending it now if the interval is up.
+
+        percent is an integer or None, info is a template to show or None,
+        and substs is a sequence of (template, variable, value).  May
+        raise DebconfError if the update is sent and the user cancels.
+        """
+        self.pending = (percent, info, tuple(substs))
+        if self.timeout() == 0:
+            self.flush()
+
+    def timeout(self):
+        """Return how long until the queued update is due.
+
+        Return None if there's nothing queued.
+        """
+        if self.pending is None:
+            return None
+        if self.last_time is None:
+            return 0
+        return max(0, self.last_time + self.interval - time.monotonic())
+
+    def flush(self):
+        """Send the queued update, if any."""
+        if self.pending is None:
+            return
+        percent, info, substs = self.pending
+        self.pending = None
+        self.last_time = time.monotonic()
+        changed = False
+        if percent is not None and percent != self.sent_percent:
+            if os.environ['UBIQUITY_FRONTEND'] != 'debconf_ui':
+                self.db.progress('SET', percent)
+            self.sent_percent = percent
+        for template, variable, value in substs:
+            if self.sent_substs.get((template, variable)) != value:
+                self.db.subst(template, variable, value)
+                self.sent_substs[(template, variable)] = value
+                changed = True
+        if info is not None and (changed or info != self.sent_info):
+            self.db.progress('INFO', info)
+            self.sent_info = info
+
+    def reset(self):
+        """Forget what was sent, for when another progress bar starts."""
+        self.pending = None
+        self.last_time = None
+        self.sent_percent = None
+        self.sent_substs = {}
+        self.sent_info = None
+
+
 class DebconfAcquireProgress(AcquireProgress):
     """An object that reports apt's fetching progress using debconf."""
 
@@ -261,8 +481,12 @@ class DebconfAcquireProgress(AcquireProgress):
         self.info = info
         self.old_capb = None
         self.eta = 0.0
+        # If set, a DownloadVerifier to check each archive as it arrives.
+        self.verifier = None
+        self.throttle = ProgressThrottle(db)
 
     def start(self):
+        self.throttle.reset()
         if os.environ['UBIQUITY_FRONTEND'] != 'debconf_ui':
             self.db.progress('START', 0, 100, self.title)
         if self.info_starting is not None:
@@ -282,21 +506,31 @@ class DebconfAcquireProgress(AcquireProgress):
             self.eta = ((self.total_bytes - self.current_bytes) /
                         float(self.current_cps))
 
+        if self.eta != 0.0:
+            time_str = "%d:%02d" % divmod(int(self.eta), 60)
+            info = self.info
+            substs = [(self.info, 'TIME', time_str)]
+        else:
+            info = None
+            substs = []
         try:
-            if os.environ['UBIQUITY_FRONTEND'] != 'debconf_ui':
-                self.db.progress('SET', int(self.percent))
+            self.throttle.update(int(self.percent), info, substs)
         except debconf.DebconfError:
             return False
-        if self.eta != 0.0:
-            time_str = "%d:%02d" % divmod(int(self.eta), 60)
-            self.db.subst(self.info, 'TIME', time_str)
-            try:
-                self.db.progress('INFO', self.info)
-            except debconf.DebconfError:
-                return False
         return True
 
+    def done(self, item):
+        AcquireProgress.done(self, item)
+        owner = item.owner
+        if (self.verifier is not None and owner.status == owner.STAT_DONE and
+                owner.complete):
+            self.verifier.submit(owner.destfile, owner.filesize)
+
     def stop(self):
+        try:
+            self.throttle.flush()
+        except debconf.DebconfError:
+            pass
         if self.old_capb is not None:
             self.db.capb(self.old_capb)
             self.old_capb = None
@@ -314,6 +548,7 @@ class DebconfInstallProgress(InstallProgress):
         self.info = info
         self.error_template = error
         self.started = False
+        self.throttle = ProgressThrottle(db)
         # InstallProgress uses a non-blocking status fd; our run()
         # implementation doesn't need that, and in fact we spin unless the
         # fd is blocking.
@@ -322,12 +557,14 @@ class DebconfInstallProgress(InstallProgress):
                     flags & ~os.O_NONBLOCK)
 
     def start_update(self):
+        self.throttle.reset()
         if os.environ['UBIQUITY_FRONTEND'] != 'debconf_ui':
             self.db.progress('START', 0, 100, self.title)
         self.started = True
 
     def error(self, pkg, errormsg):
         if self.error_template is not None:
+            self.throttle.flush()
             self.db.subst(self.error_template, 'PACKAGE', pkg)
             self.db.subst(self.error_template, 'MESSAGE', errormsg)
             self.db.input('critical', self.error_template)
@@ -336,10 +573,8 @@ class DebconfInstallProgress(InstallProgress):
     def status_change(self, dummypkg, percent, status):
         self.percent = percent
         self.status = status
-        if os.environ['UBIQUITY_FRONTEND'] != 'debconf_ui':
-            self.db.progress('SET', int(percent))
-        self.db.subst(self.info, 'DESCRIPTION', status)
-        self.db.progress('INFO', self.info)
+        self.throttle.update(
+            int(percent), self.info, [(self.info, 'DESCRIPTION', status)])
 
     def run(self, pm):
         # Create a subprocess to deal with turning apt status messages into
@@ -352,15 +587,22 @@ class DebconfInstallProgress(InstallProgress):
             os.close(control_write)
             try:
                 while True:
+                    # Wake up in time to send any update that the throttle
+                    # held back.
                     try:
                         rlist, _, _ = select.select(
-                            [self.status_stream, control_read], [], [])
+                            [self.status_stream, control_read], [], [],
+                            self.throttle.timeout())
                     except select.error as error:
                         if error[0] != errno.EINTR:
                             raise
+                        continue
                     if self.status_stream in rlist:
                         self.update_interface()
+                    elif not rlist:
+                        self.throttle.flush()
                     if control_read in rlist:
+                        self.throttle.flush()
                         os._exit(0)
             except (KeyboardInterrupt, SystemExit):
                 pass  # we're going to exit anyway
@@ -502,8 +744,18 @@ def get_cache_pkg(cache, pkg):
         return None
 
 
+def _package_name(pkg):
+    # Match the names that apt.Cache uses as keys, which only qualify
+    # packages with their architecture if it isn't the native one.
+    if hasattr(pkg, 'get_fullname'):
+        return pkg.get_fullname(True)
+    return pkg.name
+
+
 def broken_packages(cache):
     expect_count = cache._depcache.broken_count
+    if expect_count == 0:
+        return set()
     count = 0
     brokenpkgs = set()
     for pkg in cache.keys():
@@ -519,6 +771,68 @@ def broken_packages(cache):
     return brokenpkgs
 
 
+class BrokenPackages:
+    """Keep track of which packages apt considers broken.
+
+    Changing the marks on a few packages can only break or fix those
+    packages and the packages with relationships to them, so only those
+    need to be checked again, rather than the whole cache.  The result is
+    checked against apt's count of broken packages, and if they disagree
+    (say, because marking a package for installation pulled in others) we
+    fall back to a full scan.
+    """
+
+    def __init__(self, cache):
+        self.cache = cache
+        self.broken = set()
+
+    def _is_broken(self, name):
+        try:
+            return self.cache._depcache.is_inst_broken(self.cache._cache[name])
+        except KeyError:
+            return False
+
+    def _neighbours(self, name):
+        neighbours = {name}
+        try:
+            pkg = self.cache._cache[name]
+        except KeyError:
+            return neighbours
+        # Relationships may be with the package itself or with any virtual
+        # package it provides (or will provide once the marks are acted on).
+        targets = [pkg]
+        for ver in (pkg.current_ver,
+                    self.cache._depcache.get_candidate_ver(pkg)):
+            if ver is None:
+                continue
+            for provided in ver.provides_list:
+                try:
+                    targets.append(self.cache._cache[provided[0]])
+                except KeyError:
+                    pass
+        for target in targets:
+            for dep in target.rev_depends_list:
+                neighbours.add(_package_name(dep.parent_pkg))
+        return neighbours
+
+    def update(self, changed):
+        """Note that the marks on changed have changed.
+
+        Return the set of broken packages.
+        """
+        expect_count = self.cache._depcache.broken_count
+        if expect_count == 0:
+            self.broken = set()
+            return set()
+        candidates = set(self.broken)
+        for name in changed:
+            candidates |= self._neighbours(name)
+        self.broken = {name for name in candidates if self._is_broken(name)}
+        if len(self.broken) != expect_count:
+            self.broken = broken_packages(self.cache)
+        return set(self.broken)
+
+
 def mark_install(cache, pkg):
     cachedpkg = get_cache_pkg(cache, pkg)
     if (cachedpkg is not None and
@@ -529,11 +843,12 @@ def mark_install(cache, pkg):
         except SystemError:
             apt_error = True
         if cache._depcache.broken_count > 0 or apt_error:
-            brokenpkgs = broken_packages(cache)
+            tracker = BrokenPackages(cache)
+            brokenpkgs = tracker.update([pkg])
             while brokenpkgs:
                 for brokenpkg in brokenpkgs:
                     get_cache_pkg(cache, brokenpkg).mark_keep()
-                new_brokenpkgs = broken_packages(cache)
+                new_brokenpkgs = tracker.update(brokenpkgs)
                 if brokenpkgs == new_brokenpkgs:
                     break  # we can do nothing more
                 brokenpkgs = new_brokenpkgs
@@ -545,6 +860,128 @@ def mark_install(cache, pkg):
                     "Unable to install '%s' due to conflicts." % pkg)
 
 
+class DependencyGraph:
+    """Dependencies between the installed packages in an apt cache.
+
+    This walks the cache once, and then answers questions about which
+    packages have to be kept and which can be removed without asking apt
+    to mark each candidate and rescan the whole cache for broken packages
+    afterwards.  It only knows about installed packages, which is all that
+    the installer's removal calculations care about.
+    """
+
+    keys = ('Pre-Depends', 'Depends', 'Recommends')
+    # Only these can leave a package broken when they go unsatisfied.
+    hard_keys = ('Pre-Depends', 'Depends')
+
+    def __init__(self, cache):
+        self.installed = set()
+        # package name -> list of (key, alternatives), one per dependency
+        # (or disjunction of dependencies).  alternatives lists the
+        # installed packages named by the dependency, in order.
+        self.depends = {}
+        # package name -> list of sets of installed packages able to
+        # satisfy each of its hard dependencies, including via Provides
+        # and taking versions into account
+        self.satisfiers = {}
+        # package name -> packages with a hard dependency it satisfies
+        self.rdepends = {}
+        for pkg in cache._cache.packages:
+            ver = pkg.current_ver
+            if ver is None:
+                continue
+            name = _package_name(pkg)
+            self.installed.add(name)
+            depends = self.depends[name] = []
+            satisfiers = self.satisfiers[name] = []
+            for key in self.keys:
+                for dep_or in ver.depends_list.get(key, []):
+                    alternatives = [
+                        _package_name(dep.target_pkg) for dep in dep_or
+                        if dep.target_pkg.current_ver is not None]
+                    if alternatives:
+                        depends.append((key, alternatives))
+                    if key not in self.hard_keys:
+                        continue
+                    satisfied_by = set()
+                    for dep in dep_or:
+                        for target in dep.all_targets():
+                            parent = target.parent_pkg
+                            if parent.current_ver == target:
+                                satisfied_by.add(_package_name(parent))
+                    # Something that's broken already can't get any worse.
+                    if satisfied_by:
+                        satisfiers.append(satisfied_by)
+                        for satisfier in satisfied_by:
+                            self.rdepends.setdefault(
+                                satisfier, set()).add(name)
+
+    def keep_closure(self, keep, to_remove, recommends=True):
+        """Return keep plus everything in to_remove that it depends on."""
+        keys = set(self.hard_keys)
+        if recommends:
+            keys.add('Recommends')
+        expanded = set(keep)
+        to_scan = list(expanded)
+        while to_scan:
+            for key, alternatives in self.depends.get(to_scan.pop(), []):
+                if key not in keys:
+                    continue
+                # Keep the first element of a disjunction that's
+                # installed; this mirrors what 'apt-get install' would do
+                # if you were installing the package from scratch.  This
+                # doesn't handle versioned dependencies, but that's
+                # largely OK since apt will spot those later; the only
+                # case I can think of where this might have trouble is
+                # "Recommends: foo (>= 2) | bar".
+                depname = alternatives[0]
+                if depname in expanded or depname not in to_remove:
+                    continue
+                expanded.add(depname)
+                to_scan.append(depname)
+        return expanded
+
+    def _breaks(self, pkg, gone):
+        return any(satisfied_by <= gone
+                   for satisfied_by in self.satisfiers.get(pkg, []))
+
+    def _cascade(self, pkg, gone, to_remove, recursive):
+        # Return pkg and everything that removing it would break, or None
+        # if that would break something we aren't allowed to remove.
+        cascade = {pkg}
+        to_scan = [pkg]
+        while to_scan:
+            for rdep in self.rdepends.get(to_scan.pop(), ()):
+                if rdep in gone or rdep in cascade:
+                    continue
+                if not self._breaks(rdep, gone | cascade):
+                    continue
+                if not recursive and rdep not in to_remove:
+                    return None
+                cascade.add(rdep)
+                to_scan.append(rdep)
+        return cascade
+
+    def removal_closure(self, to_remove, recursive=False, removed=()):
+        """Work out which packages can be removed.
+
+        Each package in to_remove is tried in turn, along with anything
+        whose dependencies removing it would break.  Unless recursive is
+        true, those must all be in to_remove too, or the package is kept.
+        removed is the set of packages already gone.  Return the set of
+        packages newly removed.
+        """
+        to_remove = set(to_remove)
+        gone = set(removed)
+        for pkg in sorted(to_remove):
+            if pkg in gone or pkg not in self.installed:
+                continue
+            cascade = self._cascade(pkg, gone, to_remove, recursive)
+            if cascade is not None:
+                gone |= cascade
+        return gone - set(removed)
+
+
 def expand_dependencies_simple(cache, keep, to_remove, recommends=True):
     """Calculate non-removable packages.
 
@@ -554,48 +991,7 @@ def expand_dependencies_simple(cache, keep, to_remove, recommends=True):
     figure it out), but it allows us to ask apt fewer separate questions,
     and so is faster.
     """
-    keys = ['Pre-Depends', 'Depends']
-    if recommends:
-        keys.append('Recommends')
-
-    to_scan = set(keep)
-    to_scan_next = set()
-    expanded = set(keep)
-    while to_scan:
-        for pkg in to_scan:
-            cachedpkg = get_cache_pkg(cache, pkg)
-            if cachedpkg is None:
-                continue
-            ver = cachedpkg._pkg.current_ver
-            if ver is None:
-                continue
-            for key in keys:
-                if key in ver.depends_list:
-                    for dep_or in ver.depends_list[key]:
-                        # Keep the first element of a disjunction that's
-                        # installed; this mirrors what 'apt-get install' would
-                        # do if you were installing the package from scratch.
-                        # This doesn't handle versioned dependencies, but
-                        # that's largely OK since apt will spot those later;
-                        # the only case I can think of where this might have
-                        # trouble is "Recommends: foo (>= 2) | bar".
-                        for dep in dep_or:
-                            depname = dep.target_pkg.name
-                            cacheddep = get_cache_pkg(cache, depname)
-                            if cacheddep is None:
-                                continue
-                            if cacheddep._pkg.current_ver is not None:
-                                break
-                        else:
-                            continue
-                        if depname in expanded or depname not in to_remove:
-                            continue
-                        expanded.add(depname)
-                        to_scan_next.add(depname)
-        to_scan = to_scan_next
-        to_scan_next = set()
-
-    return expanded
+    return DependencyGraph(cache).keep_closure(keep, to_remove, recommends)
 
 
 def locale_to_language_pack(locale):
@@ -609,8 +1005,38 @@ def locale_to_language_pack(locale):
         return lang
 
 
-def get_remove_list(cache, to_remove, recursive=False):
+def get_remove_list(cache, to_remove, recursive=False, graph=None):
+    """Mark packages for removal, returning the set of packages marked.
+
+    The removals are worked out using a DependencyGraph, made from cache if
+    graph is None.  The graph can't know everything that apt does, so if
+    apt disagrees with it then fall back to asking apt about each package
+    in turn.
+    """
+    if graph is None:
+        graph = DependencyGraph(cache)
+    removed = graph.removal_closure(to_remove, recursive=recursive)
+    marked = []
+    try:
+        for pkg in sorted(removed):
+            cachedpkg = get_cache_pkg(cache, pkg)
+            if cachedpkg is None:
+                raise SystemError('%s not in cache' % pkg)
+            cachedpkg.mark_delete(auto_fix=False, purge=True)
+            marked.append(cachedpkg)
+    except SystemError:
+        pass
+    else:
+        if cache._depcache.broken_count == 0:
+            return removed
+    for cachedpkg in marked:
+        cachedpkg.mark_keep()
+    return _get_remove_list_slow(cache, to_remove, recursive)
+
+
+def _get_remove_list_slow(cache, to_remove, recursive=False):
     to_remove = set(to_remove)
+    tracker = BrokenPackages(cache)
     all_removed = set()
     while True:
         removed = set()
@@ -629,7 +1055,7 @@ def get_remove_list(cache, to_remove, recursive=False):
                     # of the broken packages are in the set of packages
                     # to remove anyway, then go ahead and try to remove
                     # them too.
-                    brokenpkgs = broken_packages(cache)
+                    brokenpkgs = tracker.update([pkg])
                     broken_removed = set()
                     while brokenpkgs and (recursive or
                                           brokenpkgs <= to_remove):
@@ -647,13 +1073,14 @@ def get_remove_list(cache, to_remove, recursive=False):
                         broken_removed |= broken_removed_inner
                         if apt_error or not broken_removed_inner:
                             break
-                        brokenpkgs = broken_packages(cache)
+                        brokenpkgs = tracker.update(broken_removed_inner)
                     if apt_error or cache._depcache.broken_count > 0:
                         # That didn't work. Revert all the removals we
                         # just tried.
                         for pkg2 in broken_removed:
                             get_cache_pkg(cache, pkg2).mark_keep()
                         cachedpkg.mark_keep()
+                        tracker.update(broken_removed | {pkg})
                     else:
                         removed.add(pkg)
                         removed |= broken_removed
@@ -672,6 +1099,231 @@ def get_remove_list(cache, to_remove, recursive=False):
     return all_removed
 
 
+DPKG_INFO_DIR = '/var/lib/dpkg/info'
+
+
+def read_dpkg_list(path):
+    """Return the paths listed in a dpkg .list file."""
+    with open(path, 'rb') as fp:
+        paths = os.fsdecode(fp.read()).split('\n')
+    if not paths[-1]:
+        paths.pop()
+    return paths
+
+
+class DpkgPathIndex:
+    """Find the files belonging to installed packages.
+
+    This reads dpkg's .list files directly rather than running dpkg -L, and
+    reads them in parallel when there are many.  An index of every
+    package's files can be saved to a cache file and loaded again later,
+    which saves reading the lists at all; the cache is only trusted if
+    dpkg's info directory hasn't changed since it was written.
+    """
+
+    cache_magic = 'ubiquity-dpkg-path-index 1'
+
+    def __init__(self, info_dir=DPKG_INFO_DIR):
+        self.info_dir = info_dir
+        self.stamp = os.stat(info_dir).st_mtime_ns
+        # package name -> .list files; there may be more than one for
+        # packages with instances for several architectures
+        self.lists = {}
+        for name in os.listdir(info_dir):
+            if name.endswith('.list'):
+                pkg = name[:-len('.list')].split(':', 1)[0]
+                self.lists.setdefault(pkg, []).append(
+                    os.path.join(info_dir, name))
+        # package name -> list of paths
+        self.packages = {}
+
+    @classmethod
+    def open(cls, cache_path=None, info_dir=DPKG_INFO_DIR):
+        """Return an index, loaded from cache_path if it's up to date."""
+        index = cls(info_dir)
+        if cache_path is not None:
+            index.load_cache(cache_path)
+        return index
+
+    def load_cache(self, cache_path):
+        """Load package file lists from cache_path, if it's up to date."""
+        try:
+            with open(cache_path, 'rb') as fp:
+                header = fp.readline().decode().split()
+                if (' '.join(header[:2]) != self.cache_magic or
+                        header[2:] != [str(self.stamp)]):
+                    return False
+                packages = {}
+                paths = None
+                for line in fp.read().splitlines():
+                    if line.startswith(b'@'):
+                        paths = packages.setdefault(
+                            os.fsdecode(line[1:]), [])
+                    else:
+                        paths.append(os.fsdecode(line))
+        except (IOError, OSError, IndexError, AttributeError,
+                UnicodeDecodeError):
+            return False
+        self.packages = packages
+        return True
+
+    def save_cache(self, cache_path):
+        """Read every package's files and save them to cache_path."""
+        self.read(self.lists)
+        with open(cache_path + '.new', 'wb') as fp:
+            fp.write(('%s %d\n' % (self.cache_magic, self.stamp)).encode())
+            for pkg, paths in sorted(self.packages.items()):
+                fp.write(b'@' + os.fsencode(pkg) + b'\n')
+                for path in paths:
+                    fp.write(os.fsencode(path) + b'\n')
+        os.rename(cache_path + '.new', cache_path)
+
+    def _read_package(self, pkg):
+        paths = []
+        for path in self.lists.get(pkg, []):
+            paths.extend(read_dpkg_list(path))
+        return pkg, paths
+
+    def read(self, pkgs):
+        """Make sure that the files of all of pkgs have been read."""
+        missing = [pkg for pkg in pkgs if pkg not in self.packages]
+        if len(missing) < 32:
+            results = map(self._read_package, missing)
+        else:
+            with concurrent.futures.ThreadPoolExecutor(
+                    max_workers=default_copy_workers()) as executor:
+                results = list(executor.map(self._read_package, missing))
+        for pkg, paths in results:
+            self.packages[pkg] = paths
+
+    def files(self, pkgs):
+        """Return the set of paths belonging to any of pkgs."""
+        self.read(pkgs)
+        files = set()
+        for pkg in pkgs:
+            files.update(self.packages[pkg])
+        return files
+
+
+class Blacklist:
+    """Paths that should not be copied to the target system.
+
+    Besides the blacklisted paths themselves, this knows which paths
+    belong to packages that are being kept, so that it can tell when a
+    whole directory tree can be skipped: that is, when the directory and
+    everything in it are blacklisted and no kept package has anything in
+    it.  kept may be a function returning those paths, in which case it is
+    only called if some directory turns out to be a candidate for pruning.
+    """
+
+    def __init__(self, paths=(), kept=()):
+        self.paths = set(paths)
+        if callable(kept):
+            self._kept_func = kept
+            self._kept = None
+        else:
+            self._kept = sorted(kept)
+
+    @property
+    def kept(self):
+        if self._kept is None:
+            self._kept = sorted(self._kept_func())
+        return self._kept
+
+    def __contains__(self, path):
+        return path in self.paths
+
+    def __iter__(self):
+        return iter(self.paths)
+
+    def __len__(self):
+        return len(self.paths)
+
+    def prunes(self, dirpath):
+        """Might the whole tree at dirpath be skipped?
+
+        This only consults the blacklist and the kept packages.  The tree
+        may still hold something that no package owns, so use prune() to
+        find out.
+        """
+        if dirpath not in self.paths:
+            return False
+        kept = self.kept
+        i = bisect.bisect_left(kept, dirpath)
+        if i < len(kept) and kept[i] == dirpath:
+            return False
+        # Everything under dirpath sorts together, starting here.
+        prefix = dirpath + '/'
+        i = bisect.bisect_left(kept, prefix, i)
+        return not (i < len(kept) and kept[i].startswith(prefix))
+
+    def prune(self, entries):
+        """Filter entirely blacklisted directory trees out of entries.
+
+        entries are (relpath, is_dir, value) triples for everything in the
+        tree being copied, in os.walk() order, with paths relative to its
+        root.  Yield (relpath, value) for everything that should be copied.
+        A directory that prunes() is held back, together with its contents,
+        until its contents show whether anything in it is not blacklisted;
+        if so, the directory is yielded just before its contents.
+        """
+        pruner = _TreePruner(self)
+        for relpath, is_dir, value in entries:
+            for item in pruner.feed(relpath, is_dir, value):
+                yield item
+        for item in pruner.finish():
+            yield item
+
+
+class _TreePruner:
+    # In os.walk() order, everything in a directory follows that
+    # directory's siblings, all in one run.  Directories that might be
+    # pruned are held in candidates until their run starts; the run is
+    # passed through another _TreePruner, to deal with candidates nested
+    # inside it, and held until it ends.
+
+    def __init__(self, blacklist):
+        self.blacklist = blacklist
+        self.candidates = {}
+        self.block = None
+
+    def feed(self, relpath, is_dir, value):
+        out = []
+        if self.block is not None:
+            if relpath.startswith(self.block[0] + '/'):
+                if '/' + relpath not in self.blacklist:
+                    self.block[2] = True
+                self.block[4].extend(
+                    self.block[3].feed(relpath, is_dir, value))
+                return out
+            out.extend(self.finish_block())
+        parent = os.path.dirname(relpath)
+        if parent in self.candidates:
+            self.block = [parent, self.candidates.pop(parent), False,
+                          _TreePruner(self.blacklist), []]
+            out.extend(self.feed(relpath, is_dir, value))
+        elif is_dir and self.blacklist.prunes('/' + relpath):
+            self.candidates[relpath] = value
+        else:
+            out.append((relpath, value))
+        return out
+
+    def finish_block(self):
+        dirpath, value, unowned, inner, held = self.block
+        self.block = None
+        if not unowned:
+            return []
+        held.extend(inner.finish())
+        return [(dirpath, value)] + held
+
+    def finish(self):
+        # Candidates whose runs never started are empty.
+        self.candidates = {}
+        if self.block is None:
+            return []
+        return self.finish_block()
+
+
 def remove_target(source_root, target_root, relpath, st_source):
     """Remove a target file if necessary and if we can.
 
@@ -745,51 +1397,1519 @@ def remove_target(source_root, target_root, relpath, st_source):
             backuppath = backuppath + '.bak'
 
 
-def copy_file(db, sourcepath, targetpath, md5_check):
-    while 1:
-        if md5_check:
-            sourcehash = hashlib.md5()
+COPY_BUFFER_SIZE = 1024 * 1024
 
-        with open(sourcepath, 'rb') as sourcefh:
-            with open(targetpath, 'wb') as targetfh:
-                while True:
-                    buf = sourcefh.read(16 * 1024)
-                    if not buf:
-                        break
-                    targetfh.write(buf)
-                    if md5_check:
-                        sourcehash.update(buf)
+# _IOW(0x94, 9, int)
+FICLONE = 0x40049409
+
+# In-kernel copy methods that have turned out not to be implemented at all
+# on this system, so that we don't keep asking for them.
+_unsupported_copy_methods = set()
+
+
+def _copy_fd_kernel(method, sourcefd, targetfd):
+    """Copy from sourcefd to targetfd with an in-kernel copy method.
+
+    Data moves from the current file offsets.  Return True if the copy
+    reached the end of the source, or False if this method can't be used
+    for this pair of files; in that case, anything already transferred has
+    advanced both file offsets, so another method can carry on from there.
+    """
+    if method in _unsupported_copy_methods:
+        return False
+    while True:
+        try:
+            if method == 'copy_file_range':
+                copied = os.copy_file_range(
+                    sourcefd, targetfd, COPY_BUFFER_SIZE * 8)
+            else:
+                copied = os.sendfile(
+                    targetfd, sourcefd, None, COPY_BUFFER_SIZE * 8)
+        except OSError as e:
+            if e.errno == errno.EINTR:
+                continue
+            if e.errno == errno.ENOSYS:
+                _unsupported_copy_methods.add(method)
+                return False
+            if e.errno in (errno.EXDEV, errno.EINVAL, errno.EOPNOTSUPP,
+                           errno.ENOTSUP, errno.EBADF):
+                return False
+            raise
+        if not copied:
+            return True
+
+
+def copy_fd(sourcefd, targetfd):
+    """Copy everything from sourcefd to targetfd.
 
-        if not md5_check:
+    Prefer copying inside the kernel with copy_file_range() or sendfile(),
+    so that the data never has to pass through Python, and fall back to
+    reading and writing buffers if neither is available.
+    """
+    if (hasattr(os, 'copy_file_range') and
+            _copy_fd_kernel('copy_file_range', sourcefd, targetfd)):
+        return
+    if (hasattr(os, 'sendfile') and
+            _copy_fd_kernel('sendfile', sourcefd, targetfd)):
+        return
+    while True:
+        buf = os.read(sourcefd, COPY_BUFFER_SIZE)
+        if not buf:
             break
+        while buf:
+            written = os.write(targetfd, buf)
+            buf = buf[written:]
+
+
+def available_hash_name(hash_name):
+    """Return the name of the hash that new_hash(hash_name) really uses.
+
+    md5 is always available.  blake2b needs Python 3.6, and xxhash needs
+    the python3-xxhash module; if they are missing, we fall back to md5.
+    """
+    if hash_name == 'blake2b' and hasattr(hashlib, 'blake2b'):
+        return hash_name
+    elif hash_name == 'xxhash' and xxhash is not None:
+        return hash_name
+    return 'md5'
+
+
+def new_hash(hash_name):
+    """Return a new hash object for hash_name (see available_hash_name)."""
+    hash_name = available_hash_name(hash_name)
+    if hash_name == 'blake2b':
+        return hashlib.blake2b()
+    elif hash_name == 'xxhash':
+        return xxhash.xxh64()
+    return hashlib.md5()
+
+
+def drop_cache(path, flush=True):
+    """Flush path to disk and evict it from the page cache.
+
+    After this, reading path back really reads it from the disk.  Pass
+    flush=False if the caller has already flushed the whole filesystem.
+    """
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        if flush:
+            os.fdatasync(fd)
+        if hasattr(os, 'posix_fadvise'):
+            os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_DONTNEED)
+    finally:
+        os.close(fd)
+
+
+def hash_file(path, hash_name='md5'):
+    """Return the digest of path."""
+    filehash = new_hash(hash_name)
+    with open(path, 'rb') as fh:
+        while True:
+            buf = fh.read(COPY_BUFFER_SIZE)
+            if not buf:
+                break
+            filehash.update(buf)
+    return filehash.digest()
+
 
+def files_match(sourcepath, targetpath, hash_name='md5'):
+    """Check that two files have the same hash.
+
+    Both files are read in the same pass.
+    """
+    sourcehash = new_hash(hash_name)
+    targethash = new_hash(hash_name)
+    with open(sourcepath, 'rb') as sourcefh:
         with open(targetpath, 'rb') as targetfh:
-            if md5_check:
-                targethash = hashlib.md5()
             while True:
-                buf = targetfh.read(16 * 1024)
-                if not buf:
+                sourcebuf = sourcefh.read(COPY_BUFFER_SIZE)
+                targetbuf = targetfh.read(COPY_BUFFER_SIZE)
+                if not sourcebuf and not targetbuf:
                     break
-                targethash.update(buf)
-
-        if targethash.digest() != sourcehash.digest():
-            error_template = 'ubiquity/install/copying_error/md5'
-            db.subst(error_template, 'FILE', targetpath)
-            db.input('critical', error_template)
-            db.go()
-            response = db.get(error_template)
-            if response == 'skip':
+                sourcehash.update(sourcebuf)
+                targethash.update(targetbuf)
+    return sourcehash.digest() == targethash.digest()
+
+
+class _PhaseTimer:
+    __slots__ = ('totals', 'phase', 'start')
+
+    def __init__(self, totals, phase):
+        self.totals = totals
+        self.phase = phase
+
+    def __enter__(self):
+        self.start = time.monotonic()
+
+    def __exit__(self, *exc_info):
+        self.totals[self.phase] += time.monotonic() - self.start
+
+
+class _NoTimer:
+    def __enter__(self):
+        pass
+
+    def __exit__(self, *exc_info):
+        pass
+
+
+_no_timer = _NoTimer()
+
+
+def timed(stats, phase):
+    """Time a block as part of phase, if stats is a CopyStats."""
+    if stats is None:
+        return _no_timer
+    return stats.phase(phase)
+
+
+class CopyStats:
+    """Measure how fast files are being copied, and where the time goes.
+
+    Copy workers time each phase of copying a file with phase(), and the
+    time spent on each file with add_directory_time().  These are
+    accumulated separately for each thread, so that the workers don't
+    contend for a lock.  The thread driving the copy calls add() for each
+    entry it copies.  Phase times are summed over all threads, so they can
+    add up to more than the elapsed time.
+
+    If live_path is given, a snapshot of the report is written there every
+    live_interval seconds while copying, for anyone who wants to watch.
+    """
+
+    phases = ('read', 'write', 'metadata', 'xattr', 'verify')
+
+    def __init__(self, live_path=None, live_interval=2):
+        self.live_path = live_path
+        self.live_interval = live_interval
+        self.start = time.time()
+        self.last_live = self.start
+        self.files = 0
+        self.bytes = 0
+        self.entries = 0
+        self.lock = threading.Lock()
+        self.local = threading.local()
+        self.thread_totals = []
+
+    def _totals(self):
+        try:
+            return self.local.totals
+        except AttributeError:
+            totals = (dict.fromkeys(self.phases, 0.0), {})
+            with self.lock:
+                self.thread_totals.append(totals)
+            self.local.totals = totals
+            return totals
+
+    def phase(self, phase):
+        """Return a context manager that times a block as part of phase."""
+        return _PhaseTimer(self._totals()[0], phase)
+
+    def add_directory_time(self, dirpath, seconds):
+        """Record that copying a file in dirpath took seconds."""
+        directories = self._totals()[1]
+        directories[dirpath] = directories.get(dirpath, 0.0) + seconds
+
+    def add(self, st):
+        """Record that the entry described by st has been copied."""
+        self.entries += 1
+        if stat.S_ISREG(st.st_mode):
+            self.files += 1
+            self.bytes += st.st_size
+        if self.live_path is not None:
+            now = time.time()
+            if now - self.last_live >= self.live_interval:
+                self.last_live = now
+                self.write(self.live_path)
+
+    def report(self, slowest=20):
+        """Return a summary of the statistics so far, suitable for JSON."""
+        elapsed = time.time() - self.start
+        phases = dict.fromkeys(self.phases, 0.0)
+        directories = {}
+        with self.lock:
+            thread_totals = list(self.thread_totals)
+        for thread_phases, thread_directories in thread_totals:
+            for phase, seconds in list(thread_phases.items()):
+                phases[phase] += seconds
+            for dirpath, seconds in list(thread_directories.items()):
+                directories[dirpath] = directories.get(dirpath, 0.0) + seconds
+        slowest_directories = sorted(
+            directories.items(), key=lambda item: item[1], reverse=True)
+        return {
+            'elapsed': elapsed,
+            'entries': self.entries,
+            'files': self.files,
+            'bytes': self.bytes,
+            'files_per_second': self.files / elapsed if elapsed else 0,
+            'bytes_per_second': self.bytes / elapsed if elapsed else 0,
+            'phases': phases,
+            'slowest_directories': [
+                {'path': dirpath, 'seconds': seconds}
+                for dirpath, seconds in slowest_directories[:slowest]],
+        }
+
+    def write(self, path):
+        """Write the report to path as JSON, replacing it atomically."""
+        try:
+            directory = os.path.dirname(path)
+            if not os.path.isdir(directory):
+                os.makedirs(directory)
+            with open(path + '.new', 'w') as fp:
+                json.dump(self.report(), fp, indent=2, sort_keys=True)
+            os.rename(path + '.new', path)
+        except (IOError, OSError) as e:
+            syslog.syslog(syslog.LOG_WARNING,
+                          'Failed to write copy statistics to %s: %s' %
+                          (path, e))
+
+
+class FileVerifier:
+    """Copy files and check that they arrived intact.
+
+    There are three modes:
+
+      none: copy without any checks.
+      write: if the caller has a known-good hash of the file, hash the
+        data as it is written and compare the two.  Files without one are
+        checked as in readback mode.
+      readback: after copying, flush the target to disk, drop it from the
+        page cache, and compare it with the source.  This is expensive, so
+        copy_all runs it in a BackgroundVerifier.
+
+    write is the default.  With the hashes from a copy manifest it costs
+    little more than the copy itself, and without them it is no weaker
+    than readback.
+    """
+
+    modes = ('none', 'write', 'readback')
+
+    def __init__(self, mode='write', hash_name='md5'):
+        if mode not in self.modes:
+            raise ValueError('Unknown verification mode %s' % mode)
+        self.mode = mode
+        self.hash_name = available_hash_name(hash_name)
+        # A CopyStats to record timings in, if any.
+        self.stats = None
+        # Set this if the source and target are on the same filesystem, to
+        # try sharing data blocks rather than copying them.
+        self.clone = False
+
+    @classmethod
+    def from_debconf(cls, db):
+        """Build a verifier from the ubiquity/install/verify-* settings."""
+        if db.get('ubiquity/install/md5_check') == 'false':
+            return cls('none')
+        try:
+            mode = db.get('ubiquity/install/verify-mode')
+        except debconf.DebconfError:
+            mode = ''
+        if mode not in cls.modes:
+            mode = 'write'
+        try:
+            hash_name = db.get('ubiquity/install/verify-hash')
+        except debconf.DebconfError:
+            hash_name = ''
+        return cls(mode, hash_name or 'md5')
+
+    def copy(self, sourcepath, targetpath, expected=None):
+        """Copy the contents of sourcepath to targetpath.
+
+        In write mode, return False if the data read from sourcepath does
+        not match the digest in expected.  Otherwise return True.
+        """
+        stats = self.stats
+        hashing = self.mode == 'write' and expected is not None
+        with open(sourcepath, 'rb') as sourcefh:
+            if hasattr(os, 'posix_fadvise'):
+                os.posix_fadvise(sourcefh.fileno(), 0, 0,
+                                 os.POSIX_FADV_SEQUENTIAL)
+            with open(targetpath, 'wb') as targetfh:
+                with timed(stats, 'write'):
+                    cloned = self.clone and self.clone_fd(
+                        sourcefh.fileno(), targetfh.fileno())
+                if cloned:
+                    if not hashing:
+                        return True
+                    # The target shares the source's data blocks, so this
+                    # reads the same data that copying would have.
+                    with timed(stats, 'verify'):
+                        digest = hash_file(targetpath, self.hash_name)
+                    return digest == expected
+                if not hashing:
+                    # In-kernel copies can't be split into reading and
+                    # writing, so count them all as writing.
+                    with timed(stats, 'write'):
+                        copy_fd(sourcefh.fileno(), targetfh.fileno())
+                    return True
+                sourcehash = new_hash(self.hash_name)
+                buf = bytearray(COPY_BUFFER_SIZE)
+                view = memoryview(buf)
+                while True:
+                    with timed(stats, 'read'):
+                        length = sourcefh.readinto(buf)
+                    if not length:
+                        break
+                    with timed(stats, 'write'):
+                        targetfh.write(view[:length])
+                    with timed(stats, 'verify'):
+                        sourcehash.update(view[:length])
+        return sourcehash.digest() == expected
+
+    def clone_fd(self, sourcefd, targetfd):
+        """Try to make targetfd share sourcefd's data blocks.
+
+        Return False if this file can't be cloned, in which case the
+        caller should copy it instead.  If the filesystem can't clone
+        anything at all, stop trying.
+        """
+        try:
+            fcntl.ioctl(targetfd, FICLONE, sourcefd)
+            return True
+        except OSError as e:
+            if e.errno in (errno.EOPNOTSUPP, errno.ENOTTY):
+                self.clone = False
+            elif e.errno not in (errno.EXDEV, errno.EINVAL, errno.EBADF,
+                                 errno.EPERM, errno.ETXTBSY):
+                raise
+            return False
+
+    def reads_back(self, expected=None):
+        """Return whether check reads back a file copied with expected."""
+        return (self.mode == 'readback' or
+                (self.mode == 'write' and expected is None))
+
+    def check(self, sourcepath, targetpath, flushed=False, expected=None):
+        """Read targetpath back from disk and compare it with sourcepath.
+
+        This does nothing in none mode, or in write mode if copy had the
+        digest in expected to compare with.  If flushed, the caller has
+        already flushed the target filesystem to disk.
+        """
+        if not self.reads_back(expected):
+            return True
+        with timed(self.stats, 'verify'):
+            drop_cache(targetpath, flush=not flushed)
+            return files_match(sourcepath, targetpath, self.hash_name)
+
+
+class BackgroundVerifier:
+    """Run read-back verification in a thread that lags behind the copy.
+
+    Files are queued once they have been copied.  A thread takes whatever
+    has been queued as a batch, flushes the target filesystem once for the
+    whole batch, and has a small pool read the files back and compare them
+    with their sources.  The queue is bounded, so that verification can't
+    fall arbitrarily far behind (by which time the source would have left
+    the page cache too).  Like ParallelCopier, results are returned to the
+    calling thread, and exceptions raised while verifying are re-raised
+    there.
+    """
+
+    def __init__(self, verifier, max_lag=256, workers=2):
+        self.verifier = verifier
+        self.max_lag = max_lag
+        self.workers = workers
+        self.queue = queue.Queue(maxsize=max_lag)
+        self.results = queue.Queue()
+        self.thread = threading.Thread(target=self._run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def _check(self, args):
+        try:
+            expected = getattr(args[2], 'hash', None) if args[2:] else None
+            return self.verifier.check(
+                args[0], args[1], flushed=True, expected=expected)
+        except Exception as e:
+            return e
+
+    def _run(self):
+        with concurrent.futures.ThreadPoolExecutor(
+                max_workers=self.workers) as executor:
+            finished = False
+            while not finished:
+                batch = [self.queue.get()]
+                while len(batch) < self.max_lag:
+                    try:
+                        batch.append(self.queue.get_nowait())
+                    except queue.Empty:
+                        break
+                # shutdown() queues None after everything else.
+                if batch[-1] is None:
+                    finished = True
+                    batch.pop()
+                if not batch:
+                    continue
+                try:
+                    with timed(self.verifier.stats, 'verify'):
+                        osextras.syncfs(batch[0][1])
+                except Exception as e:
+                    results = [e] * len(batch)
+                else:
+                    results = executor.map(self._check, batch)
+                for args, ok in zip(batch, results):
+                    self.results.put((args, ok))
+
+    def _harvest(self):
+        results = []
+        while True:
+            try:
+                args, ok = self.results.get_nowait()
+            except queue.Empty:
                 break
-            elif response == 'abort':
-                syslog.syslog(syslog.LOG_ERR, 'MD5 failure on %s' % targetpath)
-                sys.exit(3)
-            elif response == 'retry':
+            if isinstance(ok, Exception):
+                raise ok
+            results.append((args, ok))
+        return results
+
+    def submit(self, *args):
+        """Queue a file for verification.
+
+        The first two arguments are the source and target paths, and the
+        third, if any, is the source's stat result or manifest entry; the
+        whole argument tuple is handed back with the result.  Return a
+        list of (args, result) pairs for files that have been verified in
+        the meantime.  This blocks while the queue is full.
+        """
+        self.queue.put(args)
+        return self._harvest()
+
+    def finish(self):
+        """Wait for all queued files to be verified, returning results.
+
+        The verifier can't be used again after this.
+        """
+        self.shutdown()
+        return self._harvest()
+
+    def shutdown(self):
+        if self.thread.is_alive():
+            self.queue.put(None)
+            self.thread.join()
+
+
+def copy_file_data(sourcepath, targetpath, md5_check):
+    """Copy the contents of sourcepath to targetpath.
+
+    Return False if md5_check is set and the target does not match the
+    source afterwards, otherwise True.
+    """
+    verifier = FileVerifier('readback' if md5_check else 'none')
+    verifier.copy(sourcepath, targetpath)
+    return verifier.check(sourcepath, targetpath)
+
+
+def copy_file_error(db, targetpath):
+    """Ask what to do about a file that did not match its source.
+
+    Return True if the copy should be retried, or False if the file should
+    be skipped.  Aborting exits with code 3.
+    """
+    error_template = 'ubiquity/install/copying_error/md5'
+    db.subst(error_template, 'FILE', targetpath)
+    db.input('critical', error_template)
+    db.go()
+    response = db.get(error_template)
+    if response == 'abort':
+        syslog.syslog(syslog.LOG_ERR, 'MD5 failure on %s' % targetpath)
+        sys.exit(3)
+    return response == 'retry'
+
+
+def copy_file(db, sourcepath, targetpath, md5_check, verifier=None,
+              expected=None):
+    """Copy a file, asking what to do if it fails verification.
+
+    If verifier is None, md5_check selects between read-back MD5
+    verification and no verification at all.  expected is a known-good
+    digest of the file, if there is one.  Return True if the file was
+    copied successfully, or False if the user chose to skip it.
+    """
+    if verifier is None:
+        verifier = FileVerifier('readback' if md5_check else 'none')
+    while True:
+        if (verifier.copy(sourcepath, targetpath, expected) and
+                verifier.check(sourcepath, targetpath, expected=expected)):
+            return True
+        if not copy_file_error(db, targetpath):
+            return False
+
+
+def copy_xattrs(sourcepath, targetpath, xattrs=None):
+    """Copy extended attributes from sourcepath to targetpath.
+
+    If xattrs is not None, it is a list of (name, value) pairs already read
+    from sourcepath.
+    """
+    if (not hasattr(os, "listxattr") or
+            not hasattr(os, "supports_follow_symlinks") or
+            not os.supports_follow_symlinks):
+        return
+    try:
+        if xattrs is None:
+            xattrs = [
+                (attrname,
+                 os.getxattr(sourcepath, attrname, follow_symlinks=False))
+                for attrname in os.listxattr(
+                    sourcepath, follow_symlinks=False)]
+        for attrname, attrvalue in xattrs:
+            os.setxattr(
+                targetpath, attrname, attrvalue, follow_symlinks=False)
+    except OSError as e:
+        if e.errno not in (errno.EPERM, errno.ENOTSUP, errno.ENODATA):
+            raise
+
+
+def copy_metadata(sourcepath, targetpath, st, stats=None):
+    """Copy ownership, permissions, timestamps and extended attributes.
+
+    st may be a copy_manifest.ManifestEntry rather than a real stat result,
+    in which case the extended attributes come from the manifest too.
+    Directory timestamps are left alone, since they will change again as
+    entries are created inside them; the caller must apply those last.
+    """
+    with timed(stats, 'metadata'):
+        os.lchown(targetpath, st.st_uid, st.st_gid)
+        if not stat.S_ISLNK(st.st_mode):
+            os.chmod(targetpath, stat.S_IMODE(st.st_mode))
+        # os.utime() sets timestamp of target, not link
+        if not stat.S_ISDIR(st.st_mode) and not stat.S_ISLNK(st.st_mode):
+            try:
+                os.utime(targetpath, (st.st_atime, st.st_mtime))
+            except Exception:
+                # We can live with timestamps being wrong.
+                pass
+    with timed(stats, 'xattr'):
+        copy_xattrs(sourcepath, targetpath, getattr(st, 'xattrs', None))
+
+
+# Files up to this size are copied by copy_small_file.
+SMALL_FILE_SIZE = 64 * 1024
+
+
+def copy_small_file(sourcepath, targetpath, st, verifier, expected=None):
+    """Copy a small regular file and its metadata.
+
+    This is the fast path for the many small files in a typical system:
+    the whole file is read and written with one system call each, and
+    metadata is applied through the open target rather than by path.  The
+    caller must have removed anything in the way at targetpath.  In write
+    mode, return False if the data doesn't match the digest in expected.
+    """
+    stats = verifier.stats
+    with timed(stats, 'read'):
+        sourcefd = os.open(sourcepath, os.O_RDONLY | os.O_CLOEXEC)
+    try:
+        with timed(stats, 'read'):
+            chunks = [os.read(sourcefd, st.st_size + 1)]
+            if len(chunks[0]) > st.st_size:
+                # The file is bigger than we were told; pick up the rest.
+                while chunks[-1]:
+                    chunks.append(os.read(sourcefd, COPY_BUFFER_SIZE))
+            data = b''.join(chunks)
+        xattrs = getattr(st, 'xattrs', None)
+        if xattrs is None and hasattr(os, 'listxattr'):
+            try:
+                with timed(stats, 'xattr'):
+                    xattrs = [(name, os.getxattr(sourcefd, name))
+                              for name in os.listxattr(sourcefd)]
+            except OSError as e:
+                if e.errno not in (errno.EPERM, errno.ENOTSUP,
+                                   errno.ENODATA):
+                    raise
+                xattrs = []
+    finally:
+        os.close(sourcefd)
+
+    with timed(stats, 'write'):
+        targetfd = os.open(
+            targetpath, os.O_WRONLY | os.O_CREAT | os.O_TRUNC | os.O_CLOEXEC,
+            0o600)
+    try:
+        with timed(stats, 'write'):
+            view = memoryview(data)
+            while view:
+                view = view[os.write(targetfd, view):]
+        with timed(stats, 'metadata'):
+            os.fchown(targetfd, st.st_uid, st.st_gid)
+            os.fchmod(targetfd, stat.S_IMODE(st.st_mode))
+            try:
+                os.utime(targetfd, (st.st_atime, st.st_mtime))
+            except Exception:
+                # We can live with timestamps being wrong.
                 pass
+        try:
+            with timed(stats, 'xattr'):
+                for attrname, attrvalue in xattrs or []:
+                    os.setxattr(targetfd, attrname, attrvalue)
+        except OSError as e:
+            if e.errno not in (errno.EPERM, errno.ENOTSUP, errno.ENODATA):
+                raise
+    finally:
+        os.close(targetfd)
+
+    if verifier.mode == 'write' and expected is not None:
+        with timed(stats, 'verify'):
+            filehash = new_hash(verifier.hash_name)
+            filehash.update(data)
+            return filehash.digest() == expected
+    return True
+
+
+# Devices whose filesystems don't support FIEMAP.
+_no_fiemap_devices = set()
+
+
+def read_position(sourcepath, st):
+    """Return a sort key for where the data of sourcepath lives on disk.
+
+    Manifest entries may know this already.  Otherwise, use FIEMAP where the
+    filesystem supports it, and the inode number where it doesn't: squashfs
+    numbers inodes in the order in which it lays out their data.
+    """
+    position = getattr(st, 'position', None)
+    if position is not None:
+        return position
+    if st.st_dev not in _no_fiemap_devices:
+        try:
+            fd = os.open(sourcepath, os.O_RDONLY)
+        except OSError:
+            return st.st_ino
+        try:
+            offset = osextras.physical_offset(fd)
+            if offset is not None:
+                return offset
+        except OSError:
+            _no_fiemap_devices.add(st.st_dev)
+        finally:
+            os.close(fd)
+    return st.st_ino
+
+
+class ReadOrderer:
+    """Reorder file copies so that their sources are read in disk order.
+
+    Reading files in os.walk() order makes the source device seek back and
+    forth, which is slow on USB sticks and DVDs, and makes squashfs
+    decompress the same blocks repeatedly.  Files are held in a window and
+    released in order of read_position() each time it fills up.
+    """
+
+    def __init__(self, window=8192):
+        self.window = window
+        self.pending = []
+
+    def add(self, sourcepath, targetpath, st):
+        """Add a file to the window.
+
+        Return a list of (sourcepath, targetpath, st) tuples, in read order,
+        that should be copied now; this is empty until the window is full.
+        """
+        self.pending.append(
+            (read_position(sourcepath, st), len(self.pending),
+             (sourcepath, targetpath, st)))
+        if len(self.pending) >= self.window:
+            return self.flush()
+        return []
+
+    def flush(self):
+        """Return everything left in the window, in read order."""
+        self.pending.sort()
+        ordered = [item[2] for item in self.pending]
+        self.pending = []
+        return ordered
+
+
+def default_copy_workers():
+    """Pick a number of file copy threads suitable for this system.
+
+    Copying is mostly bound by per-file system call latency rather than by
+    CPU, so it pays to have a few more threads than CPUs.
+    """
+    return min(32, (os.cpu_count() or 1) + 4)
+
+
+class ParallelCopier:
+    """Run file copies on a bounded pool of worker threads.
+
+    Only the copies themselves run in the workers.  Callers are expected to
+    create directories, symlinks and device nodes themselves, in dependency
+    order, before submitting any files that live inside them, and to do all
+    their debconf communication from the calling thread.  Results come back
+    to the calling thread from submit() and finish(); exceptions raised by a
+    worker are re-raised there.
+    """
+
+    def __init__(self, copy_func, workers):
+        self.copy_func = copy_func
+        self.executor = concurrent.futures.ThreadPoolExecutor(
+            max_workers=workers)
+        # Bound the number of queued copies so that we don't end up
+        # holding the whole file list in memory.
+        self.max_pending = workers * 4
+        self.pending = {}
+
+    def _harvest(self, done):
+        results = []
+        for future in done:
+            args = self.pending.pop(future)
+            results.append((args, future.result()))
+        return results
+
+    def submit(self, *args):
+        """Queue a copy.
+
+        Return a list of (args, result) pairs for copies that have
+        completed in the meantime.  This blocks while the queue is full.
+        """
+        results = []
+        if len(self.pending) >= self.max_pending:
+            done, _ = concurrent.futures.wait(
+                self.pending,
+                return_when=concurrent.futures.FIRST_COMPLETED)
+            results = self._harvest(done)
+        future = self.executor.submit(self.copy_func, *args)
+        self.pending[future] = args
+        return results
+
+    def finish(self):
+        """Wait for all queued copies, returning their results."""
+        done, _ = concurrent.futures.wait(self.pending)
+        return self._harvest(done)
+
+    def shutdown(self):
+        for future in self.pending:
+            future.cancel()
+        self.executor.shutdown(wait=True)
+        self.pending = {}
+
+
+IMAGE_BLOCK_SIZE = 4 * 1024 * 1024
+IMAGE_ALIGNMENT = 4096
+# _IO(0x12, 127) from <linux/fs.h>
+BLKZEROOUT = 0x127f
+
+
+def image_data_extents(fd, size, alignment=IMAGE_ALIGNMENT):
+    """Return a list of (offset, length) pairs covering the data in fd.
+
+    Holes in sparse files are found with SEEK_DATA and SEEK_HOLE where
+    possible; otherwise the whole file counts as data.  Extents are widened
+    to multiples of alignment, and adjacent extents are merged.
+    """
+    if not hasattr(os, 'SEEK_DATA'):
+        return [(0, size)] if size else []
+    extents = []
+    offset = 0
+    while offset < size:
+        try:
+            start = os.lseek(fd, offset, os.SEEK_DATA)
+        except OSError as e:
+            if e.errno == errno.ENXIO:
+                # No more data.
+                break
+            if e.errno == errno.EINVAL:
+                # The filesystem doesn't support SEEK_DATA.
+                return [(0, size)] if size else []
+            raise
+        end = os.lseek(fd, start, os.SEEK_HOLE)
+        start -= start % alignment
+        end = min(size, end + (-end % alignment))
+        if extents and start <= extents[-1][0] + extents[-1][1]:
+            last_start = extents[-1][0]
+            extents[-1] = (last_start, end - last_start)
         else:
-            break
+            extents.append((start, end - start))
+        offset = end
+    return extents
+
+
+def zero_range(fd, offset, length):
+    """Make length bytes at offset in fd read back as zeroes.
+
+    Block devices are asked to do this themselves with BLKZEROOUT, which
+    uses write-zeroes or discard only where the device guarantees that
+    discarded blocks read back as zeroes.  Anything else, or a range the
+    ioctl can't handle, gets zeroes written.
+    """
+    if not (offset % 512 or length % 512):
+        try:
+            fcntl.ioctl(fd, BLKZEROOUT, struct.pack('QQ', offset, length))
+            return
+        except OSError as e:
+            if e.errno not in (errno.ENOTTY, errno.EINVAL, errno.EOPNOTSUPP):
+                raise
+    zeroes = memoryview(bytes(min(IMAGE_BLOCK_SIZE, length)))
+    end = offset + length
+    while offset < end:
+        offset += os.pwrite(fd, zeroes[:end - offset], offset)
+
+
+def stream_image(imagepath, devicepath, progress=None):
+    """Write a raw or sparse filesystem image to a block device.
+
+    The data in the image is written in large aligned chunks.  Holes are
+    zeroed on the device with zero_range rather than copied, since
+    filesystems made with lazy initialisation (or by e2image -r) rely on
+    them reading back as zeroes.  If progress is given, it is called with
+    the size of each chunk of data as it is written.  Return the total
+    number of bytes of data written.
+    """
+    written = 0
+    imagefd = os.open(imagepath, os.O_RDONLY)
+    try:
+        devicefd = os.open(devicepath, os.O_WRONLY)
+        try:
+            size = os.fstat(imagefd).st_size
+            hole_start = 0
+            for offset, length in image_data_extents(imagefd, size):
+                if offset > hole_start:
+                    zero_range(devicefd, hole_start, offset - hole_start)
+                end = offset + length
+                hole_start = end
+                while offset < end:
+                    buf = os.pread(
+                        imagefd, min(IMAGE_BLOCK_SIZE, end - offset), offset)
+                    if not buf:
+                        break
+                    view = memoryview(buf)
+                    while view:
+                        count = os.pwrite(devicefd, view, offset)
+                        view = view[count:]
+                        offset += count
+                        written += count
+                    if progress is not None:
+                        progress(len(buf))
+            if size > hole_start:
+                zero_range(devicefd, hole_start, size - hole_start)
+            os.fsync(devicefd)
+        finally:
+            os.close(devicefd)
+    finally:
+        os.close(imagefd)
+    return written
+
+
+def block_device_size(devicepath):
+    """Return the size of a block device (or file) in bytes."""
+    fd = os.open(devicepath, os.O_RDONLY)
+    try:
+        return os.lseek(fd, 0, os.SEEK_END)
+    finally:
+        os.close(fd)
+
+
+def filesystem_id(path):
+    """Return something that identifies the filesystem containing path."""
+    st = os.stat(path)
+    # f_fsid is only available from Python 3.7.
+    return [st.st_dev, getattr(os.statvfs(path), 'f_fsid', None)]
+
+
+class CopyJournal:
+    """Keep track of copied files, so that an interrupted copy can resume.
+
+    The journal is a file of JSON lines.  The first line identifies the
+    source and target filesystems, and each subsequent line records a
+    regular file that has been copied (and verified, if verification is
+    enabled), with its hash if we know it.  Lines are only ever appended, so
+    the worst that can happen if we die part-way through is that the last
+    few files are copied again.
+    """
+
+    def __init__(self, path, source, target):
+        self.path = path
+        self.header = {
+            'source': filesystem_id(source),
+            'target': filesystem_id(target),
+        }
+        self.done = self._load()
+        self.fp = None
+
+    def _load(self):
+        done = {}
+        try:
+            fp = open(self.path)
+        except IOError as e:
+            if e.errno != errno.ENOENT:
+                raise
+            return done
+        with fp:
+            try:
+                if json.loads(fp.readline()) != self.header:
+                    # This journal is for some other copy.
+                    return done
+                for line in fp:
+                    record = json.loads(line)
+                    done[record['path']] = record
+            except (ValueError, KeyError, TypeError):
+                # Probably a partly-written last line.
+                pass
+        return done
+
+    def is_done(self, relpath, st, targetpath):
+        """Has relpath already been copied to targetpath?"""
+        record = self.done.get(relpath)
+        if (record is None or record['size'] != st.st_size or
+                record['mtime'] != st.st_mtime):
+            return False
+        try:
+            st_target = os.lstat(targetpath)
+        except OSError:
+            return False
+        return (stat.S_ISREG(st_target.st_mode) and
+                st_target.st_size == st.st_size)
+
+    def record(self, relpath, st):
+        """Record that relpath has been copied."""
+        if self.fp is None:
+            if self.done:
+                # Carry on from the existing journal.
+                self.fp = open(self.path, 'a')
+            else:
+                self.fp = open(self.path, 'w')
+                self.fp.write(json.dumps(self.header) + '\n')
+        filehash = getattr(st, 'hash', None)
+        self.fp.write(json.dumps({
+            'path': relpath,
+            'size': st.st_size,
+            'mtime': st.st_mtime,
+            'hash': filehash.hex() if filehash is not None else None,
+        }) + '\n')
+
+    def close(self):
+        if self.fp is not None:
+            self.fp.close()
+            self.fp = None
+
+    def remove(self):
+        """The copy is complete, so the journal is no longer needed."""
+        self.close()
+        osextras.unlink_force(self.path)
+        self.done = {}
+
+
+# Pythons whose standard library install.py byte-compiled during the copy,
+# one per line.
+PYTHON_STDLIB_COMPILED = '/var/lib/ubiquity/python-stdlib-compiled'
+
+
+def python_stdlib_compiled():
+    """Return the Pythons whose standard library was compiled early."""
+    try:
+        with open(PYTHON_STDLIB_COMPILED) as compiled:
+            return set(compiled.read().split())
+    except IOError:
+        return set()
+
+
+class SubtreeWatcher:
+    """Notice when subtrees of the target have been completely copied.
+
+    The copy walks the source in os.walk() order, so once it has moved on
+    from a directory it never comes back to it.  Regular files are written
+    by worker threads some time after the walk reaches them, though, so a
+    subtree is only complete once the walk has left it and every file in
+    it that was handed to the workers has been written.  Callers report
+    each entry with walked(), each file with submitted() when it is handed
+    to the workers and copied() once it has been written, and finish() at
+    the end.  Callbacks registered with watch() are called (in the
+    caller's thread) as soon as all the subtrees they asked for are
+    complete.
+    """
+
+    def __init__(self):
+        self.pending = {}
+        self.entered = set()
+        self.left = set()
+        self.complete = set()
+        self.watches = []
+
+    def watch(self, paths, callback):
+        """Call callback once all of paths have been copied.
+
+        paths are relative to the target.  A path that the copy never
+        enters (because it is empty, say, or entirely blacklisted) is only
+        treated as complete once finish() is called.
+        """
+        paths = [path.strip('/') for path in paths]
+        for path in paths:
+            self.pending.setdefault(path, 0)
+        self.watches.append((paths, callback))
+
+    def _containing(self, relpath):
+        return [path for path in self.pending
+                if path not in self.complete and
+                relpath.startswith(path + '/')]
+
+    def walked(self, relpath):
+        """Note that the walk has reached relpath."""
+        if not self.watches:
+            return
+        containing = self._containing(relpath)
+        self.entered.update(containing)
+        left = self.entered.difference(containing, self.left)
+        if left:
+            self.left.update(left)
+            self._check()
+
+    def submitted(self, relpath):
+        """Note that the file at relpath will be reported to copied()."""
+        if not self.watches:
+            return
+        for path in self._containing(relpath):
+            self.pending[path] += 1
+
+    def copied(self, relpath):
+        """Note that the file at relpath has been written."""
+        if not self.watches:
+            return
+        for path in self._containing(relpath):
+            self.pending[path] -= 1
+            if path in self.left and not self.pending[path]:
+                self._check()
+
+    def finish(self):
+        """Note that the walk is over and every file has been written."""
+        self.left.update(self.pending)
+        self._check()
+
+    def _check(self):
+        self.complete.update(
+            path for path in self.left if not self.pending[path])
+        for watch in list(self.watches):
+            paths, callback = watch
+            if self.complete.issuperset(paths):
+                self.watches.remove(watch)
+                callback()
+
+
+class CopyProgress:
+    """Report file copying progress using debconf.
+
+    We sample progress every half-second (assuming time.time() gives us
+    sufficiently good granularity) and use the average of progress over the
+    last minute or so to decide how much time remains. We don't bother
+    displaying any progress for the first ten seconds in order to allow
+    things to settle down, and we only update the "time remaining"
+    indicator at most every two seconds after that.
+    """
+
+    def __init__(self, db, total_size):
+        self.db = db
+        self.total_size = total_size
+        self.copy_progress = 0
+        self.copied_size = 0
+        time_start = time.time()
+        self.times = [(time_start, self.copied_size)]
+        self.long_enough = False
+        self.time_last_update = time_start
+
+    def add(self, size):
+        """Record that another size bytes have been copied."""
+        self.copied_size += size
+        copied_size = self.copied_size
+        total_size = self.total_size
+        times = self.times
+
+        if int((copied_size * 90) / total_size) != self.copy_progress:
+            self.copy_progress = int((copied_size * 90) / total_size)
+            self.db.progress('SET', 10 + self.copy_progress)
+
+        time_now = time.time()
+        if (time_now - times[-1][0]) >= 0.5:
+            times.append((time_now, copied_size))
+            if not self.long_enough and time_now - times[0][0] >= 10:
+                self.long_enough = True
+            if self.long_enough and time_now - self.time_last_update >= 2:
+                self.time_last_update = time_now
+                while (time_now - times[0][0] > 60 and
+                       time_now - times[1][0] >= 60):
+                    times.pop(0)
+                speed = ((times[-1][1] - times[0][1]) /
+                         (times[-1][0] - times[0][0]))
+                if speed != 0:
+                    time_remaining = int((total_size - copied_size) / speed)
+                    if time_remaining < 60:
+                        self.db.progress(
+                            'INFO', 'ubiquity/install/copying_minute')
+
+
+def apt_state():
+    """Return something that changes whenever apt's view of the world does.
+
+    That is, whenever dpkg's status file, the package lists, or the list
+    of sources changes.
+    """
+    config = apt_pkg.config
+    paths = (config.find_file('Dir::State::status'),
+             config.find_dir('Dir::State::Lists'),
+             config.find_file('Dir::Etc::sourcelist'),
+             config.find_dir('Dir::Etc::sourceparts'),
+             config.find_file('Dir::Etc::preferences'),
+             config.find_dir('Dir::Etc::preferencesparts'))
+    state = []
+    for path in paths:
+        try:
+            st = os.stat(path)
+        except OSError:
+            state.append((path, None))
+        else:
+            state.append((path, st.st_ino, st.st_size, st.st_mtime_ns))
+    return state
+
+
+def restricted_packages(cache):
+    """Return the set of installed packages from the restricted component."""
+    restricted = set()
+    for pkg in cache._cache.packages:
+        # Package.section is deprecated, and often empty.
+        version = pkg.current_ver
+        if (version is not None and version.section and
+                version.section.startswith('restricted/')):
+            restricted.add(_package_name(pkg))
+    return restricted
+
+
+class DownloadVerifier:
+    """Check downloaded archives against the versions we meant to get.
+
+    Archives are hashed on a pool of worker threads as they are submitted,
+    so that they can be checked while apt is still fetching the rest.
+    """
+
+    def __init__(self, cache, workers=None):
+        # (name, version, architecture) -> expected SHA256, for everything
+        # that's going to be installed
+        self.expected = {}
+        for pkg in cache.get_changes():
+            ver = pkg.candidate
+            if pkg.marked_delete or ver is None:
+                continue
+            self.expected[(pkg.shortname, ver.version, ver.architecture)] = (
+                ver.sha256)
+        self.executor = concurrent.futures.ThreadPoolExecutor(
+            max_workers=workers or default_copy_workers())
+        self.futures = {}
+
+    def _expected_sha256(self, destfile):
+        # apt names archives name_version_arch.deb, quoting any
+        # underscores or colons in each part.
+        name, version, arch = os.path.basename(destfile).split('_')
+        key = (urllib.parse.unquote(name), urllib.parse.unquote(version),
+               urllib.parse.unquote(arch.split('.')[0]))
+        return self.expected[key]
+
+    def verify(self, destfile, filesize):
+        with open(destfile, 'rb') as fp:
+            st = os.fstat(fp.fileno())
+            if st.st_size != filesize:
+                osextras.unlink_force(destfile)
+                raise IOError(
+                    "%s size mismatch: %ld != %ld" %
+                    (destfile, st.st_size, filesize))
+
+            # If we fail to find a version, it's entirely possible it's a
+            # programming error and not a download error, so skip
+            # verification in such cases rather than failing.
+            try:
+                expected = self._expected_sha256(destfile)
+            except (KeyError, ValueError) as e:
+                syslog.syslog(
+                    'Failed to find package object for %s: %s' %
+                    (destfile, e))
+                return None
+            if expected is None:
+                return None
+
+            sha256 = hashlib.sha256()
+            for chunk in iter(lambda: fp.read(COPY_BUFFER_SIZE), b''):
+                sha256.update(chunk)
+            if sha256.hexdigest() != expected:
+                osextras.unlink_force(destfile)
+                raise IOError(
+                    "%s SHA256 checksum mismatch: %s != %s" %
+                    (destfile, sha256.hexdigest(), expected))
+            return expected
+
+    def submit(self, destfile, filesize):
+        """Start checking destfile, unless it's already being checked."""
+        if destfile not in self.futures:
+            self.futures[destfile] = self.executor.submit(
+                self.verify, destfile, filesize)
+
+    def finish(self, items):
+        """Check all of items, which are apt_pkg.AcquireItems.
+
+        Raise IOError if any of them don't match what was expected.
+        Otherwise, return a dictionary mapping the archives whose SHA256
+        was checked to that SHA256.
+        """
+        verified = {}
+        try:
+            for item in items:
+                self.submit(item.destfile, item.filesize)
+            for destfile, future in self.futures.items():
+                sha256 = future.result()
+                if sha256 is not None:
+                    verified[destfile] = sha256
+        finally:
+            self.executor.shutdown()
+        return verified
+
+
+def _apt_quote(string, bad):
+    # Quote string the way apt's QuoteString does.
+    return ''.join(
+        '%%%02x' % ord(c)
+        if c in bad or c == '%' or ord(c) <= 0x20 or ord(c) >= 0x7f else c
+        for c in string)
+
+
+def planned_archives(cache):
+    """Return the archives that committing cache would need.
+
+    The result maps the name apt will give each archive in its archive
+    directory to the archive's expected SHA256, which may be None.
+    """
+    archives = {}
+    for pkg in cache.get_changes():
+        ver = pkg.candidate
+        if pkg.marked_delete or ver is None:
+            continue
+        extension = os.path.splitext(ver.filename)[1] or '.deb'
+        name = '%s_%s_%s%s' % (
+            _apt_quote(pkg.shortname, '_:'), _apt_quote(ver.version, '_:'),
+            _apt_quote(ver.architecture, '_:.'), extension)
+        archives[name] = ver.sha256
+    return archives
+
+
+def _copy_checked(source, target, sha256):
+    # Copy source to target, checking its SHA256 on the way.  Return False,
+    # leaving nothing behind, if it doesn't match.
+    filehash = hashlib.sha256()
+    with open(source, 'rb') as sourcefh:
+        try:
+            with open(target + '.new', 'wb') as targetfh:
+                for chunk in iter(lambda: sourcefh.read(COPY_BUFFER_SIZE),
+                                  b''):
+                    filehash.update(chunk)
+                    targetfh.write(chunk)
+        except OSError:
+            osextras.unlink_force(target + '.new')
+            raise
+    if filehash.hexdigest() != sha256:
+        osextras.unlink_force(target + '.new')
+        return False
+    os.rename(target + '.new', target)
+    return True
+
+
+class PackagePool:
+    """A local store of package archives, named by their SHA256.
+
+    Archives are kept as <pool>/<first two digits>/<SHA256>.deb, so that
+    repeated installations can take packages from here rather than
+    downloading them again.  The pool is only ever a cache: failing to
+    read from it or add to it is logged and otherwise ignored, and
+    anything taken from it is checked against the SHA256 that apt expects.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        os.makedirs(path, exist_ok=True)
+
+    def _path(self, sha256):
+        return os.path.join(self.path, sha256[:2], '%s.deb' % sha256)
+
+    def fill_archives(self, planned, archive_dir):
+        """Put archives that are in the pool into archive_dir.
+
+        planned is as returned by planned_archives.  Return the number of
+        archives filled in.
+        """
+        filled = 0
+        for name, sha256 in sorted(planned.items()):
+            target = os.path.join(archive_dir, name)
+            if not sha256 or os.path.exists(target):
+                continue
+            source = self._path(sha256)
+            try:
+                if _copy_checked(source, target, sha256):
+                    filled += 1
+                else:
+                    syslog.syslog(
+                        'Removing corrupt %s from package pool' % source)
+                    osextras.unlink_force(source)
+            except FileNotFoundError:
+                continue
+            except OSError as e:
+                syslog.syslog('Failed to copy %s from package pool: %s' %
+                              (source, e))
+        return filled
+
+    def add(self, path, sha256):
+        """Add the archive at path, which has the given SHA256."""
+        target = self._path(sha256)
+        if os.path.exists(target):
+            return
+        try:
+            os.makedirs(os.path.dirname(target), exist_ok=True)
+            if not _copy_checked(path, target, sha256):
+                syslog.syslog('Not adding %s to package pool: SHA256 '
+                              'checksum mismatch' % path)
+        except OSError as e:
+            syslog.syslog('Failed to add %s to package pool: %s' % (path, e))
+
+    def add_archives(self, planned, archive_dir):
+        """Add planned archives that have been fetched to archive_dir."""
+        for name, sha256 in sorted(planned.items()):
+            path = os.path.join(archive_dir, name)
+            if sha256 and os.path.exists(path):
+                self.add(path, sha256)
+
+
+class Step:
+    """One step of the installation, and what it needs to itself.
+
+    resources names the things the step uses that other steps might also
+    use: 'debconf' for the debconf connection, 'apt' for the apt cache and
+    dpkg database, 'chroot' for the target's chroot mounts, and absolute
+    paths for files or directories in the target that it changes.  A path
+    conflicts with any path beneath it, so '/' conflicts with all paths.
+
+    Steps that use debconf run in order on the main thread, after moving
+    on to a new progress region of size region and showing info if given.
+    Other steps may run on worker threads, and so must not touch debconf
+    at all.  A step with barrier set waits for every earlier step first.
+    """
+
+    def __init__(self, name, func, resources=(), after=(), region=0,
+                 info=None, barrier=False):
+        self.name = name
+        self.func = func
+        self.resources = frozenset(resources)
+        self.after = frozenset(after)
+        self.region = region
+        self.info = info
+        self.barrier = barrier
+        if not self.foreground and (region or info):
+            raise ValueError(
+                'Step %s reports progress but does not use debconf' % name)
+
+    @property
+    def foreground(self):
+        return 'debconf' in self.resources
+
+    def conflicts(self, other):
+        """Can this step not run at the same time as other?"""
+        for resource in self.resources:
+            for other_resource in other.resources:
+                if resource == other_resource:
+                    return True
+                if resource.startswith('/') and other_resource.startswith('/'):
+                    first, second = sorted((resource.rstrip('/') + '/',
+                                            other_resource.rstrip('/') + '/'))
+                    if second.startswith(first):
+                        return True
+        return False
+
+
+class StepScheduler:
+    """Run Steps, overlapping those that don't conflict.
+
+    Steps are started in the order given.  Each waits for the earlier
+    steps that it conflicts with or names in its after set, then either
+    runs on the main thread (if it uses debconf) or is handed to a worker
+    thread while the main thread carries on to the next step.  An
+    exception from any step is raised once all running steps have
+    finished.
+    """
+
+    def __init__(self, install, steps, workers=4):
+        self.install = install
+        self.steps = list(steps)
+        self.workers = workers
+
+    def run(self):
+        running = []
+
+        def wait(step, future):
+            running.remove((step, future))
+            future.result()
+
+        with concurrent.futures.ThreadPoolExecutor(
+                max_workers=self.workers) as executor:
+            try:
+                for step in self.steps:
+                    for other, future in list(running):
+                        if future.done():
+                            wait(other, future)
+                        elif (step.barrier or other.name in step.after or
+                              step.conflicts(other)):
+                            wait(other, future)
+                    if step.foreground:
+                        if step.region:
+                            self.install.next_region(size=step.region)
+                        if step.info is not None:
+                            self.install.db.progress('INFO', step.info)
+                        step.func()
+                    else:
+                        running.append((step, executor.submit(step.func)))
+            finally:
+                # Don't leave anything still working on the target, even
+                # if something failed.
+                concurrent.futures.wait(
+                    [future for _, future in running])
+            for step, future in list(running):
+                wait(step, future)
+
+
+class InstallPlan:
+    """Package installations and removals to be made in one go.
+
+    Each separate commit sets up the target chroot and runs dpkg (and so
+    every trigger) again, so changes that don't depend on each other are
+    better collected here and committed together with
+    InstallBase.commit_plan.
+    """
+
+    def __init__(self):
+        self.to_install = []
+        self.to_remove = set()
+        self.to_remove_recursive = set()
+        # Show language pack progress messages?
+        self.langpacks = False
+
+    def __bool__(self):
+        return bool(self.to_install or self.to_remove or
+                    self.to_remove_recursive)
+
+    def install(self, pkgs, langpacks=False):
+        """Install pkgs, even if they're due to be removed."""
+        for pkg in pkgs:
+            if pkg not in self.to_install:
+                self.to_install.append(pkg)
+        self.to_remove.difference_update(pkgs)
+        self.to_remove_recursive.difference_update(pkgs)
+        self.langpacks = self.langpacks or langpacks
+
+    def remove(self, pkgs, recursive=False):
+        """Remove pkgs, unless they're due to be installed."""
+        pkgs = set(pkgs).difference(self.to_install)
+        if recursive:
+            self.to_remove_recursive |= pkgs
+        else:
+            self.to_remove |= pkgs
 
 
 class InstallBase:
+    _cache = None
+    _cache_key = None
+    _cache_state = None
+
     def __init__(self):
         self.target = '/target'
         self.casper_path = os.path.join(
@@ -798,6 +2918,74 @@ class InstallBase:
     def target_file(self, *args):
         return os.path.join(self.target, *args)
 
+    def get_cache(self):
+        """Return an apt cache with no packages marked for changes.
+
+        Opening a cache means parsing all the package lists, so the cache
+        is kept and handed out again to later callers.  It is reopened
+        only if apt has been pointed at a different root or if apt_state
+        says something has changed since it was opened.  Callers must not
+        close it, and must be done with it before calling this again.
+        """
+        key = (apt_pkg.config.find('Dir'),
+               apt_pkg.config.find_file('Dir::State::status'))
+        state = apt_state()
+        if self._cache is None or key != self._cache_key:
+            self._cache = Cache()
+        elif state != self._cache_state:
+            self._cache.open(None)
+        else:
+            self._cache.clear()
+        self._cache_key = key
+        self._cache_state = state
+        return self._cache
+
+    def clear_cache(self):
+        """Forget the cache kept by get_cache."""
+        self._cache = None
+        self._cache_key = None
+        self._cache_state = None
+
+    def existing_files(self, top, suffix):
+        """Return the paths under top in the target ending with suffix.
+
+        Paths are relative to the target.  This lets callers check lots of
+        paths against one directory walk, rather than stat each of them.
+        """
+        found = set()
+        root = self.target_file(top.lstrip('/'))
+        for dirpath, _, filenames in os.walk(root):
+            reldir = os.path.join(
+                '/', os.path.relpath(dirpath, self.target_file('')))
+            for name in filenames:
+                if name.endswith(suffix):
+                    found.add(os.path.join(reldir, name))
+        return found
+
+    def python_stdlib_batches(self, index, batches, exclude=(), done=()):
+        """Yield (python, files) for standard library modules to compile.
+
+        index is a DpkgPathIndex for the target.  Each installed Python's
+        uncompiled modules, less any in exclude, are split into at most
+        batches lists of files, suitable for handing to separate
+        py_compile.py processes.  Pythons named in done are skipped.
+        """
+        re_minimal = re.compile('^python\\d+\\.\\d+-minimal$')
+        pythons = sorted(
+            pkg[:-len('-minimal')] for pkg in index.lists
+            if re_minimal.match(pkg))
+        for python in pythons:
+            if python in done:
+                continue
+            re_file = re.compile('^/usr/lib/%s/.*\\.py$' % python)
+            compiled = self.existing_files('/usr/lib/%s' % python, '.pyc')
+            files = [
+                f for f in sorted(index.files(['%s-minimal' % python, python]))
+                if re_file.match(f) and '%sc' % f not in compiled and
+                f not in exclude]
+            for i in range(min(batches, len(files))):
+                yield python, files[i::batches]
+
     def warn_broken_packages(self, pkgs, err):
         pkgs = ', '.join(pkgs)
         syslog.syslog('broken packages after installation: %s' % pkgs)
@@ -826,6 +3014,20 @@ class InstallBase:
                              'ubiquity/install/title')
             self.db.progress('SET', self.prev_count)
 
+    def package_pool(self):
+        """Return the PackagePool configured by preseeding, if any."""
+        try:
+            path = self.db.get('ubiquity/install/package-pool')
+        except debconf.DebconfError:
+            return None
+        if not path:
+            return None
+        try:
+            return PackagePool(path)
+        except OSError as e:
+            syslog.syslog('Not using package pool %s: %s' % (path, e))
+            return None
+
     def commit_with_verify(self, cache, fetch_progress, install_progress):
         # Hack around occasional undetected download errors in apt by doing
         # our own verification pass at the end.  See
@@ -833,57 +3035,33 @@ class InstallBase:
         # clone-and-hacking most of cache.commit ...
         pm = apt_pkg.PackageManager(cache._depcache)
         fetcher = apt_pkg.Acquire(fetch_progress)
+        pool = self.package_pool()
+        if pool is not None:
+            pool.fill_archives(
+                planned_archives(cache),
+                apt_pkg.config.find_dir('Dir::Cache::Archives'))
         while True:
-            # fetch archives first
-            res = cache._fetch_archives(fetcher, pm)
+            # Fetch archives, checking each one as it arrives.
+            verifier = DownloadVerifier(cache)
+            if isinstance(fetch_progress, DebconfAcquireProgress):
+                fetch_progress.verifier = verifier
+            try:
+                res = cache._fetch_archives(fetcher, pm)
+            except BaseException:
+                verifier.executor.shutdown()
+                raise
+            finally:
+                if isinstance(fetch_progress, DebconfAcquireProgress):
+                    fetch_progress.verifier = None
 
-            # manually verify all the downloads
+            # Wait for verification to finish, and check anything that
+            # wasn't already checked as it arrived.
             syslog.syslog('Verifying downloads ...')
-            for item in fetcher.items:
-                with open(item.destfile, 'rb') as destfile:
-                    st = os.fstat(destfile.fileno())
-                    if st.st_size != item.filesize:
-                        osextras.unlink_force(item.destfile)
-                        raise IOError(
-                            "%s size mismatch: %ld != %ld" %
-                            (item.destfile, st.st_size, item.filesize))
-
-                    # Mapping back to the package object is an utter pain.
-                    # If we fail to find one, it's entirely possible it's a
-                    # programming error and not a download error, so skip
-                    # verification in such cases rather than failing.
-                    destfile_base = os.path.basename(item.destfile)
-                    try:
-                        name, version, arch = destfile_base.split('_')
-                        version = version.replace('%3a', ':')
-                        arch = arch.split('.')[0]
-                        if arch == 'all':
-                            fullname = name
-                        else:
-                            fullname = '%s:%s' % (name, arch)
-                            # This syntax only works on systems configured
-                            # for multiarch, so check and fall back to the
-                            # single-architecture syntax.
-                            if fullname not in cache:
-                                fullname = name
-                        candidate = cache[fullname].versions[version]
-                    except (KeyError, ValueError) as e:
-                        syslog.syslog(
-                            'Failed to find package object for %s: %s' %
-                            (item.destfile, e))
-                        continue
-
-                    if candidate.sha256 is not None:
-                        sha256 = hashlib.sha256()
-                        for chunk in iter(lambda: destfile.read(16384), b''):
-                            sha256.update(chunk)
-                        if sha256.hexdigest() != candidate.sha256:
-                            osextras.unlink_force(item.destfile)
-                            raise IOError(
-                                "%s SHA256 checksum mismatch: %s != %s" %
-                                (item.destfile, sha256.hexdigest(),
-                                 candidate.sha256))
+            verified = verifier.finish(fetcher.items)
             syslog.syslog('Downloads verified successfully')
+            if pool is not None:
+                for destfile, sha256 in verified.items():
+                    pool.add(destfile, sha256)
 
             # then install
             res = cache.install_archives(pm, install_progress)
@@ -901,13 +3079,44 @@ class InstallBase:
         return (res == pm.RESULT_COMPLETED)
 
     def do_install(self, to_install, langpacks=False):
+        plan = InstallPlan()
+        plan.install(to_install, langpacks=langpacks)
+        self.commit_plan(plan)
+
+    def warn_broken_removal(self, pkgs, err):
+        pkgs = ', '.join(pkgs)
+        syslog.syslog('broken packages after removal: %s' % pkgs)
+        self.db.subst('ubiquity/install/broken_remove', 'ERROR', err)
+        self.db.subst('ubiquity/install/broken_remove', 'PACKAGES', pkgs)
+        self.db.input('critical', 'ubiquity/install/broken_remove')
+        self.db.go()
+
+    def _mark_removals(self, cache, plan):
+        if plan.to_remove or plan.to_remove_recursive:
+            graph = DependencyGraph(cache)
+            get_remove_list(cache, plan.to_remove, graph=graph)
+            get_remove_list(cache, plan.to_remove_recursive,
+                            recursive=True, graph=graph)
+
+    def commit_plan(self, plan):
+        """Make all the changes in plan, an InstallPlan, in one dpkg run.
+
+        If the packages to install can't be installed, the removals are
+        still made on their own, and then the InstallStepError is raised.
+        """
         self.nested_progress_start()
 
-        if langpacks:
-            self.db.progress('START', 0, 10, 'ubiquity/langpacks/title')
+        to_install = plan.to_install
+        # Removals alone have always reported progress in a smaller range.
+        end = 10 if to_install else 5
+        if plan.langpacks:
+            self.db.progress('START', 0, end, 'ubiquity/langpacks/title')
+        else:
+            self.db.progress('START', 0, end, 'ubiquity/install/title')
+        if to_install:
+            self.db.progress('INFO', 'ubiquity/install/find_installables')
         else:
-            self.db.progress('START', 0, 10, 'ubiquity/install/title')
-        self.db.progress('INFO', 'ubiquity/install/find_installables')
+            self.db.progress('INFO', 'ubiquity/install/find_removables')
 
         self.progress_region(0, 1)
         fetchprogress = DebconfAcquireProgress(
@@ -915,74 +3124,103 @@ class InstallBase:
             'ubiquity/install/apt_indices_starting',
             'ubiquity/install/apt_indices')
 
-        with Cache() as cache:
-
-            if cache._depcache.broken_count > 0:
-                syslog.syslog(
-                    'not installing additional packages, since there are'
-                    ' broken packages: %s' % ', '.join(broken_packages(cache)))
-                self.db.progress('STOP')
-                self.nested_progress_end()
-                return
+        cache = self.get_cache()
+        if cache._depcache.broken_count > 0:
+            syslog.syslog(
+                'not changing packages, since there are broken packages: %s' %
+                ', '.join(broken_packages(cache)))
+            self.db.progress('STOP')
+            self.nested_progress_end()
+            return
 
-            with cache.actiongroup():
+        install_error = None
+        with cache.actiongroup():
+            self._mark_removals(cache, plan)
+            try:
                 for pkg in to_install:
                     mark_install(cache, pkg)
-
-            self.db.progress('SET', 1)
-            self.progress_region(1, 10)
-            if langpacks:
-                fetchprogress = DebconfAcquireProgress(
-                    self.db, 'ubiquity/langpacks/title', None,
-                    'ubiquity/langpacks/packages')
-                installprogress = DebconfInstallProgress(
-                    self.db, 'ubiquity/langpacks/title',
-                    'ubiquity/install/apt_info')
+            except InstallStepError as e:
+                if not (plan.to_remove or plan.to_remove_recursive):
+                    raise
+                # mark_install has cleared the cache, so mark the removals
+                # again and make them by themselves.
+                syslog.syslog(syslog.LOG_WARNING,
+                              'Not installing %s: %s' %
+                              (', '.join(to_install), e))
+                install_error = e
+                to_install = []
+                self._mark_removals(cache, plan)
+
+        self.db.progress('SET', 1)
+        self.progress_region(1, end)
+        if plan.langpacks:
+            fetchprogress = DebconfAcquireProgress(
+                self.db, 'ubiquity/langpacks/title', None,
+                'ubiquity/langpacks/packages')
+            installprogress = DebconfInstallProgress(
+                self.db, 'ubiquity/langpacks/title',
+                'ubiquity/install/apt_info')
+        else:
+            fetchprogress = DebconfAcquireProgress(
+                self.db, 'ubiquity/install/title', None,
+                'ubiquity/install/fetch_remove')
+            if to_install:
+                error_template = 'ubiquity/install/apt_error_install'
             else:
-                fetchprogress = DebconfAcquireProgress(
-                    self.db, 'ubiquity/install/title', None,
-                    'ubiquity/install/fetch_remove')
-                installprogress = DebconfInstallProgress(
-                    self.db, 'ubiquity/install/title',
-                    'ubiquity/install/apt_info',
-                    'ubiquity/install/apt_error_install')
-            chroot_setup(self.target)
-            commit_error = None
+                error_template = 'ubiquity/install/apt_error_remove'
+            installprogress = DebconfInstallProgress(
+                self.db, 'ubiquity/install/title',
+                'ubiquity/install/apt_info', error_template)
+        chroot_setup(self.target)
+        commit_error = None
+        try:
             try:
-                try:
-                    if not self.commit_with_verify(
-                            cache, fetchprogress, installprogress):
-                        fetchprogress.stop()
-                        installprogress.finish_update()
-                        self.db.progress('STOP')
-                        self.nested_progress_end()
-                        return
-                except IOError:
-                    for line in traceback.format_exc().split('\n'):
-                        syslog.syslog(syslog.LOG_ERR, line)
+                if not self.commit_with_verify(
+                        cache, fetchprogress, installprogress):
                     fetchprogress.stop()
                     installprogress.finish_update()
                     self.db.progress('STOP')
                     self.nested_progress_end()
+                    if install_error is not None:
+                        raise install_error
                     return
-                except SystemError as e:
-                    for line in traceback.format_exc().split('\n'):
-                        syslog.syslog(syslog.LOG_ERR, line)
-                    commit_error = str(e)
-            finally:
-                chroot_cleanup(self.target)
-            self.db.progress('SET', 10)
-
-            cache.open(None)
-            if commit_error or cache._depcache.broken_count > 0:
-                if commit_error is None:
-                    commit_error = ''
-                brokenpkgs = broken_packages(cache)
+            except IOError:
+                for line in traceback.format_exc().split('\n'):
+                    syslog.syslog(syslog.LOG_ERR, line)
+                fetchprogress.stop()
+                installprogress.finish_update()
+                self.db.progress('STOP')
+                self.nested_progress_end()
+                if install_error is not None:
+                    raise install_error
+                return
+            except SystemError as e:
+                for line in traceback.format_exc().split('\n'):
+                    syslog.syslog(syslog.LOG_ERR, line)
+                commit_error = str(e)
+        finally:
+            chroot_cleanup(self.target)
+        self.db.progress('SET', end)
+
+        cache.open(None)
+        # The cache now reflects what dpkg did, so get_cache needn't open
+        # it again.
+        self._cache_state = apt_state()
+        if commit_error or cache._depcache.broken_count > 0:
+            if commit_error is None:
+                commit_error = ''
+            brokenpkgs = broken_packages(cache)
+            if to_install:
                 self.warn_broken_packages(brokenpkgs, commit_error)
+            else:
+                self.warn_broken_removal(brokenpkgs, commit_error)
 
-            self.db.progress('STOP')
+        self.db.progress('STOP')
 
-            self.nested_progress_end()
+        self.nested_progress_end()
+
+        if install_error is not None:
+            raise install_error
 
     def select_language_packs(self, save=False):
         try:
@@ -1036,7 +3274,7 @@ class InstallBase:
         except debconf.DebconfError:
             return
 
-        cache = Cache()
+        cache = self.get_cache()
 
         to_install = []
         checker = osextras.find_on_path('check-language-support')
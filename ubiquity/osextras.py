@@ -20,7 +20,10 @@
 # Functions that are spiritually similar to ones in the os module, but
 # aren't there because not many people need chrooted operations like this.
 
+import errno
+import fcntl
 import os
+import struct
 
 
 def _resolve_link_root(root, path):
@@ -122,3 +125,60 @@ def glob_root(root, pathname):
         if path and path[0] != '/':
             continue
         yield path
+
+
+# _IOWR('f', 11, struct fiemap)
+FS_IOC_FIEMAP = 0xC020660B
+FIEMAP_EXTENT_UNKNOWN = 0x00000002
+# struct fiemap: fm_start, fm_length, fm_flags, fm_mapped_extents,
+# fm_extent_count, fm_reserved
+_fiemap = struct.Struct('=QQIIII')
+# struct fiemap_extent: fe_logical, fe_physical, fe_length, fe_reserved64[2],
+# fe_flags, fe_reserved[3]
+_fiemap_extent = struct.Struct('=QQQQQIIII')
+
+
+def physical_offset(fd):
+    """Return the offset on disk of the start of the file open on fd.
+
+    Return None if the file has no data or its location is unknown, and
+    raise OSError if the filesystem doesn't support FIEMAP.
+    """
+    request = bytearray(
+        _fiemap.pack(0, 0xFFFFFFFFFFFFFFFF, 0, 0, 1, 0) +
+        b'\0' * _fiemap_extent.size)
+    try:
+        fcntl.ioctl(fd, FS_IOC_FIEMAP, request)
+    except IOError as e:
+        if e.errno == errno.ENOTTY:
+            raise OSError(errno.EOPNOTSUPP, os.strerror(errno.EOPNOTSUPP))
+        raise
+    mapped_extents = _fiemap.unpack_from(request)[3]
+    if not mapped_extents:
+        return None
+    extent = _fiemap_extent.unpack_from(request, _fiemap.size)
+    if extent[5] & FIEMAP_EXTENT_UNKNOWN:
+        return None
+    return extent[1]
+
+
+def syncfs(path):
+    """Flush the filesystem containing path to disk.
+
+    Python doesn't wrap syncfs(2), so call it through libc, falling back to
+    flushing every filesystem if that doesn't work.
+    """
+    import ctypes
+
+    try:
+        libc = ctypes.CDLL(None, use_errno=True)
+        _syncfs = libc.syncfs
+    except (OSError, AttributeError):
+        os.sync()
+        return
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        if _syncfs(fd) != 0:
+            os.sync()
+    finally:
+        os.close(fd)